@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""A compact set of previously observed accessions"""
+
+from greengenes.util import greengenes_open, USER_CACHE_DIR
+from hashlib import md5
+from numpy import array, empty, load, save, searchsorted, zeros, uint8, \
+        uint64, fromiter, bitwise_or, insert
+from zlib import crc32, adler32
+from tempfile import mkstemp
+import json
+import os
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+# where stores are cached by default
+CACHE_DIR = os.path.join(USER_CACHE_DIR, 'accessions')
+
+# about a 1% false positive rate
+BLOOM_BITS_PER_ID = 10
+BLOOM_HASHES = 7
+
+def _hashes(accession):
+    """The two hashes the bloom filter positions are made from"""
+    return crc32(accession) & 0xffffffff, (adler32(accession) & 0xffffffff) | 1
+
+def make_bloom_filter(accessions, n_bits, n_hashes=BLOOM_HASHES):
+    """Returns a bytearray bloom filter of n_bits over accessions
+
+    n_bits is rounded up to a whole number of bytes.
+    """
+    n_bytes = max((n_bits + 7) / 8, 1)
+    n_bits = n_bytes * 8
+    bits = zeros(n_bytes, dtype=uint8)
+
+    n = len(accessions)
+    h1 = fromiter((crc32(a) & 0xffffffff for a in accessions), uint64, n)
+    h2 = fromiter(((adler32(a) & 0xffffffff) | 1 for a in accessions),
+                  uint64, n)
+    for i in range(n_hashes):
+        pos = (h1 + uint64(i) * h2) % uint64(n_bits)
+        bitwise_or.at(bits, pos >> uint64(3),
+                      (uint64(1) << (pos & uint64(7))).astype(uint8))
+
+    return bytearray(bits.tostring())
+
+def _widen(accessions, width):
+    """accessions as a string array at least width wide"""
+    if accessions.dtype.itemsize >= width:
+        return accessions
+    return accessions.astype('S%d' % width)
+
+class AccessionStore(object):
+    """Membership tests against a large, fixed set of accessions
+
+    The accessions are a sorted numpy string array, which may be memory
+    mapped from disk, fronted by a bloom filter so most misses never touch
+    the array. Accessions added after the fact go into the bloom filter and
+    a numpy buffer that is merged into the sorted array once it holds
+    merge_threshold accessions, so they are never kept as python strings.
+    The bloom filter is rebuilt at twice the size once the array is half
+    again as large as it was made for.
+    """
+    def __init__(self, accessions, bloom=None, n_hashes=BLOOM_HASHES,
+                 merge_threshold=10000):
+        self._accessions = accessions
+        self._width = accessions.dtype.itemsize
+        self._n_hashes = n_hashes
+        if bloom is None:
+            bloom = make_bloom_filter(accessions,
+                                      len(accessions) * BLOOM_BITS_PER_ID,
+                                      n_hashes)
+        self._bloom = bloom
+        self._n_bits = len(bloom) * 8
+        self._merge_threshold = merge_threshold
+        self._pending = empty(merge_threshold, dtype=accessions.dtype)
+        self._n_pending = 0
+
+    def _bloom_positions(self, accession):
+        """The bits of accession in the bloom filter"""
+        h1, h2 = _hashes(accession)
+        n_bits = self._n_bits
+        return [(h1 + i * h2) % n_bits for i in range(self._n_hashes)]
+
+    def _maybe_stored(self, accession):
+        """False if accession is definitely not in the store"""
+        if len(accession) > self._width:
+            return False
+
+        bloom = self._bloom
+        for pos in self._bloom_positions(accession):
+            if not bloom[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def _stored(self, accession):
+        """Binary search the sorted array, then scan the added ones"""
+        accessions = self._accessions
+        idx = searchsorted(accessions, accession)
+        if idx < len(accessions) and accessions[idx] == accession:
+            return True
+        n = self._n_pending
+        return bool(n) and (self._pending[:n] == accession).any()
+
+    def __contains__(self, accession):
+        return self._maybe_stored(accession) and self._stored(accession)
+
+    def __len__(self):
+        return len(self._accessions) + self._n_pending
+
+    def add(self, accession):
+        """Add an accession"""
+        if accession in self:
+            return
+
+        if len(accession) > self._width:
+            self._width = len(accession)
+            self._pending = _widen(self._pending, self._width)
+
+        self._pending[self._n_pending] = accession
+        self._n_pending += 1
+        bloom = self._bloom
+        for pos in self._bloom_positions(accession):
+            bloom[pos >> 3] |= 1 << (pos & 7)
+
+        if self._n_pending == len(self._pending):
+            self._merge()
+
+    def update(self, accessions):
+        """Add many accessions"""
+        for accession in accessions:
+            self.add(accession)
+
+    def _merge(self):
+        """Move the added accessions into the sorted array"""
+        n = self._n_pending
+        if not n:
+            return
+
+        width = self._width
+        pending = _widen(self._pending[:n], width)
+        pending.sort()
+        stored = _widen(self._accessions, width)
+        self._accessions = insert(stored, searchsorted(stored, pending),
+                                  pending)
+        self._pending = empty(self._merge_threshold, dtype='S%d' % width)
+        self._n_pending = 0
+
+        # keep the false positive rate down as the store grows, the bloom
+        # filter is rebuilt at twice the size so this is rare
+        n_stored = len(self._accessions)
+        if n_stored * BLOOM_BITS_PER_ID > 1.5 * self._n_bits:
+            self._bloom = make_bloom_filter(self._accessions,
+                    2 * n_stored * BLOOM_BITS_PER_ID, self._n_hashes)
+            self._n_bits = len(self._bloom) * 8
+
+    def missing(self, accessions):
+        """Returns the set of accessions not in the store
+
+        This is accessions minus the store, the reverse of set.difference.
+        """
+        self._merge()
+        accessions = set(accessions)
+        if not accessions or not len(self._accessions):
+            return accessions
+
+        # search the array for all of them at once
+        candidates = [a for a in accessions if len(a) <= self._width]
+        stored = self._accessions
+        queries = array(candidates, dtype=stored.dtype)
+        idx = searchsorted(stored, queries)
+        idx[idx == len(stored)] = 0
+        found = set(queries[stored[idx] == queries])
+
+        return set([a for a in accessions if a not in found])
+
+def _column_values(fp):
+    """Yields the first column of fp as parse_column reads it"""
+    for line in greengenes_open(fp):
+        if not line.startswith('#'):
+            yield line.strip().split('\t')[0]
+
+def build_accession_array(fp):
+    """Returns the sorted, unique first column of fp as a numpy array
+
+    The file is read twice, once for the width and count and once to fill
+    the array, so the accessions are never all held as python strings.
+    """
+    width = 1
+    count = 0
+    for value in _column_values(fp):
+        width = max(width, len(value))
+        count += 1
+
+    accessions = empty(count, dtype='S%d' % width)
+    for idx, value in enumerate(_column_values(fp)):
+        accessions[idx] = value
+    accessions.sort()
+
+    if count:
+        keep = empty(count, dtype=bool)
+        keep[0] = True
+        keep[1:] = accessions[1:] != accessions[:-1]
+        accessions = accessions[keep]
+
+    return accessions
+
+def _cache_fps(fp, cache_dir):
+    """The array, bloom filter and metadata paths for a cached store
+
+    In cache_dir the names carry a hash of the path of fp, so files with
+    the same name in different directories don't share a cache.
+    """
+    if cache_dir is None:
+        prefix = fp
+    else:
+        path_hash = md5(os.path.abspath(fp)).hexdigest()[:12]
+        prefix = os.path.join(cache_dir, '%s.%s' % (os.path.basename(fp),
+                                                    path_hash))
+    return [prefix + ext for ext in ['.accessions.npy', '.accessions.bloom',
+                                     '.accessions.json']]
+
+def _replace_file(fp, write):
+    """Write fp by calling write on a temp file that is renamed into place
+
+    Readers never see a partial file, and processes that have the old file
+    memory mapped keep their copy.
+    """
+    fd, tmp_fp = mkstemp(dir=os.path.dirname(os.path.abspath(fp)))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            write(f)
+        finally:
+            f.close()
+        os.rename(tmp_fp, fp)
+    except:
+        os.remove(tmp_fp)
+        raise
+
+def _load_cached_store(array_fp, bloom_fp, meta_fp, source):
+    """The cached AccessionStore, or None if it is stale or damaged"""
+    try:
+        with open(meta_fp) as f:
+            if json.load(f) != source:
+                return None
+        accessions = load(array_fp, mmap_mode='r')
+        with open(bloom_fp, 'rb') as f:
+            bloom = bytearray(f.read())
+        if not bloom or accessions.ndim != 1 or accessions.dtype.kind != 'S':
+            return None
+        return AccessionStore(accessions, bloom)
+    except Exception:
+        # a damaged cache is just rebuilt
+        return None
+
+def load_accession_store(fp, cache_dir=CACHE_DIR, use_cache=True):
+    """Returns an AccessionStore of the first column of fp
+
+    Lines are read as by parse_column. The sorted array and bloom filter are
+    cached in cache_dir, next to fp if it is None, and are memory mapped on
+    later loads as long as fp has the same size and modification time. The
+    default cache_dir is per user, so nothing is written next to the inputs
+    and read-only inputs still get a cache. A damaged cache
+    is rebuilt, and cache files are replaced rather than rewritten so other
+    processes using the old ones are unaffected. If the cache can't be
+    written the store is just kept in memory.
+    """
+    stat = os.stat(fp)
+    source = {'size':stat.st_size, 'mtime':stat.st_mtime,
+              'n_hashes':BLOOM_HASHES}
+    array_fp, bloom_fp, meta_fp = _cache_fps(fp, cache_dir)
+
+    if use_cache and os.path.exists(meta_fp):
+        store = _load_cached_store(array_fp, bloom_fp, meta_fp, source)
+        if store is not None:
+            return store
+
+    store = AccessionStore(build_accession_array(fp))
+
+    if use_cache:
+        try:
+            if cache_dir is not None and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            _replace_file(array_fp, lambda f: save(f, store._accessions))
+            _replace_file(bloom_fp, lambda f: f.write(store._bloom))
+            # metadata last, so a partial cache is never trusted
+            _replace_file(meta_fp, lambda f: json.dump(source, f))
+        except (IOError, OSError):
+            pass
+
+    return store
@@ -2,7 +2,9 @@
 
 from greengenes.write import write_sequence
 from greengenes.util import NoSequenceError, GreengenesRecord
-import string
+from greengenes.genbank import parse_genbank_fields, read_genbank_range
+from greengenes.sequence import normalize_dna
+import cPickle
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2012, Greengenes"
@@ -34,18 +36,16 @@ clone_names = set(['uncultured','unclassified','unknown.','unidentified',\
 isolate_names = set(['sp', 'bacterium'])
 def get_decision(r):
     """determine clone or isolate"""
-    current_decision = None
-    
-    fields = set(map(string.lower, r['source'].replace(".","").split()))
-    if len(fields.intersection(clone_names)) > 0:
+    fields = set(r['source'].replace(".","").lower().split())
+    if not fields.isdisjoint(clone_names):
         return 'clone'
-    if len(fields.intersection(isolate_names)) > 0:
+    if not fields.isdisjoint(isolate_names):
         return 'isolate'
 
-    fields = set(map(string.lower, r['definition'].replace(".","").split()))
-    if len(fields.intersection(clone_names)) > 0:
+    fields = set(r['definition'].replace(".","").lower().split())
+    if not fields.isdisjoint(clone_names):
         return 'clone'
-    if len(fields.intersection(isolate_names)) > 0:
+    if not fields.isdisjoint(isolate_names):
         return 'isolate'
 
     # check if the first character with source is lower case, if so, its an 
@@ -56,13 +56,17 @@ def get_decision(r):
     return 'named_isolate'
 
 
-def get_organism(r):
-    """Get the organism"""
-    res = r['features'][0].get('organism', None)
+def _first_value(feature, key):
+    """The first value of a qualifier, or None"""
+    res = feature.get(key, None)
     if res:
         res = res[0]
     return res
 
+def get_organism(r):
+    """Get the organism"""
+    return _first_value(r['features'][0], 'organism')
+
 def get_taxon(r):
     """get the ncbi taxon id"""
     res = r['features'][0].get('db_xref',None)
@@ -74,10 +78,7 @@ def get_taxon(r):
     return res
 
 def get_country(r):
-    res = r['features'][0].get('country', None)
-    if res:
-        res = res[0]
-    return res
+    return _first_value(r['features'][0], 'country')
 
 def _parse_migs_poorly(line, term, parse_f=lambda x: x.strip()):
     """Parse MIGS"""
@@ -108,10 +109,7 @@ def get_gold_id(r):
 def get_isolation_source(r):
     """Get the Isolation Site"""
     #return _parse_migs_poorly(r['comment'], 'Isoloation Site')
-    res = r['features'][0].get('isolation_source', None)
-    if res:
-        res = res[0]
-    return res
+    return _first_value(r['features'][0], 'isolation_source')
 
 def get_dbname(r):
     return None
@@ -126,10 +124,7 @@ def get_clone(r):
 
 def get_strain(r):
     """Get the strain"""
-    res = r['features'][0].get('strain', None)
-    if res:
-        res = res[0]
-    return res
+    return _first_value(r['features'][0], 'strain')
 
 def get_specific_host(r):
     """Specific host name"""
@@ -178,28 +173,36 @@ def get_ncbi_taxonomy(r):
     return '; '.join(r['taxonomy'])
 
 def get_genbank_summary(r):
-    """Get the gb summary data"""
+    """Get the gb summary data
+
+    Each field comes from its function in parse_funs, except that the
+    prokMSAname is put together from the decision, isolation source, clone
+    and organism already found instead of finding them all again.
+    """
     rec = GreengenesRecord()
 
     for f,m in parse_funs:
-        rec[f] = m(r)
+        if m is get_prokMSAname:
+            rec[f] = _prokmsaname(rec['decision'], rec['isolation_source'],
+                                  rec['clone'], rec['organism'])
+        else:
+            rec[f] = m(r)
 
     return rec
 
-def get_prokMSAname(r):
-    """form the prokMSAname"""
-    if get_decision(r) == 'clone':
-        isolation_source = get_isolation_source(r)
-        clone = get_clone(r)
-        
+def _prokmsaname(decision, isolation_source, clone, organism):
+    """The prokMSAname from the fields it is made of"""
+    if decision == 'clone':
         return "%s clone %s" % (str(isolation_source), str(clone))
+    elif organism is not None:
+        return "%s" % organism
     else:
-        organism = get_organism(r)
+        return None
 
-        if organism is not None:
-            return "%s" % get_organism(r)
-        else:
-            return None
+def get_prokMSAname(r):
+    """form the prokMSAname"""
+    return _prokmsaname(get_decision(r), get_isolation_source(r),
+                        get_clone(r), get_organism(r))
 
 parse_funs = [('ncbi_acc_w_ver', get_accession),
               ('ncbi_gi', get_gi),
@@ -229,3 +232,118 @@ field_order = [a for a,b in parse_funs]
 for f,m in parse_funs:
     if f not in GreengenesRecord._field:
         raise KeyError, "%s is not a valid field" % f
+
+def get_rrna_region(r):
+    """Get the longest 16S/18S region from parse_genbank_fields, or None"""
+    best = None
+    for region in r.get('rrna', []):
+        if best is None or len(region['sequence']) > len(best['sequence']):
+            best = region
+    return best
+
+def genbank_record_outcomes(records, observed=(), seen=(), rrna=False):
+    """Yields what flat_files.py does with each of the GenBank records
+
+    records is an iterator of parsed GenBank records. Yields
+    (status, accession, sequence, gg_record, location) where status is one
+    of:
+
+        'ok' : the record is good and has its sequence and gg_record
+        'no_sequence' : the record has no sequence
+        'corrupt' : the sequence has characters that aren't IUPAC DNA
+        'failure' : the accession, sequence or summary could not be had
+        'error' : the parser gave up, accession is the error message
+
+    Records whose accession is in observed or seen are skipped. seen is
+    checked as each record comes up, so it can be updated while iterating.
+
+    If rrna, records parsed with rrna=True that have a 16S/18S rRNA feature
+    give the longest such gene as the sequence, and its GenBank location.
+    Otherwise location is None.
+    """
+    while True:
+        try:
+            rec = records.next()
+        except StopIteration:
+            break
+        except Exception, e:
+            yield ('error', str(e), None, None, None)
+            break
+
+        # accession is str including version
+        try:
+            accession = get_accession(rec)
+        except:
+            yield ('failure', None, None, None, None)
+            continue
+        if accession in observed or accession in seen:
+            continue
+
+        # sequence is just a str of sequence. NCBI silently corrupts records
+        # every once and a while leading to crap in the sequence.
+        location = None
+        try:
+            region = rrna and get_rrna_region(rec)
+            if region:
+                raw = region['sequence']
+                location = region['location']
+            else:
+                raw = rec.get('sequence', '')
+            sequence, n_ambiguous, invalid = normalize_dna(raw)
+        except:
+            yield ('failure', accession, None, None, location)
+            continue
+
+        if not sequence:
+            yield ('no_sequence', accession, None, None, location)
+            continue
+        if invalid:
+            yield ('corrupt', accession, None, None, location)
+            continue
+
+        # gg_record contains gb summary data
+        try:
+            gg_record = get_genbank_summary(rec)
+        except KeyError:
+            yield ('failure', accession, None, None, location)
+            continue
+
+        yield ('ok', accession, sequence, gg_record, location)
+
+_shard_observed = ()
+_shard_rrna = False
+def init_shard_worker(observed, rrna=False):
+    """Pool initializer, hands the observed accessions to the workers"""
+    global _shard_observed, _shard_rrna
+    _shard_observed = observed
+    _shard_rrna = rrna
+
+def summarize_genbank_shard(args):
+    """Write the outcomes for a range of a GenBank file, for Pool.imap
+
+    args is (gb_fp, start, end, out_fp) with start and end from
+    split_genbank_file. Each outcome from genbank_record_outcomes is pickled
+    in order to out_fp, and out_fp is returned. Duplicate accessions are
+    left for the caller, which sees the shards in order.
+    """
+    gb_fp, start, end, out_fp = args
+    records = parse_genbank_fields(read_genbank_range(gb_fp, start, end),
+                                   rrna=_shard_rrna)
+
+    out = open(out_fp, 'wb')
+    for outcome in genbank_record_outcomes(records, _shard_observed,
+                                           rrna=_shard_rrna):
+        cPickle.dump(outcome, out, cPickle.HIGHEST_PROTOCOL)
+    out.close()
+
+    return out_fp
+
+def load_shard_outcomes(shard_fp):
+    """Yields the outcomes written by summarize_genbank_shard"""
+    f = open(shard_fp, 'rb')
+    while True:
+        try:
+            yield cPickle.load(f)
+        except EOFError:
+            break
+    f.close()
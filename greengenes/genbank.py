@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+"""Pull the fields used by flat_files out of GenBank records"""
+
+from cogent.parse.genbank import parse_locus, parse_source, parse_reference, \
+        parse_feature_table, parse_feature, dna_trans
+from cogent.parse.record import RecordError
+from gzip import open as gzopen
+import re
+import os
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+# characters dropped from ORIGIN lines, as by cogent's parse_sequence
+_origin_junk = '0123456789 \t\n\r/'
+
+def _generic(lines, rec):
+    label = lines[0].split(None, 1)[0]
+    rec[label.lower()] = ' '.join([l.strip() for l in lines])
+
+def _locus(lines, rec):
+    rec.update(parse_locus(lines[0]))
+
+def _source(lines, rec):
+    rec.update(parse_source(lines))
+
+def _reference(lines, rec):
+    rec['references'] = [parse_reference(lines)]
+
+def _features(lines, rec):
+    rec['features'] = parse_feature_table(lines)
+
+# the blocks get_genbank_summary needs, everything else is skipped
+_block_handlers = {'LOCUS':_locus,
+                   'VERSION':_generic,
+                   'DEFINITION':_generic,
+                   'COMMENT':_generic,
+                   'SOURCE':_source,
+                   'REFERENCE':_reference,
+                   'FEATURES':_features}
+
+# rRNA features extracted by parse_genbank_fields
+_ssu_product = re.compile(r'\b(16S|18S)\b|small subunit ribosomal', re.I)
+
+def is_ssu_rrna(feature):
+    """True if an rRNA feature is a 16S or 18S gene by its /product"""
+    for product in feature.get('product', []):
+        if _ssu_product.search(product):
+            return True
+    return False
+
+def _merge_spans(spans):
+    """Merge overlapping or adjacent (first, last) spans"""
+    merged = []
+    for first, last in sorted(spans):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+def extract_location(location, get_bases, length):
+    """Extract a cogent LocationList, as LocationList.extract does
+
+    get_bases(first, last) returns the 1-based, inclusive bases first to
+    last. Locations wrapping around the end of a circular sequence of
+    length bases are handled, as are those on the reverse strand.
+    """
+    result = []
+    for loc in location:
+        first, last = loc.first(), loc.last()
+        if first <= last:
+            bases = get_bases(first, last)
+        else:
+            bases = get_bases(first, length) + get_bases(1, last)
+        if loc.Strand == -1:
+            bases = bases.translate(dna_trans)[::-1]
+        result.append(bases)
+    return ''.join(result)
+
+class _RecordState(object):
+    """Where the parser is within a record"""
+    def __init__(self, rrna=False, max_full_length=None):
+        self.rec = {}
+        self.bad = False
+        self.indent = None
+        self.handler = None
+        self.block = None
+        self.feature_indent = None
+        self.origin = None
+
+        # rRNA feature blocks, and whether the current feature is one
+        self.rrna = rrna
+        self.max_full_length = max_full_length
+        self.rrna_blocks = []
+        self.in_rrna = False
+        self.scan_features = False
+        self.rrna_features = []
+        self.windows = None
+
+    def finish_block(self):
+        """Hand the current block to its handler"""
+        if self.origin is not None:
+            if self.windows is None:
+                self.rec['sequence'] = ''.join(self.origin)
+            self.origin = None
+            if self.rrna:
+                self.finish_rrna()
+        elif self.block:
+            try:
+                self.handler(self.block, self.rec)
+            except Exception:
+                # same as cogent, any failure in a block loses the record
+                self.bad = True
+        self.block = None
+        self.handler = None
+
+    def start_block(self, line):
+        first_word = line.split(None, 1)[0]
+        rec = self.rec
+        self.scan_features = False
+
+        if first_word == 'ORIGIN':
+            self.origin = []
+            if self.rrna:
+                self.start_origin()
+        elif first_word == 'REFERENCE' and 'references' in rec:
+            pass # only the first reference is used
+        elif first_word == 'FEATURES' and rec.get('features'):
+            pass # only the first feature is used
+        elif first_word in _block_handlers:
+            self.handler = _block_handlers[first_word]
+            self.block = [line]
+            self.feature_indent = None
+
+    def add_line(self, line):
+        if self.origin is not None:
+            if self.windows is None:
+                self.origin.append(line.translate(None, _origin_junk))
+            else:
+                self.add_windowed_origin(line)
+        elif self.block is not None:
+            if self.handler is _features:
+                # stop collecting at the start of the second feature
+                indent = self.feature_indent
+                if indent is None:
+                    self.feature_indent = len(line) - len(line.lstrip())
+                elif len(line) <= indent or not line[indent].isspace():
+                    self.finish_block()
+                    self.scan_features = self.rrna
+                    self.add_feature_line(line)
+                    return
+            self.block.append(line)
+        elif self.scan_features:
+            self.add_feature_line(line)
+
+    def add_feature_line(self, line):
+        """Keep the lines of rRNA features past the first feature"""
+        indent = self.feature_indent
+        if len(line) > indent and not line[indent].isspace():
+            self.in_rrna = line.split(None, 1)[0] == 'rRNA'
+            if self.in_rrna:
+                self.rrna_blocks.append([line])
+        elif self.in_rrna:
+            self.rrna_blocks[-1].append(line)
+
+    def start_origin(self):
+        """Find the 16S/18S features and what to keep of the sequence"""
+        features = [f for f in self.rec.get('features', []) \
+                    if f['type'] == 'rRNA' and f.get('location') and \
+                       is_ssu_rrna(f)]
+        for block in self.rrna_blocks:
+            try:
+                feature = parse_feature(block)
+            except Exception:
+                continue
+            if feature.get('location') and is_ssu_rrna(feature):
+                features.append(feature)
+        self.rrna_features = features
+
+        length = self.rec.get('length', 0)
+        if self.max_full_length is not None and \
+                length > self.max_full_length:
+            spans = []
+            for feature in features:
+                for loc in feature['location']:
+                    first, last = loc.first(), loc.last()
+                    if first <= last:
+                        spans.append((first, last))
+                    else:
+                        spans.extend([(first, length), (1, last)])
+            # [first, last, pieces of sequence]
+            self.windows = [w + [[]] for w in _merge_spans(spans)]
+            self.window_idx = 0
+
+    def add_windowed_origin(self, line):
+        """Keep only the bases of an ORIGIN line within the windows"""
+        windows = self.windows
+        idx = self.window_idx
+        if idx == len(windows):
+            return
+
+        position, bases = line.split(None, 1)
+        position = int(position)
+        if position + len(bases) < windows[idx][0]:
+            return # nowhere near, bases has spaces so is longer than needed
+
+        bases = bases.translate(None, _origin_junk)
+        end = position + len(bases) - 1
+        while idx < len(windows):
+            first, last, pieces = windows[idx]
+            if first > end:
+                break
+            if last >= position:
+                pieces.append(bases[max(first, position) - position:
+                                    min(last, end) - position + 1])
+            if last > end:
+                break
+            idx += 1
+        self.window_idx = idx
+
+    def finish_rrna(self):
+        """Pull out the sequence of each 16S/18S feature"""
+        rec = self.rec
+        if self.windows is None:
+            sequence = rec.get('sequence', '')
+            get_bases = lambda first, last: sequence[first - 1:last]
+            length = len(sequence)
+        else:
+            windows = [(first, last, ''.join(pieces)) \
+                       for first, last, pieces in self.windows]
+            def get_bases(first, last):
+                for w_first, w_last, bases in windows:
+                    if w_first <= first and last <= w_last:
+                        return bases[first - w_first:last - w_first + 1]
+                return ''
+            length = rec.get('length', 0)
+
+        regions = []
+        for feature in self.rrna_features:
+            location = feature['location']
+            regions.append({'product':feature['product'][0],
+                'location':''.join([l.strip() for l in \
+                                    feature['raw_location']]),
+                'first':location.first(),
+                'last':location.last(),
+                'strand':location.strand(),
+                'sequence':extract_location(location, get_bases, length)})
+        rec['rrna'] = regions
+
+def parse_genbank_fields(lines, rrna=False, max_full_length=100000):
+    """Yields dicts of the GenBank fields used by get_genbank_summary
+
+    Scans the records once and keeps only the LOCUS fields, version,
+    definition, comment, source, species and taxonomy, the first reference,
+    the first feature and the ORIGIN sequence, each as cogent's
+    MinimalGenbankParser would parse them. Everything else, including all
+    features but the first, is skipped without being parsed. As with
+    MinimalGenbankParser, records with a block that fails to parse are
+    dropped and a RecordError is raised if there is data after the last //.
+
+    If rrna, the 16S and 18S rRNA features are also pulled out, as a list
+    of dicts under 'rrna' with the product, the GenBank location string, 
+    the first and last positions (1-based, inclusive), the strand (1, -1 or
+    0 for both) and the gene sequence, reverse complemented as needed. For
+    records longer than max_full_length, only the bases under those 
+    features are kept from the ORIGIN, and there is no 'sequence'.
+    """
+    state = _RecordState(rrna, max_full_length)
+    for line in lines:
+        line = line.rstrip()
+        if not line:
+            continue
+
+        if line == '//':
+            state.finish_block()
+            if not state.bad:
+                yield state.rec
+            state = _RecordState(rrna, max_full_length)
+            continue
+
+        if state.bad:
+            continue
+
+        if state.indent is None:
+            state.indent = len(line) - len(line.lstrip())
+
+        indent = state.indent
+        if len(line) > indent and line[indent].isspace():
+            try:
+                state.add_line(line)
+            except ValueError:
+                # an ORIGIN line without a position
+                state.bad = True
+        else:
+            state.finish_block()
+            state.start_block(line)
+
+    if state.indent is not None:
+        raise RecordError, "Found additional data after records"
+
+def split_genbank_file(file_fp, n_chunks, start=0):
+    """Split a GenBank file into about n_chunks byte ranges of whole records
+
+    Returns [(start, end)] covering the file from start on. Ranges start on
+    a LOCUS line following a // line with nothing but blank lines in
+    between, so each range parses exactly as it would as part of the whole
+    file. Compressed files can't be split and come back as [(start, None)].
+    """
+    if file_fp.endswith('gz') or n_chunks < 2:
+        return [(start, None)]
+
+    size = os.path.getsize(file_fp)
+    f = open(file_fp, 'rb')
+    starts = [start]
+    for i in range(1, n_chunks):
+        f.seek(max(start + (size - start) * i / n_chunks, starts[-1] + 1))
+        last = f.readline() # likely partial, but only needs to not be //
+
+        while True:
+            pos = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if line.startswith('LOCUS') and last.rstrip() == '//':
+                starts.append(pos)
+                break
+            if line.strip():
+                last = line
+
+        if not line:
+            break
+    f.close()
+
+    return zip(starts, starts[1:] + [size])
+
+class GenbankRange(object):
+    """The lines of a GenBank file from a byte offset on
+
+    Iterating yields the lines from start up to end, or to the end of the
+    file if end is None. offset is the byte offset just past the last line
+    yielded, so a record ending there can be picked up from later. Offsets
+    into compressed files count uncompressed bytes.
+    """
+    def __init__(self, file_fp, start=0, end=None):
+        self.file_fp = file_fp
+        self.start = start
+        self.end = end
+        self.offset = start
+
+    def __iter__(self):
+        if self.file_fp.endswith('gz'):
+            f = gzopen(self.file_fp, 'rb')
+            skipped = 0
+            while skipped < self.start:
+                line = f.readline()
+                if not line:
+                    break
+                skipped += len(line)
+        else:
+            f = open(self.file_fp, 'rb')
+            f.seek(self.start)
+
+        end = self.end
+        while end is None or self.offset < end:
+            line = f.readline()
+            if not line:
+                break
+            self.offset += len(line)
+            yield line
+        f.close()
+
+def read_genbank_range(file_fp, start, end):
+    """Returns the lines of file_fp within a range from split_genbank_file"""
+    return GenbankRange(file_fp, start, end)
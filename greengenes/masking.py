@@ -1,5 +1,15 @@
 #!/usr/bin/env python
 
+from numpy import array, frombuffer, empty, zeros, uint8, packbits, \
+        unpackbits, array_equal, load, savez
+from greengenes.sequence import count_non_acgt
+from greengenes.util import greengenes_open, USER_CACHE_DIR
+from cogent.parse.fasta import MinimalFastaParser
+from hashlib import md5
+from contextlib import closing
+from tempfile import mkstemp
+import os
+
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2012, Greengenes"
 __credits__ = ["Daniel McDonald"]
@@ -9,24 +19,274 @@ __maintainer__ = "Daniel McDonald"
 __email__ = "mcdonadt@colorado.edu"
 __status__ = "Development"
 
+class CompiledMask(object):
+    """A column mask as the index array of the positions it keeps
+
+    mask is anything that iterates as truthy for the kept columns, such as
+    a list of 0/1, a numpy bool array or the text of a mask file. The mask
+    is also kept packed 8 columns to a byte as bits.
+    """
+    def __init__(self, mask):
+        if isinstance(mask, str):
+            mask = [int(c) for c in mask.strip()]
+        mask = array(mask, dtype=bool)
+        self.width = len(mask)
+        self.bits = packbits(mask)
+        self.positions = mask.nonzero()[0]
+        self.n_positions = len(self.positions)
+
+    @classmethod
+    def fromBits(cls, bits, width):
+        """Make a CompiledMask from packed bits"""
+        return cls(unpackbits(bits)[:width])
+
+    def toArray(self):
+        """The mask as a numpy bool array"""
+        mask = zeros(self.width, dtype=bool)
+        mask[self.positions] = True
+        return mask
+
+    def __eq__(self, other):
+        return isinstance(other, CompiledMask) and \
+                self.width == other.width and \
+                array_equal(self.positions, other.positions)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _check_width(self, other):
+        if self.width != other.width:
+            raise ValueError, "Masks are %d and %d columns wide" % \
+                    (self.width, other.width)
+
+    def __and__(self, other):
+        """The columns kept by both masks"""
+        self._check_width(other)
+        return CompiledMask(self.toArray() & other.toArray())
+
+    def __or__(self, other):
+        """The columns kept by either mask"""
+        self._check_width(other)
+        return CompiledMask(self.toArray() | other.toArray())
+
+    def convert(self, anchor_from, anchor_to):
+        """Move the mask to the columns of another alignment width
+
+        anchor_from and anchor_to are masks of the same columns in the two
+        widths, like 1506-1s.1508c and 1506-1s.7682c, so their nth kept
+        positions are the same column. Every position this mask keeps must
+        be kept by anchor_from.
+        """
+        self._check_width(anchor_from)
+        if anchor_from.n_positions != anchor_to.n_positions:
+            raise ValueError, "Anchor masks keep different numbers of columns"
+
+        lookup = zeros(self.width, dtype=int) - 1
+        lookup[anchor_from.positions] = anchor_to.positions
+        moved = lookup[self.positions]
+        if (moved < 0).any():
+            raise ValueError, "Column %d is not in the anchor mask" % \
+                    self.positions[(moved < 0).nonzero()[0][0]]
+
+        mask = zeros(anchor_to.width, dtype=bool)
+        mask[moved] = True
+        return CompiledMask(mask)
+
+    def _check_lengths(self, seqs, length, name):
+        """Complain about the first of seqs that isn't length long"""
+        for idx, seq in enumerate(seqs):
+            if len(seq) < length:
+                raise IndexError, "seq %d is shorter than the %s" % (idx,
+                                                                     name)
+            if len(seq) > length:
+                raise ValueError, "seq %d is longer than the %s" % (idx, 
+                                                                    name)
+
+    def inflateBlock(self, seqs):
+        """Inflate masked seqs to the full width, gaps where not kept"""
+        self._check_lengths(seqs, self.n_positions, 'mask positions')
+        if not seqs:
+            return []
+
+        masked = frombuffer(''.join(seqs), dtype=uint8)
+        full = empty((len(seqs), self.width), dtype=uint8)
+        full.fill(ord('-'))
+        full[:, self.positions] = masked.reshape(len(seqs), self.n_positions)
+        return [row.tostring() for row in full]
+
+    def deflateBlock(self, seqs):
+        """Apply the mask to full width seqs, keeping just its positions"""
+        self._check_lengths(seqs, self.width, 'mask')
+        if not seqs:
+            return []
+
+        full = frombuffer(''.join(seqs), dtype=uint8)
+        masked = full.reshape(len(seqs), self.width)[:, self.positions]
+        return [row.tostring() for row in masked]
+
+    def inflate(self, seq):
+        """Inflate a single masked seq"""
+        return self.inflateBlock([seq])[0]
+
+    def deflate(self, seq):
+        """Apply the mask to a single seq"""
+        return self.deflateBlock([seq])[0]
+
+def load_mask(mask_fp):
+    """Load a mask file of 0s and 1s"""
+    return CompiledMask(open(mask_fp).read())
+
+# the masks packaged with greengenes
+MASK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                        os.pardir, 'data', 'masks')
+
+# where compiled masks are cached by default, outside of the install
+CACHE_DIR = os.path.join(USER_CACHE_DIR, 'masks')
+
+class MaskRegistry(object):
+    """The masks in a directory by name, compiled once
+
+    name.mask files are found in mask_dir. Compiled masks are cached on 
+    disk in cache_dir, keyed by a hash of the mask file, or not at all if
+    cache_dir is None. Loaded masks are kept in memory until the size or
+    modification time of their mask file changes. If the cache can't be
+    written the masks are just compiled each time.
+    """
+    def __init__(self, mask_dir=MASK_DIR, cache_dir=CACHE_DIR):
+        self.mask_dir = mask_dir
+        self.cache_dir = cache_dir
+        self._loaded = {}
+
+    def names(self):
+        """The names of the masks in mask_dir"""
+        if not os.path.isdir(self.mask_dir):
+            return []
+        return sorted([f[:-len('.mask')] for f in os.listdir(self.mask_dir) \
+                       if f.endswith('.mask')])
+
+    def __contains__(self, name):
+        return os.path.exists(self._mask_fp(name))
+
+    def _mask_fp(self, name):
+        return os.path.join(self.mask_dir, name + '.mask')
+
+    def __getitem__(self, name):
+        mask_fp = self._mask_fp(name)
+        try:
+            stat = os.stat(mask_fp)
+        except OSError:
+            raise KeyError, name
+
+        source = (stat.st_size, stat.st_mtime)
+        if name in self._loaded and self._loaded[name][0] == source:
+            return self._loaded[name][1]
+
+        text = open(mask_fp).read()
+        if self.cache_dir is None:
+            mask = CompiledMask(text)
+        else:
+            mask = self._cached(name, text)
+
+        self._loaded[name] = (source, mask)
+        return mask
+
+    def _cached(self, name, text):
+        """Compile text through the disk cache"""
+        cache_fp = os.path.join(self.cache_dir, 
+                                '.%s.%s.npz' % (name, md5(text).hexdigest()))
+        if os.path.exists(cache_fp):
+            try:
+                with closing(load(cache_fp)) as cached:
+                    return CompiledMask.fromBits(cached['bits'],
+                                                 int(cached['width']))
+            except Exception:
+                # a damaged cache is just recompiled
+                pass
+
+        mask = CompiledMask(text)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # write then rename, so a partial cache is never read
+            fd, tmp_fp = mkstemp(suffix='.npz', dir=self.cache_dir)
+            os.close(fd)
+            try:
+                savez(tmp_fp, bits=mask.bits, width=mask.width)
+                os.rename(tmp_fp, cache_fp)
+            except (IOError, OSError):
+                os.remove(tmp_fp)
+                raise
+        except (IOError, OSError):
+            pass
+
+        return mask
+
+    def convert(self, mask, width):
+        """Move mask to width columns, see CompiledMask.convert
+
+        The anchors are a pair of masks in the registry with the same name
+        up to the width, e.g. 1506-1s.1508c and 1506-1s.7682c, that cover
+        every position mask keeps.
+        """
+        if mask.width == width:
+            return mask
+
+        names = self.names()
+        for name in names:
+            prefix = name.rsplit('.', 1)[0]
+            for other in names:
+                if other == name or other.rsplit('.', 1)[0] != prefix:
+                    continue
+                anchor_from, anchor_to = self[name], self[other]
+                if anchor_from.width != mask.width or \
+                        anchor_to.width != width:
+                    continue
+                try:
+                    return mask.convert(anchor_from, anchor_to)
+                except ValueError:
+                    continue
+
+        raise ValueError, "No anchor masks from %d to %d columns" % \
+                (mask.width, width)
+
+masks = MaskRegistry()
+
+def get_mask(name):
+    """A packaged mask by name, e.g. get_mask('1506-1s.1508c')"""
+    return masks[name]
+
 def inflate_by_mask(seq, mask):
     """Inflate seq to the mask
 
-    complain if the number of positions in seq is != to sum(mask)
+    complain if the number of positions in seq is != to sum(mask). mask
+    can be a CompiledMask, which saves compiling it on every call.
     """
-    s = []
-    idx = 0
-    for m in mask:
-        if m:
-            s.append(seq[idx])
-            idx += 1
-        else:
-            s.append('-')
+    if not isinstance(mask, CompiledMask):
+        mask = CompiledMask(mask)
+    return mask.inflate(seq)
+
+def _split_img_id(seqid):
+    """Returns (accession, genome_id) from accession|genome_id"""
+    if '|' in seqid:
+        accession, genome_id = seqid.split('|')
+    else:
+        genome_id = seqid
+        accession = None
+    return accession, genome_id
+
+def _img_seq_id(accession, genome_id):
+    if accession:
+        return '|'.join([accession, genome_id])
+    return genome_id
 
-    if len(seq) != sum(mask):
-        raise ValueError, "seq does fit mask!"
+def _ungapped_length(seq):
+    """The number of positions that aren't - or ., without copying seq"""
+    return count_non_acgt(seq, '-.')[0]
 
-    return ''.join(s)
+def _img_header(seq_id, masked_length, unmasked_length):
+    seq_info = '\t'.join(['masked_length=%d' % masked_length,
+                          'unmasked_length=%d' % unmasked_length])
+    return '\t'.join([seq_id, seq_info])
 
 def img_best_16s_per_genome(masked, unmasked):
     """Keeps the longest masked sequence per genome
@@ -37,13 +297,8 @@ def img_best_16s_per_genome(masked, unmasked):
     len_genome = {}
 
     for seqid, seq in masked.items():
-        if '|' in seqid:
-            accession, genome_id = seqid.split('|')
-        else:
-            genome_id = seqid
-            accession = None
-
-        length = len(seq.replace('-','').replace('.',''))
+        accession, genome_id = _split_img_id(seqid)
+        length = _ungapped_length(seq)
 
         if genome_id not in len_genome:
             len_genome[genome_id] =[]
@@ -52,35 +307,72 @@ def img_best_16s_per_genome(masked, unmasked):
 
     for genome_id, lengths in len_genome.items():
         masked_length, accession = sorted(lengths)[-1] # take the longest one
+        seq_id = _img_seq_id(accession, genome_id)
+        unmasked_length = _ungapped_length(unmasked[seq_id])
+        seq_header = _img_header(seq_id, masked_length, unmasked_length)
+        to_keep[seq_header] = masked[seq_id]
 
-        if accession:
-            seq_id = '|'.join([accession,genome_id])
-        else:
-            seq_id = genome_id
+    return to_keep
 
-        unmasked_length = len(unmasked[seq_id].replace('-','').replace('.',''))
+def stream_img_best_16s_per_genome(masked_fp, unmasked_fp):
+    """img_best_16s_per_genome over fasta files, one sequence at a time
 
-        seq_info = '\t'.join(['masked_length=%d' % masked_length,
-                              'unmasked_length=%d' % unmasked_length])
+    Yields (header, masked seq) in the order of masked_fp. The masked fasta
+    is read once to find the longest sequence of each genome, keeping just
+    its length and accession, then the unmasked fasta is read for the
+    lengths of those sequences alone, then the masked fasta again for the
+    sequences to keep.
+    """
+    best = {}
+    for seqid, seq in MinimalFastaParser(greengenes_open(masked_fp)):
+        accession, genome_id = _split_img_id(seqid)
+        candidate = (_ungapped_length(seq), accession)
+        if genome_id not in best or candidate > best[genome_id]:
+            best[genome_id] = candidate
 
-        seq_header = '\t'.join([seq_id, seq_info])
+    masked_lengths = {}
+    for genome_id, (length, accession) in best.iteritems():
+        masked_lengths[_img_seq_id(accession, genome_id)] = length
+    best = None
 
-        to_keep[seq_header] = masked[seq_id]
+    unmasked_lengths = {}
+    for seqid, seq in MinimalFastaParser(greengenes_open(unmasked_fp)):
+        if seqid in masked_lengths:
+            unmasked_lengths[seqid] = _ungapped_length(seq)
 
-    return to_keep
+    for seqid in masked_lengths:
+        if seqid not in unmasked_lengths:
+            raise KeyError, seqid
 
+    for seqid, seq in MinimalFastaParser(greengenes_open(masked_fp)):
+        # pop, so a repeated id is only kept once
+        masked_length = masked_lengths.pop(seqid, None)
+        if masked_length is not None:
+            yield _img_header(seqid, masked_length, 
+                              unmasked_lengths[seqid]), seq
 
 if __name__ == '__main__':
-    from cogent.parse.fasta import MinimalFastaParser
     from sys import argv
 
     masked = MinimalFastaParser(open(argv[1]))
-    mask = [int(c) for c in open(argv[3]).read().strip()]
+    if os.path.exists(argv[3]):
+        mask = load_mask(argv[3])
+    else:
+        mask = get_mask(argv[3])
 
     f = open(argv[4],'w')
+    def write_block(block):
+        inflated = mask.inflateBlock([seq for seqid, seq in block])
+        f.write(''.join(['>%s\n%s\n' % (seqid, seq) \
+                         for (seqid, masked_seq), seq in zip(block, inflated)]))
+
+    block = []
     for seqid, seq in masked:
-        inflated = inflate_by_mask(seq, mask)
-        f.write('>%s\n%s\n' % (seqid, inflated))
+        block.append((seqid, seq))
+        if len(block) == 1000:
+            write_block(block)
+            block = []
+    if block:
+        write_block(block)
 
     f.close()
-
@@ -1,5 +1,10 @@
 #!/usr/bin/env python
 
+from greengenes.sequence import count_non_acgt, ACGT
+from numpy import array, frombuffer, zeros, uint8, int32, int64, float64, \
+        cumsum, maximum, errstate, searchsorted, ix_
+import re
+
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2012, Greengenes"
 __credits__ = ["Daniel McDonald"]
@@ -9,8 +14,143 @@ __maintainer__ = "Daniel McDonald"
 __email__ = "mcdonadt@colorado.edu"
 __status__ = "Development"
 
+class CompiledInvariants(object):
+    """Invariant maps from parse_invariants as a uint8 matrix
+
+    Only the columns where some invariant isn't N are kept, with a mask of
+    the non-N positions of each invariant within them.
+    """
+    def __init__(self, invariants):
+        self.ids = [id_ for id_, inv_map, inv_length in invariants]
+        self.lengths = array([inv_length for id_, inv_map, inv_length \
+                              in invariants], dtype=float64)
+        self.width = max([len(inv_map) for id_, inv_map, inv_length \
+                          in invariants])
+
+        maps = zeros((len(invariants), self.width), dtype=uint8)
+        maps[:] = ord('N')
+        for row, (id_, inv_map, inv_length) in zip(maps, invariants):
+            row[:len(inv_map)] = frombuffer(inv_map, dtype=uint8)
+
+        not_n = maps != ord('N')
+        self.columns = not_n.any(axis=0).nonzero()[0]
+        self.maps = maps[:, self.columns]
+        self.mask = not_n[:, self.columns]
+
+def compile_invariants(invariants):
+    """Compile the invariants from parse_invariants for calc_invariant_batch"""
+    if isinstance(invariants, CompiledInvariants):
+        return invariants
+    return CompiledInvariants(invariants)
+
+def _sequence_matrix(seqs, width):
+    """seqs as rows of a uint8 matrix, cut or zero padded to width"""
+    padded = ''.join([s[:width].ljust(width, '\0') for s in seqs])
+    return frombuffer(padded, dtype=uint8).reshape(len(seqs), width)
+
+def calc_invariant_batch(seqs, invariants):
+    """Return calc_invariant of each of seqs as a numpy array
+
+    invariants are from parse_invariants or compile_invariants, compiling
+    them once up front saves redoing it on every call. Each invariant is
+    compared against all of seqs at once, as calc_invariant, positions past
+    the end of a sequence or invariant aren't compared.
+    """
+    inv = compile_invariants(invariants)
+    seqs = _sequence_matrix(seqs, inv.width)[:, inv.columns]
+
+    hits = [((seqs == inv_map) & mask).sum(axis=1) / length \
+            for inv_map, mask, length in zip(inv.maps, inv.mask, inv.lengths)]
+    return array(hits).max(axis=0)
+
+def check_invariant_batch(seqs, invariants, cutoff, chunk_size=64):
+    """Whether calc_invariant of each of seqs is at least cutoff
+
+    Returns numpy arrays (passed, bound). The non-N positions of each
+    invariant are compared chunk_size at a time, and a sequence is dropped
+    from an invariant as soon as the hits so far reach cutoff, in which
+    case it passes and bound is the score so far, a lower bound on
+    calc_invariant, or as soon as the hits so far and the positions left
+    can't reach cutoff. A sequence that never passes fails, and bound is
+    the best score it could have had, an upper bound on calc_invariant.
+    Passed sequences aren't checked against the invariants that follow.
+    """
+    inv = compile_invariants(invariants)
+    matrix = _sequence_matrix(seqs, inv.width)
+    seq_lengths = array([len(s) for s in seqs], dtype=int64)
+
+    passed = zeros(len(seqs), dtype=bool)
+    bound = zeros(len(seqs), dtype=float64)
+    for inv_map, mask, length in zip(inv.maps, inv.mask, inv.lengths):
+        positions = inv.columns[mask]
+        bases = inv_map[mask]
+
+        active = (~passed).nonzero()[0]
+        hits = zeros(len(active), dtype=int64)
+        # positions past the end of a sequence are never compared
+        comparable = searchsorted(positions, seq_lengths[active])
+
+        for start in range(0, len(positions), chunk_size):
+            if not len(active):
+                break
+            end = start + chunk_size
+            hits += (matrix[ix_(active, positions[start:end])] == \
+                     bases[start:end]).sum(axis=1)
+            best_possible = (hits + (comparable - end).clip(0)) / length
+
+            reached = hits / length >= cutoff
+            hopeless = best_possible < cutoff
+            passed[active[reached]] = True
+            bound[active[reached]] = hits[reached] / length
+            bound[active[hopeless]] = maximum(bound[active[hopeless]],
+                                              best_possible[hopeless])
+
+            undecided = ~(reached | hopeless)
+            active = active[undecided]
+            hits = hits[undecided]
+            comparable = comparable[undecided]
+
+    return passed, bound
+
+def check_invariant(seq, invariants, cutoff):
+    """Returns (calc_invariant >= cutoff, bound), see check_invariant_batch"""
+    passed, bound = check_invariant_batch([seq], invariants, cutoff)
+    return bool(passed[0]), bound[0]
+
+# the invariants and cutoff of a metrics worker process
+_worker_invariants = None
+_worker_cutoff = None
+
+def init_metrics_worker(invariants, invariant_cutoff=None):
+    """Pool initializer, compile the invariants once for the process"""
+    global _worker_invariants, _worker_cutoff
+    _worker_invariants = compile_invariants(invariants)
+    _worker_cutoff = invariant_cutoff
+
+def calc_metrics_block(block):
+    """Returns [(id, invariant score, non-ACGT fraction)] for a block
+
+    block is a list of (id, aligned sequence). The invariants are those
+    given to init_metrics_worker. If it was given an invariant_cutoff, the
+    invariant score is the bound from check_invariant_batch, so it is on
+    the same side of the cutoff as the full score. Sequences that are all
+    gaps have a non-ACGT fraction of nan.
+    """
+    ids = [id_ for id_, seq in block]
+    seqs = [seq for id_, seq in block]
+    if _worker_cutoff is None:
+        inv_scores = calc_invariant_batch(seqs, _worker_invariants)
+    else:
+        passed, inv_scores = check_invariant_batch(seqs, _worker_invariants,
+                                                   _worker_cutoff)
+    non_acgt = calc_nonACGT_batch(seqs)
+    return zip(ids, inv_scores.tolist(), non_acgt.tolist())
+
 def calc_invariant(seq, invariants):
     """Return the percent of bases that don't agree with invariants"""
+    if isinstance(invariants, CompiledInvariants):
+        return calc_invariant_batch([seq], invariants)[0]
+
     hits = [] 
     for id_, inv_map, inv_length in invariants:
         hit = 0.0
@@ -24,14 +164,60 @@ def calc_invariant(seq, invariants):
 
 def calc_nonACGT(seq):
     """Calculate the percentage of non-ACGT characters"""
-    aln_count = 0
-    non_acgt = 0
-    for c in seq:
-        if c == '-':
-            continue
-        aln_count += 1
-        if c not in ['A','G','C','T']:
-            non_acgt += 1
+    aln_count, non_acgt = count_non_acgt(seq)
     return float(non_acgt) / aln_count
 
+# lookup table codes for each byte of a sequence
+_BASE, _NON_ACGT, _GAP = 0, 1, 2
+
+def _code_table(gaps):
+    """256 entry lookup table of bytes to _BASE, _NON_ACGT or _GAP
+
+    The null byte used to pad sequences out is a gap.
+    """
+    table = zeros(256, dtype=uint8)
+    table[:] = _NON_ACGT
+    table[frombuffer(ACGT, dtype=uint8)] = _BASE
+    if gaps:
+        table[frombuffer(gaps, dtype=uint8)] = _GAP
+    table[0] = _GAP
+    return table
+
+def _block_codes(seqs, gaps):
+    """seqs as a matrix of _code_table codes, padded out with gaps"""
+    width = max([len(s) for s in seqs] or [0])
+    return _code_table(gaps)[_sequence_matrix(seqs, width)]
+
+def count_non_acgt_batch(seqs, gaps='-'):
+    """Returns arrays of count_non_acgt's (n_bases, n_non_acgt) for seqs"""
+    codes = _block_codes(seqs, gaps)
+    n_bases = (codes != _GAP).sum(axis=1)
+    n_non_acgt = (codes == _NON_ACGT).sum(axis=1)
+    return n_bases, n_non_acgt
+
+def calc_nonACGT_batch(seqs, gaps='-'):
+    """calc_nonACGT for each of seqs as a numpy array
+
+    Sequences that are all gaps are nan rather than raising
+    ZeroDivisionError.
+    """
+    n_bases, n_non_acgt = count_non_acgt_batch(seqs, gaps)
+    with errstate(divide='ignore', invalid='ignore'):
+        return n_non_acgt / n_bases.astype(float64)
+
+def calc_max_non_acgt_streak(seq, gaps='-'):
+    """The longest run of non-ACGT bases in seq, gaps are skipped over"""
+    seq = seq.translate(None, gaps)
+    return max([len(run) for run in re.split('[%s]+' % ACGT, seq)])
+
+def calc_max_non_acgt_streak_batch(seqs, gaps='-'):
+    """calc_max_non_acgt_streak for each of seqs as a numpy array"""
+    codes = _block_codes(seqs, gaps)
+    if not codes.size:
+        return zeros(len(seqs), dtype=int64)
 
+    # the non-ACGT bases so far, less those as of the last ACGT base, is
+    # the length of the current run. Gaps neither add to nor end a run.
+    so_far = cumsum(codes == _NON_ACGT, axis=1, dtype=int32)
+    at_last_base = maximum.accumulate(so_far * (codes == _BASE), axis=1)
+    return (so_far - at_last_base).max(axis=1).astype(int64)
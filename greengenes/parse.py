@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
 from cogent.parse.fasta import MinimalFastaParser
-from greengenes.util import GreengenesRecord
+from greengenes.util import GreengenesRecord, coerce_columns
+from itertools import izip
+from numpy import array, ones, zeros, float64, int64, ma
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2012, Greengenes"
@@ -75,21 +77,176 @@ def parse_column(open_file):
     return set([l.strip().split('\t')[0] for l in open_file \
                                          if not l.startswith('#')])
 
-def parse_gg_summary_flat(open_file):
-    """Parse a flat greengenes summary file from flat_files"""
+def parse_gg_summary_flat(open_file, set_types=True, block_size=10000):
+    """Parse a flat greengenes summary file from flat_files
+
+    If set_types, values are typed and validated by column a block_size
+    block of lines at a time, and a ValueError describing every bad value
+    in the block is raised if the block does not validate.
+    """
     header_line = open_file.readline()
     if not header_line.startswith('#'):
         raise ValueError, "Missing the header!"
 
     header = header_line[1:].strip().split('\t')
 
-    print "WARNING: NOT SETTING TYPES CURRENTLY"
-    for line in open_file:
-        record = GreengenesRecord()
+    if not set_types:
+        for line in open_file:
+            record = GreengenesRecord()
 
-        for key,value in zip(header, line.strip().split('\t')):
-            record[key] = value
+            for key,value in zip(header, line.strip().split('\t')):
+                record[key] = value
 
-        #record.setTypes()
-        yield record
+            yield record
+        return
+
+    block = []
+    # the header is line 1
+    block_start = 2
+    for line in open_file:
+        block.append(line.strip().split('\t'))
+
+        if len(block) == block_size:
+            for record in _typed_block(header, block, block_start):
+                yield record
+            block_start += len(block)
+            block = []
+
+    if block:
+        for record in _typed_block(header, block, block_start):
+            yield record
+
+def _pad_rows(rows, n_fields):
+    """Put back the trailing empty fields stripped off of rows"""
+    for fields in rows:
+        if len(fields) < n_fields:
+            fields.extend([None] * (n_fields - len(fields)))
+
+def _typed_columns(header, rows, first_line):
+    """Type the columns of a block of rows, complain about everything bad"""
+    columns = dict(zip(header, zip(*rows)))
+    typed, errors = coerce_columns(columns)
+    if errors:
+        msg = ["line %d: %s=%r is %s" % (first_line + row, field, value,
+                                           reason)
+               for row, field, value, reason in errors]
+        raise ValueError, "Bad values in summary\n%s" % '\n'.join(msg)
+    return typed
+
+def _typed_block(header, rows, first_line):
+    """Type a block of split lines, complain about everything that is bad"""
+    _pad_rows(rows, len(header))
+    typed = _typed_columns(header, rows, first_line)
+    return [GreengenesRecord(izip(header, values)) \
+            for values in izip(*[typed[h] for h in header])]
+
+_numpy_types = {int:int64, float:float64}
+
+def _column_type(field):
+    """The numpy type of a numeric GreengenesRecord field, or None"""
+    spec = GreengenesRecord._field.get(field)
+    if spec is None:
+        return None
+    return _numpy_types.get(spec['type'])
+
+def _as_column(field, values):
+    """A numpy masked array for numeric fields, else interned strings"""
+    type_ = _column_type(field)
+    if type_ is None:
+        return [v if v is None else intern(v) for v in values]
+
+    missing = array([v is None for v in values], dtype=bool)
+    data = zeros(len(values), dtype=type_)
+    if not missing.all():
+        data[~missing] = [v for v in values if v is not None]
+    return ma.array(data, mask=missing)
+
+def _predicate_column(column):
+    """String columns are handed to predicates as numpy object arrays"""
+    if isinstance(column, list):
+        return array(column, dtype=object)
+    return column
+
+def _select_rows(column, keep):
+    """The rows of a column where keep is True"""
+    if isinstance(column, list):
+        return [v for v, k in izip(column, keep) if k]
+    return column[keep]
+
+def load_gg_summary_columns(open_file, columns=None, where=None,
+                            block_size=10000):
+    """Load a flat greengenes summary file from flat_files by column
+
+    Only the columns named in columns, all of them if None, are kept, and
+    lines are only split as far as the last of them.
+    Numeric fields come back as numpy masked arrays, masked where the value
+    is missing, and everything else as lists of interned strings or None.
+    Values are typed and validated as by parse_gg_summary_flat.
+
+    where is {field: predicate} and keeps only the rows where every
+    predicate is true. Each predicate is called with a block of its column,
+    in the form above, and returns a boolean array, so
+    {'non_acgt_percent': lambda v: v < 0.01} keeps the rows with less than
+    1% non-ACGT bases. Masked results count as false. Fields in where
+    don't need to be in columns.
+
+    Returns {field: column}.
+    """
+    header_line = open_file.readline()
+    if not header_line.startswith('#'):
+        raise ValueError, "Missing the header!"
+    header = header_line[1:].strip().split('\t')
 
+    if columns is None:
+        columns = header
+    if where is None:
+        where = {}
+
+    wanted = list(columns) + [f for f in where if f not in columns]
+    missing = [f for f in wanted if f not in header]
+    if missing:
+        raise ValueError, "Not in the summary: %s" % ', '.join(missing)
+
+    indices = [header.index(f) for f in wanted]
+    n_fields = max(indices) + 1
+
+    blocks = []
+    def add_block(rows, first_line):
+        _pad_rows(rows, n_fields)
+        picked = [[fields[i] for i in indices] for fields in rows]
+        if picked:
+            typed = _typed_columns(wanted, picked, first_line)
+        else:
+            typed = dict([(f, []) for f in wanted])
+        block = dict([(f, _as_column(f, typed[f])) for f in wanted])
+
+        if where:
+            keep = ones(len(rows), dtype=bool)
+            for field, predicate in where.items():
+                keep &= ma.filled(predicate(_predicate_column(block[field])),
+                                  False)
+            block = dict([(f, _select_rows(block[f], keep)) for f in columns])
+        blocks.append(block)
+
+    rows = []
+    # the header is line 1
+    block_start = 2
+    for line in open_file:
+        # only split as far as the last column wanted
+        rows.append(line.strip().split('\t', n_fields))
+        if len(rows) == block_size:
+            add_block(rows, block_start)
+            block_start += len(rows)
+            rows = []
+    if rows or not blocks:
+        add_block(rows, block_start)
+
+    result = {}
+    for field in columns:
+        if _column_type(field) is None:
+            result[field] = []
+            for b in blocks:
+                result[field].extend(b[field])
+        else:
+            result[field] = ma.concatenate([b[field] for b in blocks])
+    return result
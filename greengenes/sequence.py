@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+"""Validate and normalize DNA sequences"""
+
+from string import maketrans
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+ACGT = 'ACGT'
+AMBIGUOUS_DNA = 'NRYSMKWVHBD'
+IUPAC_DNA = ACGT + AMBIGUOUS_DNA
+
+# uppercases the IUPAC characters and leaves everything else alone
+_iupac_upper = maketrans(IUPAC_DNA.lower(), IUPAC_DNA)
+
+def normalize_dna(seq):
+    """Uppercase a DNA sequence and check it against the IUPAC alphabet
+
+    Returns (sequence, n_ambiguous, invalid) where sequence is uppercased,
+    n_ambiguous is the number of IUPAC bases other than ACGT and invalid
+    holds any characters that aren't IUPAC DNA in either case, in order, so
+    the sequence is good if invalid is empty. All of the work is done by
+    str.translate, the only full size copy made is the uppercased sequence.
+    """
+    seq = seq.translate(_iupac_upper)
+    not_acgt = seq.translate(None, ACGT)
+    invalid = not_acgt.translate(None, AMBIGUOUS_DNA)
+    return seq, len(not_acgt) - len(invalid), invalid
+
+def count_non_acgt(seq, gaps='-'):
+    """Returns (number of non-gap characters, number not A, C, G or T)
+
+    The check is case sensitive, so lowercase bases count as not ACGT.
+    """
+    n_bases = len(seq) - sum([seq.count(c) for c in gaps])
+    n_acgt = sum([seq.count(c) for c in ACGT])
+    return n_bases, n_bases - n_acgt
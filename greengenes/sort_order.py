@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
 from cogent.parse.tree import DndParser
+from numpy import array, asarray, empty, arange, lexsort, int64, int32, \
+        uint8, concatenate, searchsorted, ones, zeros, unique
+from tempfile import mkstemp
+from heapq import merge
+import os
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2012, Greengenes"
@@ -93,14 +98,232 @@ def sort_order(records):
 
     return order
 
+# the tips of sort_order's tree, left to right, by (decision, in_pref, has_sp)
+_buckets = {('named_isolate',True,True):0,
+            ('named_isolate',True,False):1,
+            ('clone',True,False):2,
+            ('named_isolate',False,True):3,
+            ('named_isolate',False,False):4,
+            ('clone',False,False):5}
+
+def _iter_records(records):
+    """(id, (length, decision, in_pref, has_sp)) from a dict or iterable"""
+    if hasattr(records, 'iteritems'):
+        return records.iteritems()
+    return iter(records)
+
+def sort_columns(ids, lengths, buckets):
+    """Sort records given as columns, returns (ids, lengths, buckets)
+
+    buckets are the positions of the records' tips in sort_order's tree, 
+    from _buckets. The composite key puts the bucket first and longer
+    sequences first within it. Ties go to the larger id, as in sort_order.
+    """
+    ids = asarray(ids)
+    lengths = asarray(lengths)
+    buckets = asarray(buckets)
+    if not len(ids):
+        return ids, lengths, buckets
+
+    key = buckets.astype(int64) * (int(lengths.max()) + 1) - lengths
+
+    # larger ids first, from load_sort_columns they are already in order
+    descending = arange(len(ids) - 1, -1, -1)
+    if not (ids[1:] >= ids[:-1]).all():
+        id_rank = empty(len(ids), dtype=int64)
+        id_rank[ids.argsort(kind='mergesort')] = descending
+        descending = id_rank
+
+    order = lexsort((descending, key))
+    return ids[order], lengths[order], buckets[order]
+
+def _key_block(block):
+    """Sort a block of (id, (length, decision, in_pref, has_sp))"""
+    if not block:
+        return sort_columns([], [], [])
+    ids, values = zip(*block)
+    lengths, decisions, in_prefs, has_sps = zip(*values)
+
+    buckets = map(_buckets.get, zip(decisions, in_prefs, has_sps))
+    if None in buckets:
+        raise KeyError, tuple(values[buckets.index(None)][1:])
+    return sort_columns(ids, lengths, buckets)
+
+def sort_order_by_key(records):
+    """sort_order with one numpy sort of a key per record, no tree
+
+    records is a dict as from merge_dec_length, or an iterable of its items.
+    """
+    ids, lengths, buckets = _key_block(list(_iter_records(records)))
+    return ids.tolist()
+
+class _Descending(str):
+    """A str that sorts in reverse"""
+    def __lt__(self, other):
+        return str.__gt__(self, other)
+
+    def __gt__(self, other):
+        return str.__lt__(self, other)
+
+def _read_run(run_fp):
+    """Yields the sort keys of a sorted run, removing it when done"""
+    for line in open(run_fp):
+        bucket, length, id_ = line.rstrip('\n').split('\t', 2)
+        yield int(bucket), -int(length), _Descending(id_)
+    os.remove(run_fp)
+
+def external_sort_order(records, max_records=1000000, tmp_dir=None):
+    """sort_order for more records than fit in memory
+
+    records is an iterable as for sort_order_by_key. Blocks of max_records
+    are sorted and written out to tmp_dir, then merged. Yields the ids in
+    order.
+    """
+    run_fps = []
+    try:
+        block = []
+        for record in _iter_records(records):
+            block.append(record)
+            if len(block) == max_records:
+                run_fps.append(_write_run(_key_block(block), tmp_dir))
+                block = []
+
+        if not run_fps:
+            # it all fit, no need to touch the disk
+            for id_ in _key_block(block)[0].tolist():
+                yield id_
+            return
+        run_fps.append(_write_run(_key_block(block), tmp_dir))
+
+        for bucket, neg_length, id_ in merge(*map(_read_run, run_fps)):
+            yield str(id_)
+    finally:
+        for run_fp in run_fps:
+            if os.path.exists(run_fp):
+                os.remove(run_fp)
+
+def _write_run(sorted_block, tmp_dir):
+    """Write a sorted block to a temp file, returns the path"""
+    ids, lengths, buckets = sorted_block
+    fd, run_fp = mkstemp(prefix='sort_order_', suffix='.txt', dir=tmp_dir)
+    f = os.fdopen(fd, 'w')
+    f.write(''.join(['%d\t%d\t%s\n' % r for r in \
+                     zip(buckets.tolist(), lengths.tolist(), ids.tolist())]))
+    f.close()
+    return run_fp
+
+def _blocks(lines, parse, block_size, skip_comments=True):
+    """Yields lists of parse(line) for block_size lines at a time"""
+    block = []
+    for line in lines:
+        if skip_comments and line.startswith('#'):
+            continue
+        block.append(parse(line))
+        if len(block) == block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+def _last_unique(ids):
+    """Indices of the last of each id, in id order, as a dict would keep"""
+    order = ids.argsort(kind='mergesort')
+    sorted_ids = ids[order]
+    last = ones(len(ids), dtype=bool)
+    last[:-1] = sorted_ids[:-1] != sorted_ids[1:]
+    return order[last]
+
+def _in_sorted(ids, sorted_ids):
+    """Whether each of ids is in the sorted array sorted_ids"""
+    if not len(sorted_ids):
+        return zeros(len(ids), dtype=bool)
+    idx = searchsorted(sorted_ids, ids)
+    idx[idx == len(sorted_ids)] = 0
+    return sorted_ids[idx] == ids
+
+def _parse_length_line(line):
+    id_, length = line.strip().split('\t', 1)
+    return id_, int(length)
+
+def _parse_dec_line(line):
+    """(id, bucket out of the preference) as parse_dec reads a line
+
+    The bucket for the same record in the preference is 3 less, see
+    _buckets.
+    """
+    fields = line.strip().split('\t')
+    if len(fields) == 2:
+        id_, dec = fields
+        organism = ""
+    else:
+        id_, dec, organism = fields
+
+    if dec != 'named_isolate':
+        return id_, 5
+    elif 'sp.' in organism:
+        return id_, 4
+    else:
+        return id_, 3
+
+def _load_column_pairs(lines, parse, block_size, dtype):
+    """Read (id, value) lines to (ids, values) arrays, last of each id kept"""
+    ids = []
+    values = []
+    for block in _blocks(lines, parse, block_size):
+        block_ids, block_values = zip(*block)
+        ids.append(array(block_ids))
+        values.append(array(block_values, dtype=dtype))
+    if not ids:
+        return array([], dtype='S1'), array([], dtype=dtype)
+
+    ids = concatenate(ids)
+    values = concatenate(values)
+    keep = _last_unique(ids)
+    return ids[keep], values[keep]
+
+def load_sort_columns(dec_lines, length_lines, preference_lines,
+                      block_size=100000):
+    """Load the sort_order inputs joined as columns, for sort_columns
+
+    Returns (ids, lengths, buckets) of the records in both the decision
+    and length files, the same records merge_dec_length would give from
+    parse_dec, parse_lengths and the preference ids. ids are a numpy
+    string array, in sorted order, lengths are int32 and buckets are
+    sort_order's tips as uint8, so each id is held once in a compact array
+    instead of as keys of three dicts.
+    """
+    # comment lines included, as sort_order.py has always read it
+    preference = [array([l.strip() for l in block]) for block in \
+                  _blocks(preference_lines, str, block_size, False)]
+    if preference:
+        preference = unique(concatenate(preference))
+    else:
+        preference = array([], dtype='S1')
+
+    length_ids, lengths = _load_column_pairs(length_lines, 
+                                             _parse_length_line, block_size,
+                                             int32)
+    dec_ids, buckets = _load_column_pairs(dec_lines, _parse_dec_line,
+                                          block_size, uint8)
+
+    # both are sorted and unique, so the join is a search of one in the other
+    in_lengths = _in_sorted(dec_ids, length_ids)
+    ids = dec_ids[in_lengths]
+    buckets = buckets[in_lengths]
+    lengths = lengths[searchsorted(length_ids, ids)]
+    buckets[_in_sorted(ids, preference)] -= 3
+
+    return ids, lengths, buckets
+
 if __name__ == '__main__':
     from sys import argv
-    dec = parse_dec(open(argv[1]))
-    lengths = parse_lengths(open(argv[2]))
-    preference = set([l.strip() for l in open(argv[3])])
-    merged = merge_dec_length(preference, lengths,dec)
+    ids, lengths, buckets = load_sort_columns(open(argv[1]), open(argv[2]),
+                                              open(argv[3]))
+    order = sort_columns(ids, lengths, buckets)[0]
 
-    order = sort_order(merged)
     f = open(argv[4],'w')
-    f.write('\n'.join(order))
+    for start in range(0, len(order), 100000):
+        if start:
+            f.write('\n')
+        f.write('\n'.join(order[start:start + 100000].tolist()))
     f.close()
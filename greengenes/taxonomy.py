@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+"""Taxonomy strings interned as the nodes of a trie"""
+
+from greengenes.util import greengenes_open
+from contextlib import closing
+from tempfile import mkstemp
+from numpy import array, zeros, ones, arange, argsort, searchsorted, \
+        load, savez, add, bincount, int32, int64
+import os
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2013, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+ROOT = 0
+
+class TaxonomyTrie(object):
+    """Lineages interned as nodes, and the ids that have them
+
+    Node 0 is the root and every other node is a taxon name under its
+    parent, so a lineage such as "k__a; p__b; c__" is the node of its last
+    name. Nodes are numbered in preorder, so the nodes under node n are
+    n up to, but not including, ends[n]. parents, depths, ends and name_ids
+    are numpy arrays by node and names holds the taxon names. ids is a
+    sorted numpy string array and id_nodes holds the node of each.
+    """
+    def __init__(self, names, name_ids, parents, ids, id_nodes):
+        self.names = [str(n) for n in names]
+        self.name_ids = name_ids
+        self.parents = parents
+        self.ids = ids
+        self.id_nodes = id_nodes
+        self.n_nodes = len(parents)
+
+        # walk every node up to the root at once, the root is its own parent
+        depths = zeros(self.n_nodes, dtype=int32)
+        above = arange(self.n_nodes)
+        while above.any():
+            depths += above != ROOT
+            above = parents[above]
+        self.depths = depths
+
+        # subtree sizes, deepest nodes first
+        sizes = ones(self.n_nodes, dtype=int64)
+        for depth in range(depths.max(), 0, -1):
+            nodes = (depths == depth).nonzero()[0]
+            add.at(sizes, parents[nodes], sizes[nodes])
+        self.ends = arange(self.n_nodes) + sizes
+        self._children = None
+
+        # the ids in node order, for the ids under a clade
+        self._by_node = argsort(id_nodes, kind='mergesort')
+        self._sorted_nodes = id_nodes[self._by_node]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_):
+        return self._id_index(id_) is not None
+
+    def _id_index(self, id_):
+        ids = self.ids
+        if not len(ids) or len(id_) > ids.dtype.itemsize:
+            return None
+        idx = searchsorted(ids, id_)
+        if idx < len(ids) and ids[idx] == id_:
+            return idx
+        return None
+
+    def __getitem__(self, id_):
+        """The node of an id"""
+        idx = self._id_index(id_)
+        if idx is None:
+            raise KeyError, id_
+        return int(self.id_nodes[idx])
+
+    def find(self, lineage):
+        """The node of a lineage, a list of names, or None"""
+        if self._children is None:
+            names = self.names
+            self._children = dict([((int(p), names[n]), node) for node, p, n \
+                in zip(range(1, self.n_nodes), self.parents[1:].tolist(),
+                       self.name_ids[1:].tolist())])
+
+        node = ROOT
+        children = self._children
+        for name in lineage:
+            node = children.get((node, name))
+            if node is None:
+                return None
+        return node
+
+    def lineage(self, node):
+        """The names from the first rank down to node"""
+        names = self.names
+        name_ids = self.name_ids
+        parents = self.parents
+        result = []
+        while node != ROOT:
+            result.append(names[name_ids[node]])
+            node = parents[node]
+        result.reverse()
+        return result
+
+    def taxonString(self, node):
+        """The lineage of node as a taxonomy string"""
+        return '; '.join(self.lineage(node))
+
+    def ancestor(self, node, rank):
+        """The ancestor of node at a rank, 0 being the first
+
+        Returns node itself at its own rank. Raises ValueError if node is
+        above the rank.
+        """
+        depth = rank + 1
+        if self.depths[node] < depth:
+            raise ValueError, "Node %d is above rank %d" % (node, rank)
+        parents = self.parents
+        for i in range(self.depths[node] - depth):
+            node = parents[node]
+        return int(node)
+
+    def isAncestor(self, ancestor, node):
+        """True if node is ancestor or is under it"""
+        return ancestor <= node < self.ends[ancestor]
+
+    def lca(self, a, b):
+        """The lowest common ancestor of two nodes, ROOT if nothing shared"""
+        parents = self.parents
+        depths = self.depths
+        while depths[a] > depths[b]:
+            a = parents[a]
+        while depths[b] > depths[a]:
+            b = parents[b]
+        while a != b:
+            a = parents[a]
+            b = parents[b]
+        return int(a)
+
+    def idsUnder(self, node):
+        """The ids of node and of every node under it"""
+        nodes = self._sorted_nodes
+        start = searchsorted(nodes, node)
+        stop = searchsorted(nodes, self.ends[node])
+        return self.ids[self._by_node[start:stop]].tolist()
+
+def parse_taxonomy_lines(lines):
+    """Yields (id, taxonomy string) from id<tab>taxonomy lines"""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 2:
+            raise ValueError, "Expected an id and a taxonomy: %s" % line
+        yield fields[0], fields[1]
+
+def build_taxonomy_trie(lines):
+    """Returns a TaxonomyTrie of id<tab>taxonomy lines
+
+    Each distinct taxonomy string is split and inserted once, however many
+    ids have it. Raises ValueError if an id appears more than once.
+    """
+    ids = []
+    strings = []
+    string_idx = {}
+    for id_, tax_string in parse_taxonomy_lines(lines):
+        ids.append(id_)
+        idx = string_idx.get(tax_string)
+        if idx is None:
+            idx = string_idx[tax_string] = len(string_idx)
+        strings.append(idx)
+
+    # insert the lineages, nodes keyed by the names down to them
+    paths = {(): ROOT}
+    lineage_paths = [None] * len(string_idx)
+    for tax_string, idx in string_idx.iteritems():
+        path = tuple(tax_string.split('; '))
+        lineage_paths[idx] = path
+        for depth in range(1, len(path) + 1):
+            paths.setdefault(path[:depth], None)
+
+    # preorder is the order of the sorted paths, ancestors first
+    ordered = sorted(paths)
+    for node, path in enumerate(ordered):
+        paths[path] = node
+
+    names = sorted(set([path[-1] for path in ordered[1:]]))
+    name_lookup = dict([(name, i) for i, name in enumerate(names)])
+    name_ids = zeros(len(ordered), dtype=int32)
+    parents = zeros(len(ordered), dtype=int32)
+    for node, path in enumerate(ordered[1:]):
+        name_ids[node + 1] = name_lookup[path[-1]]
+        parents[node + 1] = paths[path[:-1]]
+
+    string_nodes = array([paths[p] for p in lineage_paths], dtype=int32)
+    id_nodes = string_nodes[array(strings, dtype=int64)]
+
+    width = max([len(i) for i in ids] or [1])
+    ids = array(ids, dtype='S%d' % width)
+    order = argsort(ids, kind='mergesort')
+    ids = ids[order]
+    id_nodes = id_nodes[order]
+    if len(ids) > 1:
+        dups = (ids[1:] == ids[:-1]).nonzero()[0]
+        if len(dups):
+            raise ValueError, "Duplicate id: %s" % ids[dups[0]]
+
+    return TaxonomyTrie(names, name_ids, parents, ids, id_nodes)
+
+def _cache_fp(fp, cache_dir):
+    """The path of the cached trie for fp"""
+    if cache_dir is None:
+        return fp + '.taxonomy.npz'
+    return os.path.join(cache_dir, os.path.basename(fp) + '.taxonomy.npz')
+
+def load_taxonomy_trie(fp, cache_dir=None, use_cache=True):
+    """Returns a TaxonomyTrie of the taxonomy map fp
+
+    The trie is cached as numpy arrays next to fp, or in cache_dir, and is
+    read from there on later loads as long as fp has the same size and
+    modification time. If the cache can't be written the trie is just
+    built each time.
+    """
+    stat = os.stat(fp)
+    source = array([stat.st_size, stat.st_mtime])
+    cache_fp = _cache_fp(fp, cache_dir)
+
+    if use_cache and os.path.exists(cache_fp):
+        try:
+            with closing(load(cache_fp)) as cached:
+                if (cached['source'] == source).all():
+                    return TaxonomyTrie(cached['names'], cached['name_ids'],
+                                        cached['parents'], cached['ids'],
+                                        cached['id_nodes'])
+        except Exception:
+            # a damaged cache is just rebuilt
+            pass
+
+    trie = build_taxonomy_trie(greengenes_open(fp))
+
+    if use_cache:
+        try:
+            # write then rename, so a partial cache is never read
+            fd, tmp_fp = mkstemp(suffix='.npz', 
+                                 dir=os.path.dirname(os.path.abspath(cache_fp)))
+            os.close(fd)
+            try:
+                savez(tmp_fp, source=source, 
+                      names=array(trie.names, dtype=str),
+                      name_ids=trie.name_ids, parents=trie.parents, 
+                      ids=trie.ids, id_nodes=trie.id_nodes)
+                os.rename(tmp_fp, cache_fp)
+            except (IOError, OSError):
+                os.remove(tmp_fp)
+                raise
+        except (IOError, OSError):
+            pass
+
+    return trie
+
+def find_polyphyletic(trie, include_empty=False):
+    """Names found under more than one parent at the same rank
+
+    Returns {(name, rank): {parent: (count, representative id)}} where
+    parent is the taxonomy string of a parent the name is under, None for
+    the first rank, count is the number of ids in that clade and the
+    representative is one of them. Ranks start at 0. Names without
+    anything after the prefix, such as "g__", are left out unless
+    include_empty. The work is linear in the number of nodes and ids.
+    """
+    n_nodes = trie.n_nodes
+    parents = trie.parents
+    depths = trie.depths
+    ends = trie.ends
+
+    # ids under each node, as a difference of running totals in preorder
+    direct = bincount(trie.id_nodes, minlength=n_nodes)
+    totals = zeros(n_nodes + 1, dtype=int64)
+    totals[1:] = direct.cumsum()
+    counts = totals[ends] - totals[:n_nodes]
+
+    # group the nodes by name and depth, a group of more than one node has
+    # the name under more than one parent
+    keys = trie.name_ids.astype(int64) * (depths.max() + 1) + depths
+    keys[ROOT] = -1
+    group_sizes = bincount(keys[1:])
+    poly = (group_sizes[keys[1:]] > 1).nonzero()[0] + 1
+
+    # the first id in node order under each node
+    firsts = searchsorted(trie._sorted_nodes, poly)
+    reps = trie.ids[trie._by_node[firsts]]
+
+    names = trie.names
+    parent_strings = {ROOT:None}
+    result = {}
+    for node, count, rep in zip(poly.tolist(), counts[poly].tolist(),
+                                reps.tolist()):
+        name = names[trie.name_ids[node]]
+        if not include_empty and not name.split('__', 1)[-1]:
+            continue
+        parent = int(parents[node])
+        if parent not in parent_strings:
+            parent_strings[parent] = trie.taxonString(parent)
+        parent_string = parent_strings[parent]
+        key = (name, int(depths[node]) - 1)
+        result.setdefault(key, {})[parent_string] = (count, rep)
+
+    return result
@@ -5,7 +5,17 @@ from gzip import open as gzopen
 from datetime import datetime
 from subprocess import Popen, PIPE
 from StringIO import StringIO
+from contextlib import contextmanager
+from threading import Thread, Timer
+from Queue import Queue, Empty
+from time import time, sleep
+from operator import itemgetter
+from itertools import izip
 from cogent.parse.fasta import MinimalFastaParser
+import resource
+import signal
+import re
+import json
 import os
 
 __author__ = "Daniel McDonald"
@@ -17,6 +27,12 @@ __maintainer__ = "Daniel McDonald"
 __email__ = "mcdonadt@colorado.edu"
 __status__ = "Development"
 
+# where greengenes caches things by default, per user and outside the install
+USER_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                  os.path.join(os.path.expanduser('~'), 
+                                               '.cache')),
+                              'greengenes')
+
 class NoSequenceError(Exception):
     pass
 
@@ -42,9 +58,109 @@ def make_tree_arb_safe(t):
         if len(n.Children) == 1:
             n.append(RangeNode(Name="X",Length=0.0))
 
+# the tip given to single child nodes by make_tree_arb_safe, shared as text
+# by write_arb_safe_newick instead of creating a node per use
+_arb_dummy_tip = {False:',X', True:',X:0.0'}
+_newick_quote_chars = re.compile("""[]['"(),:;_]""")
+
+def _newick_label(node, with_distances):
+    """The Newick name and length of a node as written by cogent"""
+    if not getattr(node, 'NameLoaded', True) or node.Name is None:
+        label = ''
+    else:
+        label = str(node.Name)
+        if not (label.startswith("'") and label.endswith("'")):
+            if _newick_quote_chars.search(label):
+                label = "'%s'" % label.replace("'", "''")
+            else:
+                label = label.replace(' ','_')
+
+    if with_distances and getattr(node, 'Length', None) is not None:
+        label = "%s:%s" % (label, node.Length)
+    return label
+
+def write_arb_safe_newick(tree, ids, out, with_distances=False,
+                          buffer_size=10000):
+    """Write the tree pruned to ids and made ARB safe as Newick to out
+
+    Writes what the Newick of make_tree_arb_safe(prune_tree(tree, ids))
+    would be, but in a single traversal of tree, without copying it or
+    creating the dummy tips. tree is not modified. Raises ValueError if ids
+    are not a subset of the tips, which is only known after out has been
+    written to.
+    """
+    ids = set(ids)
+    if not ids:
+        raise ValueError, "No ids to keep!"
+
+    dummy = _arb_dummy_tip[with_distances]
+    found = set([])
+    buf = []
+
+    # a frame is [node, next child index, opened, number of kept children].
+    # A node is only opened once a kept tip is found below it, so subtrees
+    # without kept tips are skipped without writing anything.
+    stack = [[tree, 0, False, 0]]
+    while stack:
+        frame = stack[-1]
+        node, child_idx = frame[0], frame[1]
+
+        if child_idx < len(node.Children):
+            frame[1] += 1
+            child = node.Children[child_idx]
+            if child.Children:
+                stack.append([child, 0, False, 0])
+            elif child.Name in ids:
+                # open any ancestors that don't have a kept tip yet
+                for i, ancestor in enumerate(stack):
+                    if ancestor[2]:
+                        continue
+                    if i:
+                        parent = stack[i - 1]
+                        if parent[3]:
+                            buf.append(',')
+                        parent[3] += 1
+                    buf.append('(')
+                    ancestor[2] = True
+
+                if frame[3]:
+                    buf.append(',')
+                frame[3] += 1
+                buf.append(_newick_label(child, with_distances))
+                found.add(child.Name)
+            continue
+
+        stack.pop()
+        if frame[2]:
+            if frame[3] == 1:
+                buf.append(dummy)
+            buf.append(')')
+            buf.append(_newick_label(node, with_distances))
+
+        if len(buf) > buffer_size:
+            out.write(''.join(buf))
+            buf = []
+
+    buf.append(';')
+    out.write(''.join(buf))
+
+    if found != ids:
+        raise ValueError, "ids are not a subset of the tree!"
+
+_log_time_format = '%H:%M:%S on %d %b %Y'
+_log_time_cache = [None, None]
+
+def _log_timestamp():
+    """Return the current log timestamp, formatting at most once a second"""
+    now = int(time())
+    if _log_time_cache[0] != now:
+        _log_time_cache[0] = now
+        _log_time_cache[1] = datetime.fromtimestamp(now).strftime(\
+                                                        _log_time_format)
+    return _log_time_cache[1]
+
 def log_f(line):
-    start_time = datetime.now().strftime('%H:%M:%S on %d %b %Y')
-    return "%s\t%s\n" % (start_time, line)
+    return "%s\t%s\n" % (_log_timestamp(), line)
 
 def greengenes_open(file_fp, permission='U'):
     """Read or write the contents of a file
@@ -75,13 +191,78 @@ def generate_log_fp(output_dir, basefile_name='log', suffix='txt',
     filename = '%s_%s.%s' % (basefile_name,timestamp,suffix)
     return os.path.join(output_dir,filename)
 
+def _resource_usage():
+    """Returns (cpu seconds, peak rss in KB) for this process"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+class WorkflowStage(object):
+    """Resource usage of a single named pipeline stage
+
+    peak_rss_kb is the process high water mark at the end of the stage, so it
+    is never less than that of an earlier stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.records = 0
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss_kb = None
+        self._start_wall = None
+        self._start_cpu = None
+
+    def increment(self, n=1):
+        """Count n records as processed by this stage"""
+        self.records += n
+
+    def start(self):
+        self._start_wall = time()
+        self._start_cpu = _resource_usage()[0]
+
+    def stop(self):
+        cpu, rss = _resource_usage()
+        self.wall_time = time() - self._start_wall
+        self.cpu_time = cpu - self._start_cpu
+        self.peak_rss_kb = rss
+
+    def toDict(self):
+        """Return the stage summary as a dict"""
+        return {'stage':self.name, 'records':self.records,
+                'wall_time':self.wall_time, 'cpu_time':self.cpu_time,
+                'peak_rss_kb':self.peak_rss_kb}
+
+    def __str__(self):
+        return "Stage %s: %d records, %.2fs wall, %.2fs cpu, %d KB peak RSS" % \
+                (self.name, self.records, self.wall_time, self.cpu_time,
+                 self.peak_rss_kb)
+
 class WorkflowLogger(object):
-    """Originally from the QIIME project under qiime.workflow"""
-    def __init__(self,log_fp=None,open_mode='w',script_name="Not specified"):
+    """Originally from the QIIME project under qiime.workflow
+
+    Writes are buffered and flushed at most every flush_interval seconds (a
+    flush_interval of 0 flushes on every write), and always at the start and
+    end of a stage so the current step is visible during long quiet stages.
+    Stages recorded with stage()
+    are written as JSON lines to summary_fp on close, which defaults to the
+    log path with a _stages.jsonl suffix.
+    """
+    def __init__(self,log_fp=None,open_mode='w',script_name="Not specified",
+                 flush_interval=5.0, summary_fp=None):
         if log_fp:
             self._f = open(log_fp,open_mode)
         else:
             self._f = None 
+
+        if summary_fp is None and log_fp:
+            summary_fp = os.path.splitext(log_fp)[0] + '_stages.jsonl'
+        self._summary_fp = summary_fp
+
+        self._buffer = []
+        self._flush_interval = flush_interval
+        self._last_flush = time()
+        self._stages = []
+        self._closed = False
+
         start_time = datetime.now().strftime('%H:%M:%S on %d %b %Y')
         self.write('Logging started at %s\n' % start_time)
         self.write('Script: %s\n' % script_name)
@@ -89,23 +270,65 @@ class WorkflowLogger(object):
 
     def write(self,s):
         if self._f:
-            self._f.write(s)
-            # Flush here so users can see what step they're
-            # on after each write, since some steps can take
-            # a long time, and a relatively small amount of 
-            # data is being written to the log files.
-            self._f.flush()
+            self._buffer.append(s)
+            # Flush periodically so users can see what step they're
+            # on, since some steps can take a long time, without paying
+            # for a flush on every line of a chatty step.
+            if time() - self._last_flush >= self._flush_interval:
+                self.flush()
         else:
             pass 
-    
+
+    def flush(self):
+        """Write out any buffered lines"""
+        if self._f and self._buffer:
+            self._f.write(''.join(self._buffer))
+            self._f.flush()
+            self._buffer = []
+        self._last_flush = time()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a pipeline stage
+
+        Yields a WorkflowStage, call increment() on it to count records
+        """
+        stage = WorkflowStage(name)
+        self.write(log_f("Starting stage %s" % name))
+        self.flush()
+        stage.start()
+        try:
+            yield stage
+        finally:
+            stage.stop()
+            self._stages.append(stage)
+            self.write(log_f(str(stage)))
+            self.flush()
+
+    def getStages(self):
+        """Return the WorkflowStages recorded so far"""
+        return list(self._stages)
+
     def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
         end_time = datetime.now().strftime('%H:%M:%S on %d %b %Y')
         self.write('\nLogging stopped at %s\n' % end_time)
         if self._f:
+            self.flush()
             self._f.close()
         else:
             pass
 
+        if self._summary_fp and self._stages:
+            summary = open(self._summary_fp, 'w')
+            for stage in self._stages:
+                summary.write(json.dumps(stage.toDict(), sort_keys=True))
+                summary.write('\n')
+            summary.close()
+
     def __del__(self):
         """Destructor"""
         self.close()
@@ -138,6 +361,191 @@ def greengenes_system_call(cmd):
     return_value = proc.returncode
     return stdout, stderr, return_value
 
+class CommandResult(tuple):
+    """The (stdout, stderr, return_value) of a command plus resource usage
+
+    Unpacks like the result of greengenes_system_call. stdout is None if it
+    was streamed to a consumer. cpu_time and max_rss_kb are those of the
+    shell and the children it waited on.
+    """
+    def __new__(cls, stdout, stderr, return_value, cmd=None, wall_time=None,
+                cpu_time=None, max_rss_kb=None, timed_out=False):
+        res = super(CommandResult, cls).__new__(cls, (stdout, stderr,
+                                                      return_value))
+        res.cmd = cmd
+        res.wall_time = wall_time
+        res.cpu_time = cpu_time
+        res.max_rss_kb = max_rss_kb
+        res.timed_out = timed_out
+        return res
+
+    stdout = property(lambda self: self[0])
+    stderr = property(lambda self: self[1])
+    return_value = property(lambda self: self[2])
+
+def _drain(open_file, chunks):
+    """Read all of open_file into chunks"""
+    chunks.append(open_file.read())
+
+def _kill_group(proc, flag):
+    """Kill proc and anything it spawned, noting the kill in flag"""
+    flag.append(True)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass # already gone
+
+def greengenes_streaming_call(cmd, consumer=None, timeout=None):
+    """Call cmd, passing each line of stdout to consumer
+
+    Like greengenes_system_call, but stdout is handed to consumer a line at
+    a time instead of being held in memory (if consumer is None, stdout is
+    collected and returned as usual). The command and anything it spawns
+    are killed if it runs longer than timeout seconds. Returns a
+    CommandResult.
+    """
+    start = time()
+    # own process group so a timeout can take out the shell's children too
+    proc = Popen(cmd,shell=True,universal_newlines=True,\
+                 stdout=PIPE,stderr=PIPE,preexec_fn=os.setsid)
+
+    # stderr is drained on the side so a chatty tool can't block on it
+    stderr_chunks = []
+    stderr_reader = Thread(target=_drain, args=(proc.stderr, stderr_chunks))
+    stderr_reader.daemon = True
+    stderr_reader.start()
+
+    killed = []
+    timer = None
+    if timeout is not None:
+        deadline = start + timeout
+        timer = Timer(timeout, _kill_group, (proc, killed))
+        timer.daemon = True
+        timer.start()
+
+    reaped = False
+    try:
+        if consumer is None:
+            stdout = proc.stdout.read()
+        else:
+            stdout = None
+            for line in iter(proc.stdout.readline, ''):
+                consumer(line)
+
+        # the timer is done with before the reap, so it can never kill a
+        # process group whose pid has been handed out again
+        if timer is not None:
+            timer.cancel()
+            timer.join()
+
+            # stdout can be closed before the command exits
+            while not killed:
+                pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+                if pid:
+                    reaped = True
+                    break
+                if time() >= deadline:
+                    _kill_group(proc, killed)
+                else:
+                    sleep(0.01)
+
+        # reap ourselves to get at the resource usage of the child
+        if not reaped:
+            pid, status, usage = os.wait4(proc.pid, 0)
+            reaped = True
+    finally:
+        if timer is not None:
+            timer.cancel()
+            timer.join()
+        if not reaped:
+            # the consumer raised, don't leave the command running
+            _kill_group(proc, killed)
+            os.wait4(proc.pid, 0)
+        stderr_reader.join()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    # a command that finished on its own just before the kill didn't time out
+    timed_out = bool(killed) and os.WIFSIGNALED(status) and \
+            os.WTERMSIG(status) == signal.SIGKILL
+
+    return CommandResult(stdout, ''.join(stderr_chunks), proc.returncode,
+                         cmd=cmd, wall_time=time() - start,
+                         cpu_time=usage.ru_utime + usage.ru_stime,
+                         max_rss_kb=usage.ru_maxrss,
+                         timed_out=timed_out)
+
+def greengenes_pooled_calls(cmds, n_workers=4, timeout=None, callback=None):
+    """Run cmds across at most n_workers concurrent processes
+
+    cmds can be any iterable and is consumed as workers free up. timeout
+    applies to each command. callback, if given, is called with each
+    CommandResult as it completes. Returns the CommandResults in the order
+    of cmds.
+    """
+    if n_workers < 1:
+        raise ValueError, "n_workers must be at least 1"
+
+    # bounded so a generator of commands isn't read far ahead of the workers
+    todo = Queue(n_workers)
+    done = Queue()
+    results = {}
+
+    def worker():
+        while True:
+            item = todo.get()
+            if item is None:
+                break
+            idx, cmd = item
+            try:
+                done.put((idx, greengenes_streaming_call(cmd, timeout=timeout)))
+            except Exception, e:
+                done.put((idx, e))
+
+    workers = [Thread(target=worker) for i in range(n_workers)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    def collect(block):
+        while not done.empty() or block:
+            idx, res = done.get()
+            if isinstance(res, Exception):
+                raise res
+            results[idx] = res
+            if callback is not None:
+                callback(res)
+            block = False
+
+    n_cmds = 0
+    try:
+        for idx, cmd in enumerate(cmds):
+            todo.put((idx, cmd))
+            n_cmds += 1
+            collect(False)
+
+        while len(results) < n_cmds:
+            collect(True)
+    finally:
+        # on an error nothing more is started, and what is running finishes
+        # before the caller sees it
+        while True:
+            try:
+                todo.get_nowait()
+            except Empty:
+                break
+        for w in workers:
+            todo.put(None)
+        for w in workers:
+            w.join()
+
+    return [results[i] for i in range(n_cmds)]
+
 class GreengenesRecord(dict):
     """Represent a full Greengenes record"""
 
@@ -245,9 +653,12 @@ class GreengenesRecord(dict):
                                    '\tWRITE "%s"'])
 
     def __init__(self, *args, **kwargs):
-        for k in self._field:
-            self[k] = None
-        super(GreengenesRecord, self).__init__(*args, **kwargs)
+        # start from a copy of the all None record, much cheaper than
+        # setting each field
+        super(GreengenesRecord, self).__init__(self._empty)
+        self.update(*args, **kwargs)
+
+    _empty = dict.fromkeys(_field)
 
     def getARBRules(self):
         """Get the ARB rules"""
@@ -290,3 +701,114 @@ class GreengenesRecord(dict):
                 raise ValueError, "Field %s in prok %s has a bad type" % \
                                         (k, str(self['prokmsa_id']))
     
+
+def _is_missing(value):
+    return value is None or value == ''
+
+def _coerce_column(field, values, check_required):
+    """Coerce a single column, returns (typed, [(row, field, value, reason)])"""
+    spec = GreengenesRecord._field[field]
+    type_ = spec['type']
+    errors = []
+
+    if check_required and spec['required']:
+        if None in values or '' in values:
+            errors.extend([(i, field, v, "missing required value") \
+                           for i,v in enumerate(values) if _is_missing(v)])
+
+    if type_ is str:
+        # values parsed from text are already str, only touch the odd ones
+        if '' not in values and \
+                set(map(type, values)).issubset(set([str, type(None)])):
+            return values, errors
+        return [None if _is_missing(v) else v if isinstance(v, str) \
+                else str(v) for v in values], errors
+
+    if values.count(None) == len(values):
+        # nothing to do, a common case for the columns not yet filled in
+        return values, errors
+
+    if None not in values and '' not in values:
+        try:
+            return map(type_, values), errors
+        except (TypeError, ValueError):
+            pass
+    else:
+        present = [i for i,v in enumerate(values) if not _is_missing(v)]
+        try:
+            coerced = map(type_, [values[i] for i in present])
+        except (TypeError, ValueError):
+            pass
+        else:
+            typed = [None] * len(values)
+            for i,v in izip(present, coerced):
+                typed[i] = v
+            return typed, errors
+
+    # something is bad, go value by value to find all of it
+    typed = []
+    for i,v in enumerate(values):
+        if _is_missing(v):
+            typed.append(None)
+            continue
+        try:
+            typed.append(type_(v))
+        except (TypeError, ValueError):
+            errors.append((i, field, v, "not a valid %s" % type_.__name__))
+            typed.append(v)
+    return typed, errors
+
+def coerce_columns(columns, check_required=False):
+    """Coerce columns of GreengenesRecord fields to their types in bulk
+
+    columns : {field: [values]}, each column covering the same rows
+
+    Each column is coerced with a single map of its type, only falling back
+    to checking value by value if that fails. Missing values, None or '',
+    become None whatever the type of the field, so an empty field reads the
+    same wherever it is in a row. Columns that are not GreengenesRecord
+    fields are returned as is. If check_required, missing values in
+    required fields are reported.
+
+    Returns ({field: [typed values]}, [(row, field, value, reason)]) where
+    bad values are left untouched in the typed columns.
+    """
+    typed = {}
+    errors = []
+    for field, values in columns.items():
+        if field not in GreengenesRecord._field:
+            typed[field] = values
+            continue
+
+        if not isinstance(values, list):
+            values = list(values)
+        typed[field], field_errors = _coerce_column(field, values,
+                                                    check_required)
+        errors.extend(field_errors)
+
+    errors.sort()
+    return typed, errors
+
+def validate_records(records, check_required=False):
+    """Coerce and validate a block of GreengenesRecords in place
+
+    Works column by column, see coerce_columns. Returns the list of
+    (row, field, value, reason) for every bad value in the block, bad values
+    are left as they were.
+    """
+    columns = {}
+    for field in GreengenesRecord._field:
+        try:
+            columns[field] = map(itemgetter(field), records)
+        except KeyError:
+            columns[field] = [r.get(field) for r in records]
+
+    typed, errors = coerce_columns(columns, check_required)
+
+    for field, values in typed.items():
+        if values is columns[field]:
+            continue
+        for record, value in izip(records, values):
+            record[field] = value
+
+    return errors
@@ -2,7 +2,9 @@
 
 from t2t.nlevel import make_consensus_tree, load_consensus_map, \
         set_rank_order
-from operator import add 
+from greengenes.util import greengenes_open
+from multiprocessing import Pool
+import os
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2013, Greengenes"
@@ -16,20 +18,94 @@ __status__ = "Development"
 class ParseError(Exception):
     pass
 
-def cache_tipnames(t):
-    """cache tipnames on the internal nodes"""
+# the error classes of check_line, in the order they are reported
+PARSE_ERROR = 'parse'
+PREFIX_ERROR = 'prefixes'
+N_LEVELS_ERROR = 'n_levels'
+GAP_ERROR = 'gap'
+ERROR_CLASSES = [PARSE_ERROR, PREFIX_ERROR, N_LEVELS_ERROR, GAP_ERROR]
+
+# exit statuses of a TaxonomyReport
+EXIT_OK = 0
+EXIT_FAILED_CHECKS = 1
+EXIT_PARSE_ERROR = 2
+
+def index_tips(t):
+    """Number the tips of t in postorder
+
+    Returns the tip names in that order. Every node gets TipStart and
+    TipStop so the names of the tips below it are
+    tip_names[n.TipStart:n.TipStop], and its first tip is
+    tip_names[n.TipStart].
+    """
+    tip_names = []
     for n in t.postorder(include_self=True):
         if n.istip():
-            n.TipNames = [n.Name]
+            n.TipStart = len(tip_names)
+            tip_names.append(n.Name)
+            n.TipStop = len(tip_names)
         else:
-            n.TipNames = reduce(add, [c.TipNames for c in n.Children])
+            n.TipStart = n.Children[0].TipStart
+            n.TipStop = n.Children[-1].TipStop
+    return tip_names
+
+class TipNames(object):
+    """The names of the tips under a node, a view into index_tips' list
+
+    Behaves as a read-only list without copying any names.
+    """
+    __slots__ = ['_names', '_start', '_stop']
+
+    def __init__(self, tip_names, start, stop):
+        self._names = tip_names
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __iter__(self):
+        names = self._names
+        for i in xrange(self._start, self._stop):
+            yield names[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(self)[idx]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError, "TipNames index out of range"
+        return self._names[self._start + idx]
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+def cache_tipnames(t):
+    """cache tipnames on the internal nodes
+
+    TipNames on each node is a TipNames view over the tips listed by
+    index_tips, so caching is linear in the size of the tree.
+    """
+    tip_names = index_tips(t)
+    for n in t.postorder(include_self=True):
+        n.TipNames = TipNames(tip_names, n.TipStart, n.TipStop)
 
 ### BAD NAME, these aren't polyphyletic, but mistakes in taxonomy
 def get_polyphyletic(cons):
     """get polyphyletic groups and a representative tip"""
     tips, taxonstrings = zip(*cons.items()) # unzip
     tree, lookup = make_consensus_tree(taxonstrings, False, tips=tips)
-    cache_tipnames(tree)
+    tip_names = index_tips(tree)
 
     count = 0 
     names = {}
@@ -39,7 +115,8 @@ def get_polyphyletic(cons):
         if (n.Name, n.Rank) not in names:
             names[(n.Name, n.Rank)] = {}
         if n.Parent is not None:
-            names[(n.Name, n.Rank)][n.Parent.Name] = n.TipNames[0] # get a rep
+            # get a rep
+            names[(n.Name, n.Rank)][n.Parent.Name] = tip_names[n.TipStart]
     
     return names
 
@@ -87,32 +164,177 @@ def check_prefixes(parsed, expected_prefixes):
 
     return True
 
+def check_line(line, n_levels, prefixes):
+    """Returns the error classes of a line, empty if it is good
+
+    A line that doesn't parse is only a PARSE_ERROR, otherwise it is run
+    through check_prefixes, check_n_levels and check_gap.
+    """
+    try:
+        id_, parsed = check_parse(line)
+    except ParseError:
+        return [PARSE_ERROR]
+
+    errors = []
+    try:
+        if not check_prefixes(parsed, prefixes):
+            errors.append(PREFIX_ERROR)
+    except ValueError:
+        # a name without a prefix
+        errors.append(PREFIX_ERROR)
+    if not check_n_levels(parsed, n_levels):
+        errors.append(N_LEVELS_ERROR)
+    if not check_gap(parsed):
+        errors.append(GAP_ERROR)
+    return errors
+
+class TaxonomyReport(object):
+    """Error counts and the first offending lines of a taxonomy file
+
+    counts is {error class: number of lines} and examples is 
+    {error class: [(line number, line)]} holding at most max_examples of
+    the first lines with that error. Line numbers start at 1.
+    """
+    def __init__(self, max_examples=10):
+        self.max_examples = max_examples
+        self.n_lines = 0
+        self.counts = dict([(e, 0) for e in ERROR_CLASSES])
+        self.examples = dict([(e, []) for e in ERROR_CLASSES])
+
+    def add(self, line, errors):
+        """Count the next line and its errors"""
+        self.n_lines += 1
+        for error in errors:
+            self.counts[error] += 1
+            if len(self.examples[error]) < self.max_examples:
+                self.examples[error].append((self.n_lines, line.rstrip()))
+
+    def update(self, other):
+        """Add the report of the lines following these ones"""
+        offset = self.n_lines
+        for error in ERROR_CLASSES:
+            self.counts[error] += other.counts[error]
+            room = self.max_examples - len(self.examples[error])
+            self.examples[error].extend([(n + offset, l) for n, l in \
+                                         other.examples[error][:room]])
+        self.n_lines += other.n_lines
+
+    def exitStatus(self):
+        """EXIT_OK, EXIT_FAILED_CHECKS or, if any line didn't parse,
+        EXIT_PARSE_ERROR"""
+        if self.counts[PARSE_ERROR]:
+            return EXIT_PARSE_ERROR
+        if sum(self.counts.values()):
+            return EXIT_FAILED_CHECKS
+        return EXIT_OK
+
+    def toLines(self):
+        """Returns the report as tab delimited lines"""
+        lines = ["#lines\t%d\n" % self.n_lines,
+                 "#status\t%d\n" % self.exitStatus(),
+                 "#error\tcount\n"]
+        lines.extend(["%s\t%d\n" % (e, self.counts[e]) \
+                      for e in ERROR_CLASSES])
+        lines.append("#error\tline number\tline\n")
+        for error in ERROR_CLASSES:
+            lines.extend(["%s\t%d\t%s\n" % (error, n, l) \
+                          for n, l in self.examples[error]])
+        return lines
+
+def verify_taxonomy_lines(lines, n_levels, prefixes, max_examples=10):
+    """Check every line, returns a TaxonomyReport"""
+    report = TaxonomyReport(max_examples)
+    for line in lines:
+        report.add(line, check_line(line, n_levels, prefixes))
+    return report
+
+def split_lines_file(file_fp, n_chunks):
+    """Split a file into about n_chunks byte ranges of whole lines
+
+    Returns [(start, end)], end is None for the last range. Compressed 
+    files can't be split and come back as [(0, None)].
+    """
+    if file_fp.endswith('gz') or n_chunks < 2:
+        return [(0, None)]
+
+    size = os.path.getsize(file_fp)
+    f = open(file_fp, 'rb')
+    starts = [0]
+    for i in range(1, n_chunks):
+        f.seek(max(size * i / n_chunks, starts[-1]))
+        f.readline() # partial, finish it off
+        pos = f.tell()
+        if pos >= size:
+            break
+        if pos > starts[-1]:
+            starts.append(pos)
+    f.close()
+
+    return zip(starts, starts[1:] + [None])
+
+def _range_lines(file_fp, start, end):
+    """Yields the lines of file_fp from byte offset start up to end"""
+    if not start and end is None:
+        # the whole file, which may be compressed
+        for line in greengenes_open(file_fp):
+            yield line
+        return
+
+    f = open(file_fp, 'rb')
+    f.seek(start)
+    offset = start
+    while end is None or offset < end:
+        line = f.readline()
+        if not line:
+            break
+        offset += len(line)
+        yield line
+    f.close()
+
+def _verify_range(args):
+    """Pool worker, returns the TaxonomyReport of a byte range"""
+    file_fp, (start, end), n_levels, prefixes, max_examples = args
+    lines = _range_lines(file_fp, start, end)
+    return verify_taxonomy_lines(lines, n_levels, prefixes, max_examples)
+
+def verify_taxonomy_file(file_fp, n_levels, prefixes, n_workers=1,
+                         max_examples=10):
+    """Check every line of a taxonomy file, returns a TaxonomyReport
+
+    The file is split into byte ranges of whole lines that are checked in
+    n_workers processes, and the reports of the ranges are put back 
+    together in order, so the result is the same as checking the file in
+    one go. Compressed files are checked in a single process.
+    """
+    if n_workers < 2:
+        return verify_taxonomy_lines(greengenes_open(file_fp), n_levels,
+                                     prefixes, max_examples)
+
+    ranges = split_lines_file(file_fp, n_workers * 4)
+    jobs = [(file_fp, r, n_levels, prefixes, max_examples) for r in ranges]
+    pool = Pool(n_workers)
+    reports = pool.map(_verify_range, jobs)
+    pool.close()
+    pool.join()
+
+    report = TaxonomyReport(max_examples)
+    for r in reports:
+        report.update(r)
+    return report
+
 if __name__ == '__main__':
-    from sys import argv, exit, stderr
+    from sys import argv, exit, stdout
   
     nlevels = int(argv[2])
     prefixes = argv[3].split(',')
+    if len(argv) > 4:
+        n_workers = int(argv[4])
+    else:
+        n_workers = 1
 
-    counter = 1
-    for l in open(argv[1]):
-        try:
-            id_, parsed = check_parse(l)
-        except ParseError, e:
-            stderr.write("Error on line: %d\n" % counter)
-            raise e
-            exit(1)
-
-        if not check_prefixes(parsed, prefixes):
-            print "Line %d appears to have incorrect prefixes" % counter
-            stderr.write(l)
-        if not check_n_levels(parsed, nlevels):
-            print "Line %d appears to have the wrong number of levels" %counter
-            stderr.write(l)
-        if not check_gap(parsed):
-            print "Line %d appears to have a gap in the taxonomy" % counter
-            stderr.write(l)
-        
-        counter += 1
+    report = verify_taxonomy_file(argv[1], nlevels, prefixes, n_workers)
+    stdout.write(''.join(report.toLines()))
+    exit(report.exitStatus())
 
     ### for the pretty_make_taxonomy check
     #conmap_f = argv[1]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+from cogent.util.misc import parse_command_line_parameters
+from cogent.parse.genbank import MinimalGenbankParser
+from optparse import make_option
+from greengenes.flat_files import get_genbank_summary, parse_funs
+from greengenes.genbank import parse_genbank_fields
+from greengenes.util import greengenes_open as open, GreengenesRecord
+from StringIO import StringIO
+from time import time
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+script_info={}
+script_info['brief_description']="""Benchmark the GenBank parsing behind flat_files.py"""
+script_info['script_description']="""Times getting from GenBank text to Greengenes records, with cogent's MinimalGenbankParser and with the streaming field extractor in greengenes.genbank. The input records are repeated --scale times in memory so disk speed does not factor in. Then, on already parsed records, times get_genbank_summary against calling each of parse_funs on its own, and breaks the time down by field."""
+script_info['script_usage']=[("","Benchmark on the test data scaled 50 times","%prog -i tests/test_data/AGIY01000001.1.gb,tests/test_data/FO117587.1.gb -s 50")]
+script_info['required_options'] = [\
+        make_option('-i','--input-gbs',type='str',
+            help="Files containing Genbank records")]
+script_info['optional_options'] = [\
+        make_option('-s','--scale',type='int', default=10,
+            help='Number of times to repeat the input records [default: %default]'),
+        make_option('-r','--repeats',type='int', default=3,
+            help='Number of timed runs per parser, the best is reported [default: %default]')]
+script_info['version'] = __version__
+
+def time_parser(parser, text, repeats):
+    """Returns (best seconds, number of records) to summarize all of text"""
+    best = None
+    for i in range(repeats):
+        start = time()
+        count = 0
+        for rec in parser(StringIO(text)):
+            try:
+                get_genbank_summary(rec)
+            except KeyError:
+                pass
+            count += 1
+        elapsed = time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, count
+
+def summary_by_field(r):
+    """get_genbank_summary as one call per field of parse_funs"""
+    rec = GreengenesRecord()
+    for f, m in parse_funs:
+        rec[f] = m(r)
+    return rec
+
+def time_summary(summarize, records, repeats):
+    """Returns the best seconds to summarize all records"""
+    best = None
+    for i in range(repeats):
+        start = time()
+        for rec in records:
+            try:
+                summarize(rec)
+            except KeyError:
+                pass
+        elapsed = time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def profile_fields(records):
+    """Returns [(seconds, field)] spent in each of parse_funs, slowest first
+    
+    Records failing on a field are skipped for that field.
+    """
+    profile = []
+    for field, f in parse_funs:
+        start = time()
+        for rec in records:
+            try:
+                f(rec)
+            except KeyError:
+                pass
+        profile.append((time() - start, field))
+    return sorted(profile, reverse=True)
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    text = ''.join([open(fp).read() for fp in opts.input_gbs.split(',')])
+    text = text * opts.scale
+    megabytes = len(text) / float(1024 ** 2)
+
+    print "%.1f MB of GenBank records" % megabytes
+    for name, parser in [('MinimalGenbankParser', MinimalGenbankParser),
+                         ('parse_genbank_fields', parse_genbank_fields)]:
+        elapsed, count = time_parser(parser, text, opts.repeats)
+        print "%s: %d records in %.2fs, %.1f records/s, %.1f MB/s" % \
+                (name, count, elapsed, count / elapsed, megabytes / elapsed)
+
+    records = list(parse_genbank_fields(StringIO(text)))
+    for rec in records:
+        rec.pop('sequence', None)
+
+    print
+    print "Summaries of %d parsed records" % len(records)
+    for name, summarize in [('by field', summary_by_field),
+                            ('get_genbank_summary', get_genbank_summary)]:
+        elapsed = time_summary(summarize, records, opts.repeats)
+        print "%s: %.1fms, %.1f records/s" % (name, 1000 * elapsed,
+                                              len(records) / elapsed)
+
+    print
+    print "Time by field"
+    profile = profile_fields(records)
+    total = sum([t for t, field in profile])
+    for elapsed, field in profile:
+        print "%s\t%.3fms\t%.1f%%" % (field, 1000 * elapsed,
+                                       100 * elapsed / total)
+
+if __name__ == '__main__':
+    main()
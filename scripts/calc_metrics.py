@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+from cogent.util.misc import parse_command_line_parameters
+from cogent.parse.fasta import MinimalFastaParser
+from optparse import make_option
+from greengenes.metrics import init_metrics_worker, calc_metrics_block
+from greengenes.parse import parse_invariants
+from greengenes.util import greengenes_open as open, WorkflowLogger, log_f
+from collections import deque
+from multiprocessing import Pool
+from sys import stdout, argv
+from time import time
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+script_info={}
+script_info['brief_description']="""Compute the QC metrics of aligned sequences"""
+script_info['script_description']="""This script computes the percent identity to the invariant core and the non-ACGT fraction of every sequence in an aligned fasta, the metrics consumed by filter_met_chi.py. Sequences are read and scored in blocks, spread over --workers processes, and the id, inv and nonacgt table is written in input order. At most two blocks per worker are held at a time. Sequences that are all gaps have a nonacgt of nan. filter_met_chi.py only checks inv against 0.9, so --invariant-cutoff 0.9 gives it the same answers for less work."""
+script_info['script_usage']=[("","Score an alignment with 4 processes","%prog -i aligned.fasta.gz -o metrics.txt --invariants data/invariant/domain_invariant.masks --workers 4")]
+script_info['required_options'] = [\
+        make_option('-i','--input-fasta',type='str',
+            help="Aligned sequences"),
+        make_option('-o','--output-fp',type='str',
+            help="Output metrics table"),
+        make_option('--invariants',type='str',
+            help="Path to the invariant maps")]
+script_info['optional_options'] = [\
+        make_option('--workers',type='int', default=1,
+            help='Number of processes [default: %default]'),
+        make_option('--block-size',type='int', default=1000,
+            help='Sequences per block [default: %default]'),
+        make_option('--log-fp',type='str', default=None,
+            help='Log file [default: no log]'),
+        make_option('--report-interval',type='float', default=60.0,
+            help='Seconds between progress reports [default: %default]'),
+        make_option('--invariant-cutoff',type='float', default=None,
+            help='Only find out whether the invariant score is at least this, scanning each invariant only until that is settled. inv is then a bound on the score on the same side of the cutoff, so filtering at this cutoff is unchanged [default: full scores]')]
+script_info['version'] = __version__
+
+def fasta_blocks(lines, block_size):
+    """Yields lists of at most block_size (id, seq)"""
+    block = []
+    for id_, seq in MinimalFastaParser(lines):
+        block.append((id_, seq))
+        if len(block) == block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+def ordered_results(pool, blocks, max_pending):
+    """Yields the results of blocks in order, at most max_pending in flight"""
+    pending = deque()
+    for block in blocks:
+        pending.append(pool.apply_async(calc_metrics_block, (block,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    verbose = opts.verbose
+    n_workers = opts.workers
+    if n_workers < 1:
+        option_parser.error("--workers must be at least 1")
+    if opts.block_size < 1:
+        option_parser.error("--block-size must be at least 1")
+
+    logger = WorkflowLogger(opts.log_fp, script_name=argv[0])
+    invariants = parse_invariants(open(opts.invariants))
+    blocks = fasta_blocks(open(opts.input_fasta), opts.block_size)
+
+    if n_workers > 1:
+        pool = Pool(n_workers, init_metrics_worker, 
+                    (invariants, opts.invariant_cutoff))
+        results = ordered_results(pool, blocks, 2 * n_workers)
+    else:
+        init_metrics_worker(invariants, opts.invariant_cutoff)
+        results = (calc_metrics_block(block) for block in blocks)
+
+    def report(stage):
+        elapsed = time() - start
+        logline = log_f("Scored %d sequences, %.1f per second" % \
+                        (stage.records, stage.records / max(elapsed, 1e-6)))
+        logger.write(logline)
+        if verbose:
+            stdout.write(logline)
+
+    output = open(opts.output_fp, 'w')
+    output.write("#id\tinv\tnonacgt\n")
+    with logger.stage(opts.input_fasta) as stage:
+        start = time()
+        last_report = start
+        for result in results:
+            output.write(''.join(["%s\t%r\t%r\n" % r for r in result]))
+            stage.increment(len(result))
+
+            if time() - last_report >= opts.report_interval:
+                report(stage)
+                last_report = time()
+        report(stage)
+    output.close()
+
+    if n_workers > 1:
+        pool.close()
+        pool.join()
+    logger.close()
+
+if __name__ == '__main__':
+    main()
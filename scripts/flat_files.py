@@ -1,17 +1,21 @@
 #!/usr/bin/env python
 
-from cogent.parse.genbank import MinimalGenbankParser, PartialRecordError
 from cogent.util.misc import parse_command_line_parameters
 from optparse import make_option
-from greengenes.flat_files import get_sequence, get_genbank_summary, \
-        get_accession
+from greengenes.flat_files import genbank_record_outcomes, \
+        init_shard_worker, summarize_genbank_shard, load_shard_outcomes
+from greengenes.genbank import parse_genbank_fields, split_genbank_file, \
+        GenbankRange
 from greengenes.write import write_sequence, write_gg_record, \
         write_obs_record
-from greengenes.parse import parse_column
-from greengenes.util import greengenes_open as open, NoSequenceError, \
+from greengenes.accessions import load_accession_store
+from greengenes.util import greengenes_open as open, \
         WorkflowLogger, generate_log_fp, log_f
 from sys import stdout, stderr, argv
 from os import makedirs
+from multiprocessing import Pool
+from glob import glob
+import json
 import os
 
 __author__ = "Daniel McDonald"
@@ -25,8 +29,9 @@ __status__ = "Development"
 
 script_info={}
 script_info['brief_description']="""Convert possible new Greengenes records to easily consumable files"""
-script_info['script_description']="""This script consumes Genbank records and dumps out summary information in a tab-delimited format and sequences with accessions for IDs for all parsable records. Failures are recorded. Records are checked by Genbank accession to determine if they've already been indexed by Greengenes."""
-script_info['script_usage']=[]
+script_info['script_description']="""This script consumes Genbank records and dumps out summary information in a tab-delimited format and sequences with accessions for IDs for all parsable records. Failures are recorded. Records are checked by Genbank accession to determine if they've already been indexed by Greengenes. With --checkpoint-interval, output is written in numbered segments (e.g. tag_sequences.0000.fasta.gz), a new one every checkpoint. Segments are gzip files and can be concatenated with cat."""
+script_info['script_usage']=[("","Parse two GenBank dumps with 8 processes","%prog -i gb1.txt,gb2.txt -o out -t new -e existing.txt --workers 8"),
+    ("","Checkpoint every 100000 records, and pick up a run that died","%prog -i gb1.txt,gb2.txt -o out -t new -e existing.txt --checkpoint-interval 100000; %prog -i gb1.txt,gb2.txt -o out -t new -e existing.txt --resume")]
 script_info['required_options'] = [\
         make_option('-i','--input-gbs',type='str',
             help="Files containing Genbank records"),
@@ -34,12 +39,101 @@ script_info['required_options'] = [\
             help="Output directory"),
         make_option('-t','--tag',type='str',help='Output filename prefix'),
         make_option('-e','--existing',type='str',
-            help="File containing previously observed accessions in the first column")]
+            help="File containing previously observed accessions in the first column. A sorted copy is cached under ~/.cache/greengenes for later runs")]
 script_info['optional_options'] = [\
         make_option('--max-failures',type='int', default=10000,
-            help='Maximum parse errors per genbank file')]      
+            help='Maximum parse errors per genbank file'),
+        make_option('--workers',type='int', default=1,
+            help='Number of processes. With more than one, uncompressed files are split between LOCUS records and the pieces are summarized in parallel. Output is the same as with one [default: %default]'),
+        make_option('--checkpoint-interval',type='int', default=0,
+            help='Records between checkpoints, 0 to not checkpoint. With workers, checkpoints wait for the end of a piece of a file [default: %default]'),
+        make_option('--resume',action='store_true', default=False,
+            help='Continue a checkpointed run in --output-dir from its last checkpoint [default: %default]'),
+        make_option('--extract-rrna',action='store_true', default=False,
+            help='For records with 16S or 18S rRNA features, write the longest of those genes instead of the whole sequence, with its GenBank location after the accession in the fasta. Only the genes are kept from the sequences of records over 100kb [default: %default]')]
 script_info['version'] = __version__
 
+def _consume_shard(shard_fp):
+    """Yields a shard's outcomes and then removes the shard"""
+    for outcome in load_shard_outcomes(shard_fp):
+        yield outcome
+    os.remove(shard_fp)
+
+def _output_fps(output_dir, tag, segment=None):
+    """The sequence, gg record, obs record and seen accession paths"""
+    if segment is None:
+        suffix = ''
+    else:
+        suffix = '.%04d' % segment
+
+    fps = [os.path.join(output_dir, '%s_sequences%s.fasta.gz' % (tag, suffix)),
+           os.path.join(output_dir, '%s_ggrecords%s.txt.gz' % (tag, suffix)),
+           os.path.join(output_dir, '%s_obsrecords%s.txt.gz' % (tag, suffix))]
+    if segment is None:
+        fps.append(None)
+    else:
+        fps.append(os.path.join(output_dir, '.seen%s.txt' % suffix))
+    return fps
+
+class FlatFileOutput(object):
+    """The sequence, gg record and obs record outputs
+
+    If segment is not None, output goes to numbered segments, and the 
+    accessions written with sequences are also kept, so they can be marked
+    as seen when resuming.
+    """
+    def __init__(self, output_dir, tag, segment=None):
+        self.output_dir = output_dir
+        self.tag = tag
+        self.segment = segment
+        self._open()
+
+    def _open(self):
+        seq_fp, gg_fp, obs_fp, seen_fp = _output_fps(self.output_dir, 
+                                                     self.tag, self.segment)
+        self.sequences = open(seq_fp, 'w')
+        self.gg_records = open(gg_fp, 'w')
+        self.obs_records = open(obs_fp, 'w')
+        if seen_fp is None:
+            self.seen = None
+        else:
+            self.seen = open(seen_fp, 'w')
+
+    def write(self, accession, sequence, gg_record, location=None):
+        if location is None:
+            write_sequence(self.sequences, accession, sequence)
+        else:
+            write_sequence(self.sequences, "%s %s" % (accession, location),
+                           sequence)
+        write_gg_record(self.gg_records, gg_record)
+        write_obs_record(self.obs_records, accession)
+        if self.seen is not None:
+            self.seen.write("%s\n" % accession)
+
+    def write_obs(self, accession):
+        write_obs_record(self.obs_records, accession)
+
+    def close(self):
+        self.sequences.close()
+        self.gg_records.close()
+        self.obs_records.close()
+        if self.seen is not None:
+            self.seen.close()
+
+    def roll(self):
+        """Close the current segment and start the next"""
+        self.close()
+        self.segment += 1
+        self._open()
+
+def write_checkpoint(checkpoint_fp, state):
+    """Write the checkpoint state so it is either all there or not at all"""
+    tmp_fp = checkpoint_fp + '.tmp'
+    f = open(tmp_fp, 'w')
+    json.dump(state, f)
+    f.close()
+    os.rename(tmp_fp, checkpoint_fp)
+
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
 
@@ -49,119 +143,212 @@ def main():
     tag = opts.tag
     existing_fp = opts.existing
     max_failures = opts.max_failures
+    n_workers = opts.workers
+    checkpoint_interval = opts.checkpoint_interval
+
+    if n_workers < 1:
+        option_parser.error("--workers must be at least 1")
     
-    makedirs(output_dir)
+    if not (opts.resume and os.path.exists(output_dir)):
+        makedirs(output_dir)
     logger = WorkflowLogger(generate_log_fp(output_dir), script_name=argv[0])
 
-    observed_records = parse_column(open(existing_fp))
+    # accessions seen in this run are added as they're written
+    observed_records = load_accession_store(existing_fp)
 
-    sequences_fp = os.path.join(output_dir, '%s_sequences.fasta.gz' % tag)
-    gg_records_fp = os.path.join(output_dir, '%s_ggrecords.txt.gz' % tag)
-    obs_records_fp = os.path.join(output_dir, '%s_obsrecords.txt.gz' % tag)
-    
-    sequences = open(sequences_fp,'w')
-    gg_records = open(gg_records_fp, 'w')
-    obs_records = open(obs_records_fp, 'w')
-    
-    seen = set([])
-    for gb_fp in input_gbs:
-        logline = log_f("Start parsing of %s..." % gb_fp)
-        logger.write(logline)
+    # where the run is at: the next record to parse is at offset in
+    # input_gbs[file_index], and every segment before segment is complete
+    checkpoint_fp = os.path.join(output_dir, '.checkpoint.json')
+    state = {'input_gbs':input_gbs, 'file_index':0, 'offset':0,
+             'failure_count':0, 'segment':0, 
+             'checkpoint_interval':checkpoint_interval}
+
+    if opts.resume and os.path.exists(checkpoint_fp):
+        state = json.load(open(checkpoint_fp))
+        if state['input_gbs'] != input_gbs:
+            option_parser.error("--input-gbs are not those of the "
+                                "checkpointed run: %s" % \
+                                ','.join(state['input_gbs']))
+        if not checkpoint_interval:
+            checkpoint_interval = state['checkpoint_interval']
+
+        for segment in range(state['segment']):
+            seen_fp = _output_fps(output_dir, tag, segment)[-1]
+            observed_records.update([l.strip() for l in open(seen_fp)])
 
+        logline = log_f("Resuming from %s byte %d, segment %d" % \
+                        (input_gbs[state['file_index']] \
+                            if state['file_index'] < len(input_gbs) else '', 
+                         state['offset'], state['segment']))
+        logger.write(logline)
         if verbose:
             stdout.write(logline)
 
-        records = MinimalGenbankParser(open(gb_fp))
-        
-        failure_count = 0
-        alpha = set(['A','T','G','C',
-                     'a','t','g','c',
-                     'N','n',
-                     'R','Y','S','M',
-                     'r','y','s','m',
-                     'K','k','W','w',
-                     'V','v','H','h','B','b','D','d'])
-
-        while True and (failure_count < max_failures):
-            # gracefully handle parser errors to a limit
-            try:
-                next_record = records.next()
-            except PartialRecordError, e:
-                failure_count += 1
-                continue
-            except StopIteration:
+    if opts.resume:
+        # anything past the checkpoint is redone
+        for fp in glob(os.path.join(output_dir, '.shard_*.pkl')):
+            os.remove(fp)
+        segment = state['segment']
+        while checkpoint_interval:
+            fps = filter(os.path.exists, _output_fps(output_dir, tag, segment))
+            if not fps:
                 break
-            except Exception, e:
-                logline = log_f("Caught: %s, previous accession: %s" % (e, accession))
-                logger.write(logline)
-                if verbose:
-                    stdout.write(logline)
-                failure_count += 1
-
-            # accession is str including version
-            try:
-                accession = get_accession(next_record)
-            except:
-                failure_count += 1
-                continue
-            if accession in observed_records:
-                continue
-            if accession in seen:
-                continue
-                # accession added at the end of this while loop
-
-            # sequence is just a str of sequence
-            try:
-                sequence = get_sequence(next_record)
-            except NoSequenceError:
-                # this isn't a failure, so no point in continuing but record
-                # the accession so it isn't hit again
-                write_obs_record(obs_records, accession)
-                continue
-            except:
-                failure_count += 1
-                continue
-
-            # verify the sequence is DNA. NCBI silently corrupts records 
-            # every once and a while leading to crap in the sequence. 
-            # Thanks NCBI.
-            seq_chars = set(sequence)
-            if not seq_chars.issubset(alpha):
-                logline = log_f("Corrupt sequence, accession: %s" % (accession))
-                logger.write(logline)
-                if verbose:
-                    stdout.write(logline)
-                failure_count += 1
-                continue
-
-            # gg_record contains gb summary data  
-            try:
-                gg_record = get_genbank_summary(next_record)
-            except KeyError, e:
-                failure_count += 1
-                continue
-
-            seen.add(accession)
-            write_sequence(sequences, accession, sequence)
-            write_gg_record(gg_records, gg_record)
-            write_obs_record(obs_records, accession)
-            
-        if failure_count >= max_failures:
-            logline = log_f("MAX FAILURES OF %d REACHED IN %s" % (max_failures, \
-                                                                  gb_fp))
-            logger.write(logline)
-            stderr.write(logline)
+            map(os.remove, fps)
+            segment += 1
+
+    if checkpoint_interval:
+        # so a run that dies before its first checkpoint resumes as one
+        state['checkpoint_interval'] = checkpoint_interval
+        write_checkpoint(checkpoint_fp, state)
+        outputs = FlatFileOutput(output_dir, tag, state['segment'])
+    else:
+        outputs = FlatFileOutput(output_dir, tag)
+
+    def checkpoint(file_index, offset, failure_count):
+        """Finish the current segment and record where the run is at"""
+        outputs.roll()
+        state.update({'file_index':file_index, 'offset':offset,
+                      'failure_count':failure_count,
+                      'segment':outputs.segment,
+                      'checkpoint_interval':checkpoint_interval})
+        write_checkpoint(checkpoint_fp, state)
+
+    first_file = state['file_index']
+    if n_workers > 1:
+        # shards come back in input order, each as a file of outcomes
+        shards = []
+        file_shards = []
+        for gb_idx in range(first_file, len(input_gbs)):
+            gb_fp = input_gbs[gb_idx]
+            if gb_idx == first_file:
+                start = state['offset']
+            else:
+                start = 0
+
+            ranges = split_genbank_file(gb_fp, n_workers, start)
+            for start, end in ranges:
+                shard_fp = os.path.join(output_dir, 
+                                        '.shard_%d.pkl' % len(shards))
+                shards.append((gb_fp, start, end, shard_fp))
+            file_shards.append(ranges)
+
+        pool = Pool(n_workers, init_shard_worker, 
+                    (observed_records, opts.extract_rrna))
+        shard_fps = pool.imap(summarize_genbank_shard, shards)
+
+    def file_outcomes(gb_idx, start):
+        """Yields (outcome, offset) for a file
+        
+        offset is where parsing could pick up after the outcome, or None.
+        With workers, that's only known at the end of a shard, which is
+        marked with an outcome of None.
+        """
+        if n_workers > 1:
+            for start, end in file_shards[gb_idx - first_file]:
+                for outcome in _consume_shard(shard_fps.next()):
+                    yield outcome, None
+                yield None, end
         else:
-            logline = log_f("Parsed %s, %d failures observed." % (gb_fp, \
-                                                                  failure_count))
+            lines = GenbankRange(input_gbs[gb_idx], start)
+            records = parse_genbank_fields(lines, rrna=opts.extract_rrna)
+            for outcome in genbank_record_outcomes(records, observed_records,
+                                                   rrna=opts.extract_rrna):
+                yield outcome, lines.offset
+
+    for gb_idx in range(first_file, len(input_gbs)):
+        gb_fp = input_gbs[gb_idx]
+        with logger.stage(gb_fp) as stage:
+            logline = log_f("Start parsing of %s..." % gb_fp)
             logger.write(logline)
 
             if verbose:
                 stdout.write(logline)
 
-    sequences.close()
-    gg_records.close()
-    obs_records.close()
+            if gb_idx == first_file:
+                start = state['offset']
+                failure_count = state['failure_count']
+            else:
+                start = 0
+                failure_count = 0
+
+            outcomes = file_outcomes(gb_idx, start)
+            since_checkpoint = 0
+            resume_offset = None
+            for outcome, offset in outcomes:
+                if failure_count >= max_failures:
+                    break
+
+                # everything up to resume_offset has been handled
+                if checkpoint_interval and resume_offset is not None and \
+                        since_checkpoint >= checkpoint_interval:
+                    checkpoint(gb_idx, resume_offset, failure_count)
+                    since_checkpoint = 0
+                resume_offset = offset
+
+                if outcome is None:
+                    continue
+                status, accession, sequence, gg_record, location = outcome
+                since_checkpoint += 1
+
+                # dedup in input order. in serial mode this was already done
+                # before the record was summarized
+                if accession is not None and accession in observed_records:
+                    continue
+
+                if status == 'ok':
+                    observed_records.add(accession)
+                    outputs.write(accession, sequence, gg_record, location)
+                    stage.increment()
+                elif status == 'no_sequence':
+                    # this isn't a failure, so no point in continuing but 
+                    # record the accession so it isn't hit again
+                    outputs.write_obs(accession)
+                else:
+                    if status == 'corrupt':
+                        logline = log_f("Corrupt sequence, accession: %s" % \
+                                        accession)
+                    elif status == 'error':
+                        logline = log_f("Caught: %s" % accession)
+                    else:
+                        logline = None
+                    
+                    if logline is not None:
+                        logger.write(logline)
+                        if verbose:
+                            stdout.write(logline)
+                    failure_count += 1
+
+            if n_workers > 1:
+                # the remaining shards of this file still need cleaning up
+                for outcome in outcomes:
+                    pass
+                
+            if failure_count >= max_failures:
+                logline = log_f("MAX FAILURES OF %d REACHED IN %s" % (max_failures, \
+                                                                      gb_fp))
+                logger.write(logline)
+                stderr.write(logline)
+            else:
+                logline = log_f("Parsed %s, %d failures observed." % (gb_fp, \
+                                                                      failure_count))
+                logger.write(logline)
+
+                if verbose:
+                    stdout.write(logline)
+
+            if checkpoint_interval:
+                checkpoint(gb_idx + 1, 0, 0)
+
+    if n_workers > 1:
+        pool.close()
+        pool.join()
+
+    outputs.close()
+    if checkpoint_interval:
+        # the last checkpoint opened a segment that will never be written to
+        for fp in _output_fps(output_dir, tag, outputs.segment):
+            os.remove(fp)
+    logger.close()
 
 if __name__ == '__main__':
     main()
@@ -5,7 +5,9 @@ from optparse import make_option
 from greengenes.util import greengenes_open as open, NoSequenceError, \
         WorkflowLogger, generate_log_fp, log_f, GreengenesRecord
 from greengenes.write import write_gg_record
-from greengenes.parse import parse_column, parse_invariants
+from greengenes.parse import parse_invariants
+from greengenes.metrics import compile_invariants
+from greengenes.accessions import load_accession_store
 from cogent.parse.greengenes import MinimalGreengenesParser
 from os import makedirs
 from sys import stderr, stdout, argv
@@ -51,7 +53,7 @@ def main():
     gg_id = opts.starting_gg_id
 
 
-    invariants = parse_invariants(open(opts.invariants))
+    invariants = compile_invariants(parse_invariants(open(opts.invariants)))
 
     makedirs(output_dir)
     logger = WorkflowLogger(generate_log_fp(output_dir), script_name=argv[0])
@@ -64,7 +66,7 @@ def main():
     output_gg_noggid_fp = os.path.join(output_dir, "%s.records.noggid.txt" \
                                                     % tag)
     
-    existing_records = parse_column(open(existing_fp))
+    existing_records = load_accession_store(existing_fp)
     
     #records = dict([(r['ncbi_acc_w_ver'], r) \
     #                for r in MinimalGreengenesParser(open(gg_records_fp))])
@@ -3,6 +3,7 @@
 from optparse import make_option
 from cogent.util.misc import parse_command_line_parameters
 from greengenes.ncbi import esearch, parse_esearch, bulk_efetch, parse_gi_from_gb
+from greengenes.accessions import load_accession_store
 from gzip import open as open_gz
 import time
 
@@ -33,7 +34,7 @@ def main():
 
     # if we already have these records, then we do not need to reobtain them
     if opts.existing_gb:
-        existing_gis = set([l.strip() for l in open(opts.existing_gb)])
+        existing_gis = load_accession_store(opts.existing_gb)
     else:
         existing_gis = set([])
 
@@ -59,7 +60,10 @@ def main():
                 print "Query %s added %d to set" % (query, len(possible_gis) - cur_size)
 
     # drop out any existing ids
-    possible_gis = possible_gis - existing_gis
+    if opts.existing_gb:
+        possible_gis = existing_gis.missing(possible_gis)
+    else:
+        possible_gis = possible_gis - existing_gis
 
     if opts.verbose:
         print "Total number of GIs to query: %d" % len(possible_gis)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+from cogent.util.unit_test import TestCase, main
+from greengenes.accessions import AccessionStore, build_accession_array, \
+        load_accession_store, make_bloom_filter, CACHE_DIR
+from greengenes.parse import parse_column
+from numpy import array
+from tempfile import mkdtemp
+from shutil import rmtree
+import os
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class AccessionStoreTests(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.existing_fp = os.path.join(self.dir, 'existing.txt')
+        f = open(self.existing_fp, 'w')
+        f.write(existing)
+        f.close()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_build_accession_array(self):
+        """Sorted and unique, read like parse_column"""
+        obs = build_accession_array(self.existing_fp)
+        self.assertEqual(list(obs), sorted(parse_column(existing_lines)))
+        self.assertEqual(obs.dtype.itemsize, 11)
+
+    def test_contains(self):
+        """Membership matches a set"""
+        exp = parse_column(existing_lines)
+        store = AccessionStore(build_accession_array(self.existing_fp))
+        for acc in ['AB000001.1', 'X12345.2', 'EU1.1', 'AB000001.2', 'X',
+                    'AB000001.1000', 'ZZZZZZ', '', 'AB000001']:
+            self.assertEqual(acc in store, acc in exp)
+        self.assertEqual(len(store), 4)
+
+    def test_add(self):
+        """Added accessions are found"""
+        store = AccessionStore(build_accession_array(self.existing_fp))
+        self.assertFalse('NEW1.1' in store)
+        store.add('NEW1.1')
+        store.update(['NEW2.1', 'a_very_long_accession.1', 'X12345.2'])
+        self.assertTrue('NEW1.1' in store)
+        self.assertTrue('NEW2.1' in store)
+        self.assertTrue('a_very_long_accession.1' in store)
+        self.assertEqual(len(store), 7)
+
+    def test_add_merges(self):
+        """added accessions are merged into the sorted array"""
+        store = AccessionStore(build_accession_array(self.existing_fp),
+                               merge_threshold=3)
+        n_bits = store._n_bits
+        new = ['NEW%d.1' % i for i in range(10)] + ['a_very_long_accession.1']
+        store.update(new + ['AB000001.1'])
+        self.assertEqual(len(store), 15)
+        self.assertEqual(store._n_pending, 2)
+        self.assertEqual(list(store._accessions), 
+                         sorted(list(store._accessions)))
+        self.assertEqual(len(store._accessions), 13)
+        self.assertTrue(store._n_bits > n_bits)
+        for acc in new + ['EU1.1', 'X12345.2']:
+            self.assertTrue(acc in store)
+            self.assertTrue(store._maybe_stored(acc))
+        self.assertFalse('NEW10.1' in store)
+        self.assertEqual(store.missing(new + ['NEW10.1']), 
+                         set(['NEW10.1']))
+        self.assertEqual(len(store), 15)
+
+    def test_missing(self):
+        """Drop what's in the store"""
+        store = AccessionStore(build_accession_array(self.existing_fp))
+        store.add('NEW1.1')
+        obs = store.missing(['X12345.2', 'NEW1.1', 'NEW2.1', 'EU1.1',
+                                'a_very_long_accession.1', 'AA'])
+        self.assertEqual(obs, set(['NEW2.1', 'a_very_long_accession.1',
+                                   'AA']))
+
+        empty = AccessionStore(array([], dtype='S1'))
+        self.assertEqual(empty.missing(['a', 'b']), set(['a', 'b']))
+        self.assertFalse('a' in empty)
+
+    def test_make_bloom_filter(self):
+        """Never a false negative"""
+        accs = array(['AB%06d.1' % i for i in range(1000)])
+        bloom = make_bloom_filter(accs, 10000)
+        store = AccessionStore(accs, bloom)
+        self.assertEqual(len(bloom), 1250)
+        for a in accs:
+            self.assertTrue(store._maybe_stored(a))
+        false_pos = sum([store._maybe_stored('EU%06d.1' % i) \
+                         for i in range(1000)])
+        self.assertTrue(false_pos < 50)
+
+        # sizes that aren't a whole number of bytes
+        for n in [1, 7, 9, 1001, 1010]:
+            store = AccessionStore(accs, make_bloom_filter(accs, n))
+            for a in accs:
+                self.assertTrue(store._maybe_stored(a))
+
+    def test_load_accession_store_damaged(self):
+        """A damaged or partial cache is rebuilt"""
+        load_accession_store(self.existing_fp, None)
+        array_fp = self.existing_fp + '.accessions.npy'
+        bloom_fp = self.existing_fp + '.accessions.bloom'
+
+        open(array_fp, 'w').write('junk')
+        store = load_accession_store(self.existing_fp, None)
+        self.assertTrue('EU1.1' in store)
+        self.assertTrue('EU1.1' in load_accession_store(self.existing_fp, None))
+
+        os.remove(bloom_fp)
+        store = load_accession_store(self.existing_fp, None)
+        self.assertTrue('EU1.1' in store)
+        self.assertTrue(os.path.exists(bloom_fp))
+
+        # no temp files are left behind
+        self.assertEqual(sorted(os.listdir(self.dir)), ['existing.txt',
+            'existing.txt.accessions.bloom', 'existing.txt.accessions.json',
+            'existing.txt.accessions.npy'])
+
+    def test_load_accession_store(self):
+        """Cache the store and reuse it while the source is unchanged"""
+        store = load_accession_store(self.existing_fp, None)
+        self.assertTrue(os.path.exists(self.existing_fp + '.accessions.npy'))
+        self.assertTrue('EU1.1' in store)
+
+        cached = load_accession_store(self.existing_fp, None)
+        self.assertEqual(list(cached._accessions), list(store._accessions))
+        self.assertEqual(cached._bloom, store._bloom)
+        self.assertTrue('EU1.1' in cached)
+
+        f = open(self.existing_fp, 'a')
+        f.write('EU2.1\n')
+        f.close()
+        changed = load_accession_store(self.existing_fp, None)
+        self.assertTrue('EU2.1' in changed)
+
+        # a store still mapping the old cache is unaffected by a rebuild
+        self.assertTrue('AB000001.1' in cached)
+        self.assertFalse('EU2.1' in cached)
+
+        cache_dir = os.path.join(self.dir, 'cache')
+        os.mkdir(cache_dir)
+        store = load_accession_store(self.existing_fp, cache_dir=cache_dir)
+        self.assertTrue('EU2.1' in store)
+        cached = os.listdir(cache_dir)
+        self.assertEqual(len(cached), 3)
+        self.assertTrue([f for f in cached if f.startswith('existing.txt.') \
+                         and f.endswith('.accessions.json')])
+
+        # the same name elsewhere gets its own cache
+        other_dir = os.path.join(self.dir, 'other')
+        os.mkdir(other_dir)
+        other_fp = os.path.join(other_dir, 'existing.txt')
+        open(other_fp, 'w').write('ZZ1.1\n')
+        other = load_accession_store(other_fp, cache_dir=cache_dir)
+        self.assertEqual(list(other._accessions), ['ZZ1.1'])
+        self.assertEqual(len(os.listdir(cache_dir)), 6)
+        self.assertTrue('EU2.1' in load_accession_store(self.existing_fp, 
+                                                        cache_dir=cache_dir))
+
+        # the cache directory is made as needed
+        new_dir = os.path.join(self.dir, 'new', 'cache')
+        self.assertTrue('EU2.1' in load_accession_store(self.existing_fp, 
+                                                        cache_dir=new_dir))
+        self.assertEqual(len(os.listdir(new_dir)), 3)
+
+    def test_load_accession_store_default_cache(self):
+        """By default the cache is kept per user, not next to the input"""
+        self.assertEqual(load_accession_store.func_defaults[0], CACHE_DIR)
+        self.assertFalse(CACHE_DIR.startswith(self.dir))
+
+existing_lines = """#accession\tfoo
+AB000001.1\tx
+X12345.2
+EU1.1\ty\tz
+AB000001.1\tx
+  AB000002.10
+""".splitlines(True)
+existing = ''.join(existing_lines)
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,9 @@ from greengenes.flat_files import get_accession, get_gi, get_sequence, \
         get_country, get_ncbi_taxonomy, get_gold_id, _parse_migs_poorly, \
         get_title, get_journal, get_authors, get_pubmed, get_taxon, \
         get_ncbi_taxonomy, get_country, get_genbank_summary, get_strain, \
-        get_submit_date, get_specific_host, get_prokMSAname, get_clone
+        get_submit_date, get_specific_host, get_prokMSAname, get_clone, \
+        genbank_record_outcomes, parse_funs, get_rrna_region
+from greengenes.genbank import parse_genbank_fields
 from StringIO import StringIO
 from greengenes.util import GreengenesRecord
 
@@ -171,6 +173,27 @@ class FlatFilesTests(TestCase):
        
         self.assertEqual(obs,exp)
 
+    def test_get_genbank_summary_by_field(self):
+        """The summary is the same as from each of parse_funs"""
+        def by_field(r):
+            rec = GreengenesRecord()
+            for f, m in parse_funs:
+                rec[f] = m(r)
+            return rec
+
+        no_refs = self.gb2.copy()
+        del no_refs['references']
+        clone = self.gb1.copy()
+        clone['source'] = 'uncultured bacterium'
+        for r in list(self.multi) + [self.gb1, self.gb2, no_refs, clone]:
+            self.assertEqual(get_genbank_summary(r), by_field(r))
+
+        for k in ['version', 'source', 'features', 'date', 'taxonomy']:
+            r = self.gb1.copy()
+            del r[k]
+            self.assertRaises(KeyError, by_field, r)
+            self.assertRaises(KeyError, get_genbank_summary, r)
+
     def test_get_prokMSAname(self):
         """get the prokmsa name"""
         exp_gb1 = "Methanolinea tarda NOBI-1"
@@ -216,6 +239,67 @@ class FlatFilesTests(TestCase):
         obs = get_ncbi_taxonomy(self.gb1)
         self.assertEqual(obs,exp)
 
+    def test_genbank_record_outcomes(self):
+        """Say what to do with each record"""
+        gb1 = MinimalGenbankParser(StringIO(id_AGIY01000001_1_gb)).next()
+        no_seq = {'version':'VERSION     X1.1  GI:1'}
+        corrupt = {'version':'VERSION     X2.1  GI:2', 'sequence':'ACGU'}
+        no_summary = {'version':'VERSION     X3.1  GI:3', 'sequence':'ACGT'}
+        records = [self.gb2, {}, no_seq, corrupt, no_summary, gb1, self.gb2]
+
+        obs = list(genbank_record_outcomes(iter(records)))
+        self.assertEqual([o[:2] for o in obs], 
+                         [('ok', 'FO117587.1'), ('failure', None),
+                          ('no_sequence', 'X1.1'), ('corrupt', 'X2.1'),
+                          ('failure', 'X3.1'), ('ok', 'AGIY01000001.1'),
+                          ('ok', 'FO117587.1')])
+        self.assertEqual(obs[0][2], get_sequence(self.gb2))
+        self.assertEqual(obs[0][3], get_genbank_summary(self.gb2))
+
+        seen = set([])
+        obs = []
+        for o in genbank_record_outcomes(iter(records), ['X1.1'], seen):
+            seen.add(o[1])
+            obs.append(o[:2])
+        self.assertEqual(obs, [('ok', 'FO117587.1'), ('failure', None),
+                               ('corrupt', 'X2.1'), ('failure', 'X3.1'),
+                               ('ok', 'AGIY01000001.1')])
+
+        def bad_parser():
+            yield self.gb2
+            raise ValueError, "foo"
+        obs = list(genbank_record_outcomes(bad_parser()))
+        self.assertEqual([o[:2] for o in obs], [('ok', 'FO117587.1'),
+                                                ('error', 'foo')])
+
+    def test_genbank_record_outcomes_rrna(self):
+        """Use the 16S gene as the sequence when asked"""
+        records = list(parse_genbank_fields(StringIO(combined), rrna=True))
+        obs = list(genbank_record_outcomes(iter(records), rrna=True))
+        self.assertEqual([o[:2] for o in obs], [('ok', 'AGIY01000001.1'),
+                                                ('ok', 'FO117587.1')])
+        self.assertEqual(obs[0][2], records[0]['rrna'][0]['sequence'].upper())
+        self.assertEqual(obs[0][4], '116983..118449')
+        self.assertEqual(obs[1][2], records[1]['sequence'].upper())
+        self.assertEqual(obs[1][4], None)
+
+        # the long genome has no sequence without the gene
+        records[0]['rrna'] = []
+        obs = list(genbank_record_outcomes(iter(records[:1]), rrna=True))
+        self.assertEqual(obs[0][:2], ('no_sequence', 'AGIY01000001.1'))
+
+        obs = list(genbank_record_outcomes(iter(records[1:])))
+        self.assertEqual(obs[0][4], None)
+
+    def test_get_rrna_region(self):
+        """The longest gene, the first of equals"""
+        r = {'rrna':[{'sequence':'AA', 'location':'a'},
+                     {'sequence':'AAA', 'location':'b'},
+                     {'sequence':'CCC', 'location':'c'}]}
+        self.assertEqual(get_rrna_region(r)['location'], 'b')
+        self.assertEqual(get_rrna_region({}), None)
+        self.assertEqual(get_rrna_region({'rrna':[]}), None)
+
 id_AGIY01000001_1_gb = open('test_data/AGIY01000001.1.gb').read()
 id_FO117587_1_gb = open('test_data/FO117587.1.gb').read()
 combined = open('test_data/combined.gb').read()
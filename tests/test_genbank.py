@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+from cogent.util.unit_test import TestCase, main
+from cogent.parse.genbank import MinimalGenbankParser
+from cogent.parse.record import RecordError
+from greengenes.genbank import parse_genbank_fields, split_genbank_file, \
+        read_genbank_range, GenbankRange, is_ssu_rrna
+from greengenes.flat_files import get_genbank_summary, get_sequence
+from StringIO import StringIO
+from tempfile import mkstemp
+from gzip import open as gzopen
+import os
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class GenbankTests(TestCase):
+    def setUp(self):
+        pass
+
+    def test_parse_genbank_fields(self):
+        """Pull out just the fields needed for the summary"""
+        obs = list(parse_genbank_fields(StringIO(id_AGIY01000001_1_gb)))
+        self.assertEqual(len(obs), 1)
+        rec = obs[0]
+        self.assertEqual(rec['version'],
+                         'VERSION     AGIY01000001.1  GI:354825968')
+        self.assertEqual(rec['date'], '31-OCT-2011')
+        self.assertEqual(rec['source'], 'Methanolinea tarda NOBI-1')
+        self.assertEqual(len(rec['features']), 1)
+        self.assertEqual(rec['features'][0]['type'], 'source')
+        self.assertEqual(len(rec['references']), 1)
+        self.assertEqual(rec['references'][0]['title'],
+                         'The draft genome of Methanolinea tarda NOBI-1')
+        self.assertTrue(rec['comment'].startswith('COMMENT     URL'))
+        self.assertEqual(len(rec['sequence']), 452612)
+        self.assertFalse('keywords' in rec)
+
+    def test_parse_genbank_fields_same_as_cogent(self):
+        """Summaries and sequences match those from MinimalGenbankParser"""
+        for gb in [id_AGIY01000001_1_gb, id_FO117587_1_gb, combined, nasty,
+                   crap]:
+            exp = [(get_genbank_summary(r), get_sequence(r)) \
+                   for r in MinimalGenbankParser(StringIO(gb))]
+            obs = [(get_genbank_summary(r), get_sequence(r)) \
+                   for r in parse_genbank_fields(StringIO(gb))]
+            self.assertEqual(obs, exp)
+
+    def test_parse_genbank_fields_bad_records(self):
+        """Drop records that don't parse, complain about trailing data"""
+        # the first record has an HTML error page for a LOCUS line
+        obs = list(parse_genbank_fields(StringIO(nasty)))
+        self.assertEqual(len(obs), 1)
+
+        # the first two records in here are mashed together
+        obs = list(parse_genbank_fields(StringIO(crap)))
+        self.assertEqual([r['version'] for r in obs],
+                         ['VERSION     FJ924701.1  GI:238237108'])
+
+        gen = parse_genbank_fields(StringIO(combined + "LOCUS   foo\n"))
+        self.assertRaises(RecordError, list, gen)
+
+    def test_parse_genbank_fields_rrna(self):
+        """Pull out the 16S/18S genes"""
+        full = MinimalGenbankParser(StringIO(id_AGIY01000001_1_gb)).next()
+        exp = [f['location'].extract(full['sequence']) \
+               for f in full['features'] \
+               if f['type'] == 'rRNA' and is_ssu_rrna(f)]
+        self.assertEqual(len(exp), 1)
+
+        rec = parse_genbank_fields(StringIO(id_AGIY01000001_1_gb), 
+                                   rrna=True).next()
+        self.assertEqual(len(rec['rrna']), 1)
+        region = rec['rrna'][0]
+        self.assertEqual(region['product'], '16S ribosomal RNA')
+        self.assertEqual(region['location'], '116983..118449')
+        self.assertEqual((region['first'], region['last']), (116983, 118449))
+        self.assertEqual(region['strand'], 1)
+        self.assertEqual(region['sequence'], exp[0])
+        self.assertEqual(len(region['sequence']), 1467)
+        # too long to keep the whole sequence
+        self.assertFalse('sequence' in rec)
+
+        rec = parse_genbank_fields(StringIO(id_AGIY01000001_1_gb), rrna=True,
+                                   max_full_length=None).next()
+        self.assertEqual(len(rec['sequence']), 452612)
+        self.assertEqual(rec['rrna'][0]['sequence'], exp[0])
+
+        # the first feature can be the gene
+        rec = parse_genbank_fields(StringIO(crap), rrna=True).next()
+        self.assertEqual(rec['rrna'][0]['location'], '<1..>135')
+        self.assertEqual(rec['rrna'][0]['sequence'], rec['sequence'])
+
+        # without rrna nothing changes
+        rec = parse_genbank_fields(StringIO(id_FO117587_1_gb)).next()
+        self.assertFalse('rrna' in rec)
+        rec = parse_genbank_fields(StringIO(id_FO117587_1_gb), 
+                                   rrna=True).next()
+        self.assertEqual(rec['rrna'], [])
+
+    def test_is_ssu_rrna(self):
+        """Match 16S and 18S products"""
+        self.assertTrue(is_ssu_rrna({'product':['16S ribosomal RNA']}))
+        self.assertTrue(is_ssu_rrna({'product':['18s rRNA']}))
+        self.assertTrue(is_ssu_rrna({'product':['small subunit ribosomal RNA']}))
+        self.assertFalse(is_ssu_rrna({'product':['23S ribosomal RNA']}))
+        self.assertFalse(is_ssu_rrna({'product':['116S']}))
+        self.assertFalse(is_ssu_rrna({}))
+
+    def test_split_genbank_file(self):
+        """Split files between whole records"""
+        for fp in ['test_data/combined.gb', 'test_data/crap.gb']:
+            text = open(fp).read()
+            exp = [(get_genbank_summary(r), get_sequence(r)) \
+                   for r in parse_genbank_fields(StringIO(text))]
+            for n in [2, 3, 10]:
+                ranges = split_genbank_file(fp, n)
+                self.assertTrue(len(ranges) <= n)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], len(text))
+                for (a, b), (c, d) in zip(ranges, ranges[1:]):
+                    self.assertEqual(b, c)
+                    self.assertTrue(text[c:].startswith('LOCUS'))
+
+                obs = []
+                for start, end in ranges:
+                    lines = read_genbank_range(fp, start, end)
+                    obs.extend([(get_genbank_summary(r), get_sequence(r)) \
+                                for r in parse_genbank_fields(lines)])
+                self.assertEqual(obs, exp)
+
+        # the records mashed together in crap.gb can't be split
+        self.assertEqual(len(split_genbank_file('test_data/combined.gb', 2)),
+                         2)
+        self.assertEqual(len(split_genbank_file('test_data/crap.gb', 10)), 2)
+        self.assertEqual(split_genbank_file('foo.gb.gz', 4), [(0, None)])
+        self.assertEqual(split_genbank_file(fp, 1), [(0, None)])
+
+    def test_split_genbank_file_start(self):
+        """Split from an offset"""
+        fp = 'test_data/combined.gb'
+        start = split_genbank_file(fp, 2)[1][0]
+        self.assertEqual(split_genbank_file(fp, 3, start), [(start, 1236008)])
+        self.assertEqual(split_genbank_file('foo.gz', 3, 10), [(10, None)])
+
+    def test_genbank_range(self):
+        """Track offsets so parsing can pick up after a record"""
+        fd, gz_fp = mkstemp(suffix='.gb.gz')
+        os.close(fd)
+        f = gzopen(gz_fp, 'wb')
+        f.write(combined)
+        f.close()
+
+        for fp in ['test_data/combined.gb', gz_fp]:
+            lines = GenbankRange(fp)
+            records = parse_genbank_fields(lines)
+            first = records.next()
+            self.assertEqual(first['locus'], 'AGIY01000001')
+            offset = lines.offset
+            self.assertTrue(combined[:offset].endswith('//\n'))
+
+            rest = list(parse_genbank_fields(GenbankRange(fp, offset)))
+            self.assertEqual([r['locus'] for r in rest], ['FO117587'])
+            self.assertEqual(rest[0]['sequence'], 
+                             list(records)[0]['sequence'])
+
+            lines = GenbankRange(fp, 0, offset)
+            self.assertEqual(''.join(lines), combined[:offset])
+        os.remove(gz_fp)
+
+id_AGIY01000001_1_gb = open('test_data/AGIY01000001.1.gb').read()
+id_FO117587_1_gb = open('test_data/FO117587.1.gb').read()
+combined = open('test_data/combined.gb').read()
+nasty = open('test_data/nasty.gb').read()
+crap = open('test_data/crap.gb').read()
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
 from numpy import array
-from greengenes.masking import inflate_by_mask, img_best_16s_per_genome
+from greengenes.masking import inflate_by_mask, img_best_16s_per_genome, \
+        CompiledMask, load_mask, MaskRegistry, MASK_DIR, CACHE_DIR, \
+        stream_img_best_16s_per_genome
+from tempfile import mkdtemp, mkstemp
+from shutil import rmtree
+import os
 from cogent.util.unit_test import TestCase, main
 
 __author__ = "Daniel McDonald"
@@ -28,6 +33,102 @@ class MaskTests(TestCase):
         self.assertRaises(IndexError, inflate_by_mask, 'AT', mask)
         self.assertRaises(ValueError, inflate_by_mask, 'ATTTT', mask)
 
+    def test_compiled_mask(self):
+        """Inflate and deflate single sequences and blocks"""
+        mask = CompiledMask([0, 0, 1, 1, 0, 1])
+        self.assertEqual(mask.width, 6)
+        self.assertEqual(mask.n_positions, 3)
+        self.assertEqual(list(mask.positions), [2, 3, 5])
+        self.assertEqual(list(CompiledMask("001101\n").positions), [2, 3, 5])
+
+        self.assertEqual(mask.inflate('ATG'), '--AT-G')
+        self.assertEqual(inflate_by_mask('ATG', mask), '--AT-G')
+        self.assertEqual(mask.inflateBlock(['ATG', 'C.A']),
+                         ['--AT-G', '--C.-A'])
+        self.assertEqual(mask.inflateBlock([]), [])
+        self.assertEqual(mask.deflate('xxATyG'), 'ATG')
+        self.assertEqual(mask.deflateBlock(['--AT-G', '--C.-A']),
+                         ['ATG', 'C.A'])
+
+        # every sequence is checked before anything is done
+        self.assertRaises(IndexError, mask.inflateBlock, ['ATG', 'AT'])
+        self.assertRaises(ValueError, mask.inflateBlock, ['ATGC', 'ATG'])
+        self.assertRaises(IndexError, mask.deflate, 'ATG')
+        self.assertRaises(ValueError, mask.deflate, 'ATGATGA')
+
+        mask = load_mask('../data/masks/1506-1s.1508c.mask')
+        self.assertEqual(mask.width, 1508)
+        self.assertEqual(mask.n_positions, 1506)
+
+    def test_compose_masks(self):
+        """AND, OR and move masks between widths"""
+        a = CompiledMask([1, 1, 0, 0, 1])
+        b = CompiledMask([0, 1, 1, 0, 1])
+        self.assertEqual(a & b, CompiledMask([0, 1, 0, 0, 1]))
+        self.assertEqual(a | b, CompiledMask([1, 1, 1, 0, 1]))
+        self.assertNotEqual(a, b)
+        self.assertRaises(ValueError, a.__and__, CompiledMask([1, 1]))
+        self.assertEqual(CompiledMask.fromBits(a.bits, 5), a)
+        self.assertEqual(list(a.toArray()), [True, True, False, False, True])
+
+        # the same 3 columns in 5 and 8 column alignments
+        anchor_5 = CompiledMask([1, 1, 0, 1, 0])
+        anchor_8 = CompiledMask([0, 1, 0, 1, 0, 0, 0, 1])
+        obs = CompiledMask([1, 0, 0, 1, 0]).convert(anchor_5, anchor_8)
+        self.assertEqual(obs, CompiledMask([0, 1, 0, 0, 0, 0, 0, 1]))
+        self.assertEqual(obs.convert(anchor_8, anchor_5),
+                         CompiledMask([1, 0, 0, 1, 0]))
+        self.assertRaises(ValueError, a.convert, anchor_5, anchor_8)
+
+    def test_mask_registry(self):
+        """Find, compile and cache masks by name"""
+        cache_dir = mkdtemp()
+        registry = MaskRegistry(MASK_DIR, cache_dir)
+        self.assertEqual(registry.names(), ['1506-1s.1508c', '1506-1s.7682c',
+            '1577-1s.1582c', '1577-1s.7682c', 'archaea-0p1.7682',
+            'bacteria-0p1.7682'])
+        self.assertTrue('1506-1s.1508c' in registry)
+        self.assertFalse('foo' in registry)
+        self.assertRaises(KeyError, registry.__getitem__, 'foo')
+
+        mask = registry['1506-1s.1508c']
+        self.assertEqual(mask, load_mask('../data/masks/1506-1s.1508c.mask'))
+        self.assertTrue(registry['1506-1s.1508c'] is mask)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        # a new registry reads the cache
+        cached = MaskRegistry(MASK_DIR, cache_dir)['1506-1s.1508c']
+        self.assertEqual(cached, mask)
+
+        wide = registry.convert(mask, 7682)
+        self.assertEqual(wide, registry['1506-1s.7682c'])
+        self.assertEqual(registry.convert(wide, 1508), mask)
+        self.assertRaises(ValueError, registry.convert, 
+                          registry['bacteria-0p1.7682'], 1508)
+        rmtree(cache_dir)
+
+        # nothing is written next to the packaged masks
+        self.assertEqual(MaskRegistry().cache_dir, CACHE_DIR)
+        self.assertFalse(CACHE_DIR.startswith(os.path.abspath(MASK_DIR)))
+        self.assertFalse([f for f in os.listdir(MASK_DIR) \
+                          if f.endswith('.npz')])
+
+    def test_mask_registry_changes(self):
+        """Masks are reloaded when their file changes"""
+        mask_dir = mkdtemp()
+        mask_fp = os.path.join(mask_dir, 'a.mask')
+        open(mask_fp, 'w').write('0110')
+        registry = MaskRegistry(mask_dir, cache_dir=None)
+        first = registry['a']
+        self.assertEqual(first, CompiledMask([0, 1, 1, 0]))
+        self.assertTrue(registry['a'] is first)
+
+        open(mask_fp, 'w').write('10011')
+        os.utime(mask_fp, (0, 0))
+        self.assertEqual(registry['a'], CompiledMask([1, 0, 0, 1, 1]))
+        self.assertEqual(os.listdir(mask_dir), ['a.mask'])
+        rmtree(mask_dir)
+
     def test_img_best_16s_per_genome(self):
         """the best, ONLY THE BEST"""
         masked = {'1|a':'aatt--ggcc', '2|a':'atgc---.-a',
@@ -39,5 +140,34 @@ class MaskTests(TestCase):
         obs = img_best_16s_per_genome(masked,unmasked)
         self.assertEqual(obs, exp)
 
+    def test_stream_img_best_16s_per_genome(self):
+        """the best, from files, without holding them"""
+        masked = [('1|a','aatt--ggcc'), ('2|a','atgc---.-a'), 
+                  ('1|b','aattcc'), ('c', 'a-a'), ('3|a', 'aatt..ggcc')]
+        unmasked = [('1|a','aaattt--gggccc'), ('2|a','atgcccc-.-a'),
+                    ('1|b','aattcc'), ('3|a', 'a'), ('c', 'aaa')]
+        masked_fp = self._write_fasta(masked)
+        unmasked_fp = self._write_fasta(unmasked)
+
+        exp = img_best_16s_per_genome(dict(masked), dict(unmasked))
+        obs = list(stream_img_best_16s_per_genome(masked_fp, unmasked_fp))
+        self.assertEqual(dict(obs), exp)
+        self.assertEqual([h.split('\t')[0] for h, s in obs], 
+                         ['1|b', 'c', '3|a'])
+
+        missing_fp = self._write_fasta(unmasked[:2])
+        gen = stream_img_best_16s_per_genome(masked_fp, missing_fp)
+        self.assertRaises(KeyError, list, gen)
+
+        for fp in [masked_fp, unmasked_fp, missing_fp]:
+            os.remove(fp)
+
+    def _write_fasta(self, seqs):
+        fd, fp = mkstemp(suffix='.fasta')
+        f = os.fdopen(fd, 'w')
+        f.write(''.join(['>%s\n%s\n' % s for s in seqs]))
+        f.close()
+        return fp
+
 if __name__ == '__main__':
     main()
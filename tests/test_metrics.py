@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
-from greengenes.metrics import calc_invariant, calc_nonACGT
+from greengenes.metrics import calc_invariant, calc_nonACGT, \
+        calc_invariant_batch, compile_invariants, calc_nonACGT_batch, \
+        count_non_acgt_batch, calc_max_non_acgt_streak, \
+        calc_max_non_acgt_streak_batch, init_metrics_worker, \
+        calc_metrics_block, check_invariant, check_invariant_batch
+from numpy import isnan
 from cogent.util.unit_test import TestCase, main
 
 __author__ = "Daniel McDonald"
@@ -27,6 +32,72 @@ class MetricsTests(TestCase):
         obs = calc_invariant(input_sq, invariants)
         self.assertFloatEqual(obs,exp)
 
+    def test_calc_invariant_batch(self):
+        """Score many sequences at once, same as calc_invariant"""
+        invariants = [('a','AANNNTNNTNTCCGGCCCNNACN', 14),
+                      ('b','AANNTTNNTNCTCGGCCCNNACN', 15),
+                      ('c','NNNNNNNNNNNNNNNNNNNNNNNNNNT', 1)]
+        seqs = ["AATACATTCTTCCGGCCCA---T",
+                "AATACATTCTTCCGGCCCA---TGGGT", # longer than some invariants
+                "AATACATTCT",                  # shorter than all of them
+                "aatacattcttccggccca---t",
+                "",
+                "AANNTTNNTNCTCGGCCCNNACN"]
+        exp = [calc_invariant(s, invariants) for s in seqs]
+        self.assertEqual(exp[1], 1.0)
+        self.assertEqual(list(calc_invariant_batch(seqs, invariants)), exp)
+
+        compiled = compile_invariants(invariants)
+        self.assertEqual(compile_invariants(compiled), compiled)
+        self.assertEqual(compiled.width, 27)
+        self.assertEqual(compiled.ids, ['a', 'b', 'c'])
+        self.assertEqual(list(calc_invariant_batch(seqs, compiled)), exp)
+        self.assertEqual([calc_invariant(s, compiled) for s in seqs], exp)
+
+    def test_check_invariant(self):
+        """Stop scoring once the cutoff is settled"""
+        invariants = [('a','AANNNTNNTNTCCGGCCCNNACN', 14),
+                      ('b','AANNTTNNTNCTCGGCCCNNACN', 15)]
+        seqs = ["AATACATTCTTCCGGCCCA---T", "AANNTTNNTNCTCGGCCCNNACN",
+                "GGGGGGGGGGGGGGGGGGGGGGG", "AATACATTCT", ""]
+        full = [calc_invariant(s, invariants) for s in seqs]
+        for cutoff in [0.0, 0.5, 0.7, 0.9, 1.0]:
+            for chunk_size in [1, 3, 64]:
+                passed, bound = check_invariant_batch(seqs, invariants,
+                                                      cutoff, chunk_size)
+                for p, b, f in zip(passed, bound, full):
+                    self.assertEqual(p, f >= cutoff)
+                    if p:
+                        self.assertTrue(cutoff <= b <= f)
+                    else:
+                        self.assertTrue(f <= b < cutoff)
+
+        # settled after the first 4 positions of each invariant
+        obs = check_invariant_batch(seqs[2:3], invariants, 0.9, 4)
+        self.assertEqual((obs[0][0], obs[1][0]), (False, 11.0 / 15))
+        self.assertEqual(check_invariant(seqs[1], invariants, 0.5),
+                         (True, 12.0 / 14))
+
+        init_metrics_worker(invariants, 0.9)
+        obs = calc_metrics_block([('x', seqs[0]), ('y', seqs[1])])
+        self.assertTrue(obs[0][1] < 0.9)
+        self.assertTrue(obs[1][1] >= 0.9)
+
+    def test_calc_metrics_block(self):
+        """Score a block of (id, seq) with the worker's invariants"""
+        invariants = [('a','AANNNTNNTNTCCGGCCCNNACN', 14),
+                      ('b','AANNTTNNTNCTCGGCCCNNACN', 15)]
+        init_metrics_worker(invariants)
+        block = [('x', "AATACATTCTTCCGGCCCA---T"), ('y', "---"),
+                 ('z', "AANNTTNNTNCTCGGCCCNNACN")]
+        obs = calc_metrics_block(block)
+        self.assertEqual([o[0] for o in obs], ['x', 'y', 'z'])
+        for (id_, seq), (obs_id, inv, non_acgt) in zip(block, obs):
+            self.assertEqual(inv, calc_invariant(seq, invariants))
+        self.assertEqual(obs[0][2], calc_nonACGT(block[0][1]))
+        self.assertTrue(isnan(obs[1][2]))
+        self.assertEqual(obs[2][2], calc_nonACGT(block[2][1]))
+
     def test_calc_nonACGT(self):
         """Calculate the non-acgt percentage off of nast alignment"""
         a = "--A--T--NN-CC---G"
@@ -53,5 +124,39 @@ class MetricsTests(TestCase):
         self.assertEqual(obs_d, exp_d)
         self.assertEqual(obs_e, exp_e)
 
+        # lowercase and . aren't ACGT, and there must be something not a gap
+        self.assertEqual(calc_nonACGT("ac.T-"), 3.0 / 4.0)
+        self.assertRaises(ZeroDivisionError, calc_nonACGT, "---")
+
+    def test_calc_nonACGT_batch(self):
+        """Same as calc_nonACGT for a block of sequences"""
+        seqs = ["--A--T--NN-CC---G", "--A--T--XYZCC---G", "ac.T-", "A",
+                "--A--N--AAACC---G", "GATTACA"]
+        obs = calc_nonACGT_batch(seqs)
+        self.assertEqual(list(obs), [calc_nonACGT(s) for s in seqs])
+
+        n_bases, n_non_acgt = count_non_acgt_batch(seqs + ["---", ""])
+        self.assertEqual(list(n_bases), [7, 8, 4, 1, 8, 7, 0, 0])
+        self.assertEqual(list(n_non_acgt), [2, 3, 3, 0, 1, 0, 0, 0])
+
+        obs = calc_nonACGT_batch(["---", "AN"])
+        self.assertTrue(isnan(obs[0]))
+        self.assertEqual(obs[1], 0.5)
+
+        obs = calc_nonACGT_batch(["A.N-", "A.N-"], gaps='-.')
+        self.assertEqual(list(obs), [0.5, 0.5])
+
+    def test_calc_max_non_acgt_streak(self):
+        """Longest run of non-ACGT bases, skipping gaps"""
+        seqs = ["--A--T--NN-CC---G", "--A--T--XY-ZCC---G", "NNNA-N", "",
+                "---", "GATTACA", "N", "ACGN--N-N", "RYA-N.N.N"]
+        exp = [2, 3, 3, 0, 0, 0, 1, 3, 5]
+        self.assertEqual([calc_max_non_acgt_streak(s) for s in seqs], exp)
+        self.assertEqual(list(calc_max_non_acgt_streak_batch(seqs)), exp)
+        self.assertEqual(list(calc_max_non_acgt_streak_batch(seqs,'-.')),
+                         exp[:-1] + [3])
+        self.assertEqual(list(calc_max_non_acgt_streak_batch(["", ""])),
+                         [0, 0])
+
 if __name__ == '__main__':
     main()
@@ -3,9 +3,10 @@
 from cogent.util.unit_test import TestCase, main
 from greengenes.parse import parse_column, parse_gg_summary_flat, \
         parse_invariants, parse_otus, parse_b3_chimeras, \
-        parse_cs_chimeras, parse_uchime_chimeras
+        parse_cs_chimeras, parse_uchime_chimeras, load_gg_summary_columns
 from greengenes.util import GreengenesRecord
 from StringIO import StringIO
+from numpy import int64
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2012, Greengenes"
@@ -80,6 +81,76 @@ class ParseTests(TestCase):
 
         self.assertEqual(obs,exp)
 
+    def test_parse_gg_summary_flat_types(self):
+        """Summary records are typed and validated in blocks"""
+        obs = list(parse_gg_summary_flat(StringIO(gg_summary_typed),
+                                         block_size=2))
+        self.assertEqual([r['prokmsa_id'] for r in obs], [1,25,50])
+        self.assertEqual([r['non_acgt_percent'] for r in obs],
+                         [0.01,None,0.5])
+        self.assertEqual([r['pubmed'] for r in obs], [None,None,123])
+
+        obs = list(parse_gg_summary_flat(StringIO(gg_summary_typed),
+                                         set_types=False))
+        self.assertEqual([r['prokmsa_id'] for r in obs], ['1','25','50'])
+
+        try:
+            list(parse_gg_summary_flat(StringIO(gg_summary_bad)))
+        except ValueError, e:
+            msg = str(e)
+        else:
+            self.fail("Bad summary should not parse")
+        self.assertTrue("line 2: prokmsa_id='x1' is not a valid int" in msg)
+        self.assertTrue("line 4: pubmed='abc' is not a valid int" in msg)
+
+    def test_parse_gg_summary_flat_empty_str(self):
+        """An empty field is None wherever it is in the row"""
+        obs = list(parse_gg_summary_flat(StringIO(gg_summary_empty)))
+        self.assertEqual([r['country'] for r in obs], [None, None, 'usa'])
+        self.assertEqual([r['strain'] for r in obs], [None, 'x', None])
+
+    def test_load_gg_summary_columns(self):
+        """Load typed columns of the summary"""
+        obs = load_gg_summary_columns(StringIO(gg_summary_typed),
+                                      block_size=2)
+        self.assertEqual(sorted(obs), ['ncbi_acc_w_ver', 'non_acgt_percent',
+                                       'prokmsa_id', 'pubmed'])
+        self.assertEqual(obs['ncbi_acc_w_ver'], ['xyzf', 'abcd', '223xx'])
+        self.assertEqual(obs['prokmsa_id'].dtype, int64)
+        self.assertEqual(list(obs['prokmsa_id']), [1, 25, 50])
+        self.assertEqual(obs['non_acgt_percent'].tolist(), [0.01, None, 0.5])
+        self.assertEqual(obs['pubmed'].tolist(), [None, None, 123])
+
+        # same values as the records
+        recs = list(parse_gg_summary_flat(StringIO(gg_summary_typed)))
+        for field, column in obs.items():
+            if hasattr(column, 'tolist'):
+                column = column.tolist()
+            self.assertEqual(column, [r[field] for r in recs])
+
+        self.assertRaises(ValueError, load_gg_summary_columns,
+                          StringIO(gg_summary_bad))
+        self.assertRaises(ValueError, load_gg_summary_columns,
+                          StringIO(gg_summary_typed), ['foo'])
+
+    def test_load_gg_summary_columns_where(self):
+        """Keep only some columns of some rows"""
+        obs = load_gg_summary_columns(StringIO(gg_summary_typed),
+                ['ncbi_acc_w_ver'], {'non_acgt_percent':lambda v: v < 0.1},
+                block_size=2)
+        self.assertEqual(obs, {'ncbi_acc_w_ver':['xyzf']})
+
+        obs = load_gg_summary_columns(StringIO(gg_summary_typed),
+                ['prokmsa_id', 'non_acgt_percent'],
+                {'ncbi_acc_w_ver':lambda v: v != 'xyzf',
+                 'prokmsa_id':lambda v: v > 10})
+        self.assertEqual(obs['prokmsa_id'].tolist(), [25, 50])
+        self.assertEqual(obs['non_acgt_percent'].tolist(), [None, 0.5])
+
+        obs = load_gg_summary_columns(StringIO(gg_summary_typed), 
+                ['pubmed'], {'prokmsa_id':lambda v: v > 100})
+        self.assertEqual(len(obs['pubmed']), 0)
+
 invariants = """>inv_a
 NNNNAANNANNTTNGNANNNAAANN
 >inv_b
@@ -100,5 +171,23 @@ gg_summary = """#prokMSA_id\tncbi_acc_w_ver\tcountry
 50\t223xx\t
 """
 
+gg_summary_typed = """#prokmsa_id\tncbi_acc_w_ver\tnon_acgt_percent\tpubmed
+1\txyzf\t0.01\t
+25\tabcd\t\t
+50\t223xx\t0.5\t123
+"""
+
+gg_summary_empty = """#prokmsa_id\tcountry\tstrain
+1\t\t
+2\t\tx
+3\tusa\t
+"""
+
+gg_summary_bad = """#prokmsa_id\tncbi_acc_w_ver\tpubmed
+x1\txyzf\t
+25\tabcd\t
+50\t223xx\tabc
+"""
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+from cogent.util.unit_test import TestCase, main
+from greengenes.sequence import normalize_dna, count_non_acgt
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class SequenceTests(TestCase):
+    def setUp(self):
+        pass
+
+    def test_normalize_dna(self):
+        """Uppercase, count ambiguous bases and find bad characters"""
+        self.assertEqual(normalize_dna('ACGT'), ('ACGT', 0, ''))
+        self.assertEqual(normalize_dna('acgtnNryRY'), ('ACGTNNRYRY', 6, ''))
+        self.assertEqual(normalize_dna('aCgTbdhvkmsw'), 
+                         ('ACGTBDHVKMSW', 8, ''))
+        self.assertEqual(normalize_dna('ACGU-xA.n'), ('ACGU-xA.N', 1, 'U-x.'))
+        self.assertEqual(normalize_dna(''), ('', 0, ''))
+
+    def test_count_non_acgt(self):
+        """Count bases, and bases that aren't ACGT"""
+        self.assertEqual(count_non_acgt('--A--T--NN-CC---G'), (7, 2))
+        self.assertEqual(count_non_acgt('acgt.ACGT'), (9, 5))
+        self.assertEqual(count_non_acgt('---'), (0, 0))
+        self.assertEqual(count_non_acgt('A-.-N', gaps='-.'), (2, 1))
+
+if __name__ == '__main__':
+    main()
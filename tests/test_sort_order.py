@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
-from greengenes.sort_order import parse_dec, parse_lengths, merge_dec_length, sort_order
+from greengenes.sort_order import parse_dec, parse_lengths, merge_dec_length, sort_order, \
+        sort_order_by_key, external_sort_order, sort_columns, \
+        load_sort_columns
+from tempfile import mkdtemp
+from shutil import rmtree
+import os
 from cogent.util.unit_test import TestCase,main
 
 __author__ = "Daniel McDonald"
@@ -60,5 +65,67 @@ class SortOrderTests(TestCase):
         obs = sort_order(self.map407k)
         self.assertEqual(obs,exp)
 
+    def test_sort_order_by_key(self):
+        """Same order as sort_order, without the tree"""
+        exp = ['a','b','c','d','e','f','g','h','i','j','k','l']
+        self.assertEqual(sort_order_by_key(self.map407k), exp)
+        self.assertEqual(sort_order_by_key(self.map407k.items()), exp)
+        self.assertEqual(sort_order_by_key({}), [])
+
+        # ties on length go to the larger id
+        records = dict(self.map407k)
+        records.update({'aa':(123,'named_isolate',True,True),
+                        'A':(123,'named_isolate',True,True),
+                        'z':(1000,'clone',False,False)})
+        self.assertEqual(sort_order_by_key(records), sort_order(records))
+
+        records['x'] = (1, 'clone', True, True)
+        self.assertRaises(KeyError, sort_order_by_key, records)
+
+        ids, lengths, buckets = sort_columns(['a', 'b', 'c'], [5, 6, 6],
+                                             [1, 1, 0])
+        self.assertEqual(list(ids), ['c', 'b', 'a'])
+        self.assertEqual(list(lengths), [6, 6, 5])
+        self.assertEqual(list(buckets), [0, 1, 1])
+
+    def test_load_sort_columns(self):
+        """Join the inputs as merge_dec_length does"""
+        dec = ["#id\tdecision\torganism\n", "a\tnamed_isolate\tblah sp. foo",
+               "b\tclone", "c\tcrap", "d\tnamed_isolate\timgood",
+               "e\tnamed_isolate\tx", "b\tnamed_isolate\timgood", 
+               "f\tclone"]
+        lengths = ["#id\tlength", "a\t123", "b\t250", "d\t10", "c\t100",
+                   "a\t124", "f\t5", "g\t500"]
+        preference = ["a\n", "b\n", "#f\n", "x\n"]
+
+        exp = merge_dec_length(set([l.strip() for l in preference]),
+                               parse_lengths(lengths), parse_dec(dec))
+        for block_size in [1, 2, 100]:
+            ids, lens, buckets = load_sort_columns(dec, lengths, preference,
+                                                   block_size)
+            self.assertEqual(list(ids), ['a', 'b', 'c', 'd', 'f'])
+            self.assertEqual(list(lens), [124, 250, 100, 10, 5])
+            self.assertEqual(list(buckets), [1, 0, 5, 3, 5])
+
+            obs = sort_columns(ids, lens, buckets)[0]
+            self.assertEqual(list(obs), sort_order(exp))
+
+        ids, lens, buckets = load_sort_columns([], lengths, [])
+        self.assertEqual(len(ids), 0)
+        ids, lens, buckets = load_sort_columns(dec, [], preference)
+        self.assertEqual(len(ids), 0)
+
+    def test_external_sort_order(self):
+        """Merge sorted runs for the same order as sort_order"""
+        tmp_dir = mkdtemp()
+        exp = sort_order(self.map407k)
+        for max_records in [1, 2, 5, 12, 100]:
+            obs = list(external_sort_order(self.map407k, max_records,
+                                           tmp_dir))
+            self.assertEqual(obs, exp)
+            self.assertEqual(os.listdir(tmp_dir), [])
+        self.assertEqual(list(external_sort_order([], 2, tmp_dir)), [])
+        rmtree(tmp_dir)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+from cogent.util.unit_test import TestCase, main
+from greengenes.taxonomy import build_taxonomy_trie, load_taxonomy_trie, \
+        parse_taxonomy_lines, find_polyphyletic, ROOT
+from tempfile import mkdtemp
+from shutil import rmtree
+import os
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2013, Greengenes"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "0.1-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class TaxonomyTrieTests(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.map_fp = os.path.join(self.dir, 'taxonomy.txt')
+        f = open(self.map_fp, 'w')
+        f.write(taxonomy_map)
+        f.close()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_parse_taxonomy_lines(self):
+        """ids and taxonomy strings"""
+        obs = list(parse_taxonomy_lines(taxonomy_map.splitlines()))
+        self.assertEqual(len(obs), 6)
+        self.assertEqual(obs[0], ('1', 'k__a; p__b; c__c'))
+        self.assertRaises(ValueError, list, parse_taxonomy_lines(['x y']))
+
+    def test_build_taxonomy_trie(self):
+        """lineages are interned"""
+        trie = build_taxonomy_trie(taxonomy_map.splitlines())
+        self.assertEqual(len(trie), 6)
+        self.assertEqual(trie.n_nodes, 10)
+        self.assertEqual(trie['1'], trie['2'])
+        self.assertEqual(trie.taxonString(trie['1']), 'k__a; p__b; c__c')
+        self.assertEqual(trie.lineage(trie['5']), ['k__x', 'p__b', 'c__'])
+        self.assertEqual(trie.lineage(ROOT), [])
+        self.assertTrue('6' in trie)
+        self.assertFalse('7' in trie)
+        self.assertFalse('a very long id' in trie)
+        self.assertRaises(KeyError, trie.__getitem__, '7')
+
+        # preorder, so a clade is a range of nodes
+        for node in range(trie.n_nodes):
+            for other in range(trie.n_nodes):
+                lineage = trie.lineage(node)
+                exp = trie.lineage(other)[:len(lineage)] == lineage
+                self.assertEqual(trie.isAncestor(node, other), exp)
+
+        self.assertRaises(ValueError, build_taxonomy_trie, 
+                          ['1\tk__a', '2\tk__b', '1\tk__c'])
+        empty = build_taxonomy_trie([])
+        self.assertEqual(len(empty), 0)
+        self.assertFalse('1' in empty)
+
+    def test_find(self):
+        """lineages to nodes"""
+        trie = build_taxonomy_trie(taxonomy_map.splitlines())
+        self.assertEqual(trie.find(['k__a', 'p__b', 'c__c']), trie['1'])
+        self.assertEqual(trie.find([]), ROOT)
+        self.assertEqual(trie.lineage(trie.find(['k__a', 'p__b'])),
+                         ['k__a', 'p__b'])
+        self.assertEqual(trie.find(['k__a', 'p__x']), None)
+
+    def test_ancestor(self):
+        """walk up to a rank"""
+        trie = build_taxonomy_trie(taxonomy_map.splitlines())
+        node = trie['3']
+        self.assertEqual(trie.lineage(trie.ancestor(node, 0)), ['k__a'])
+        self.assertEqual(trie.lineage(trie.ancestor(node, 1)), 
+                         ['k__a', 'p__b'])
+        self.assertEqual(trie.ancestor(node, 2), node)
+        self.assertRaises(ValueError, trie.ancestor, node, 3)
+
+    def test_lca(self):
+        """lowest common ancestors"""
+        trie = build_taxonomy_trie(taxonomy_map.splitlines())
+        self.assertEqual(trie.lineage(trie.lca(trie['1'], trie['3'])),
+                         ['k__a', 'p__b'])
+        self.assertEqual(trie.lca(trie['1'], trie['2']), trie['1'])
+        self.assertEqual(trie.lca(trie['1'], trie['5']), ROOT)
+        self.assertEqual(trie.lineage(trie.lca(trie['4'], trie['1'])),
+                         ['k__a'])
+        p_b = trie.find(['k__a', 'p__b'])
+        self.assertEqual(trie.lca(trie['3'], p_b), p_b)
+
+    def test_ids_under(self):
+        """all the ids in a clade"""
+        trie = build_taxonomy_trie(taxonomy_map.splitlines())
+        self.assertEqual(sorted(trie.idsUnder(trie.find(['k__a']))),
+                         ['1', '2', '3', '4', '6'])
+        self.assertEqual(sorted(trie.idsUnder(trie.find(['k__a', 'p__b']))),
+                         ['1', '2', '3', '6'])
+        self.assertEqual(sorted(trie.idsUnder(trie['1'])), ['1', '2'])
+        self.assertEqual(trie.idsUnder(trie['5']), ['5'])
+        self.assertEqual(len(trie.idsUnder(ROOT)), 6)
+
+    def test_load_taxonomy_trie(self):
+        """cache the trie and reuse it while the map is unchanged"""
+        trie = load_taxonomy_trie(self.map_fp)
+        cache_fp = self.map_fp + '.taxonomy.npz'
+        self.assertTrue(os.path.exists(cache_fp))
+
+        cached = load_taxonomy_trie(self.map_fp)
+        self.assertEqual(cached.names, trie.names)
+        self.assertEqual(list(cached.ids), list(trie.ids))
+        self.assertEqual(list(cached.id_nodes), list(trie.id_nodes))
+        self.assertEqual(cached.taxonString(cached['6']), 
+                         'k__a; p__b; c__d')
+
+        f = open(self.map_fp, 'a')
+        f.write('7\tk__z; p__; c__\n')
+        f.close()
+        changed = load_taxonomy_trie(self.map_fp)
+        self.assertEqual(changed.taxonString(changed['7']), 'k__z; p__; c__')
+
+        # a damaged cache is rebuilt
+        open(cache_fp, 'w').write('junk')
+        self.assertTrue('7' in load_taxonomy_trie(self.map_fp))
+
+        cache_dir = os.path.join(self.dir, 'cache')
+        os.mkdir(cache_dir)
+        trie = load_taxonomy_trie(self.map_fp, cache_dir=cache_dir)
+        self.assertTrue('7' in trie)
+        self.assertTrue(os.path.exists(os.path.join(cache_dir,
+                                        'taxonomy.txt.taxonomy.npz')))
+        # no temp files are left behind
+        self.assertEqual(os.listdir(cache_dir), ['taxonomy.txt.taxonomy.npz'])
+        self.assertEqual(sorted(os.listdir(self.dir)), ['cache', 
+                         'taxonomy.txt', 'taxonomy.txt.taxonomy.npz'])
+
+        # cached loads don't hold the cache open
+        if os.path.isdir('/proc/self/fd'):
+            n_fds = len(os.listdir('/proc/self/fd'))
+            for i in range(5):
+                load_taxonomy_trie(self.map_fp, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir('/proc/self/fd')), n_fds)
+
+    def test_find_polyphyletic(self):
+        """names under more than one parent"""
+        trie = build_taxonomy_trie(taxonomy_map.splitlines())
+        obs = find_polyphyletic(trie)
+        self.assertEqual(obs, {('p__b', 1):{'k__a':(4, '1'), 
+                                            'k__x':(1, '5')},
+                               ('c__c', 2):{'k__a; p__b':(2, '1'),
+                                            'k__a; p__e':(1, '4')}})
+
+        obs = find_polyphyletic(trie, include_empty=True)
+        self.assertEqual(len(obs), 2)
+
+        trie = build_taxonomy_trie(poly_map.splitlines())
+        obs = find_polyphyletic(trie)
+        self.assertEqual(obs, {})
+        obs = find_polyphyletic(trie, include_empty=True)
+        self.assertEqual(obs, {('g__', 3):{'k__a; p__b; c__c':(2, '1'),
+                                           'k__a; p__b; c__d':(1, '3')}})
+
+        self.assertEqual(find_polyphyletic(build_taxonomy_trie([])), {})
+
+taxonomy_map = """1\tk__a; p__b; c__c
+2\tk__a; p__b; c__c
+3\tk__a; p__b; c__d
+
+4\tk__a; p__e; c__c
+5\tk__x; p__b; c__
+6\tk__a; p__b; c__d
+"""
+
+poly_map = """1	k__a; p__b; c__c; g__
+2	k__a; p__b; c__c; g__
+3	k__a; p__b; c__d; g__
+"""
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,17 @@
 from cogent.util.unit_test import TestCase, main
 from cogent.parse.tree import DndParser
 from cogent.seqsim.tree import RangeNode
-from greengenes.util import GreengenesRecord, prune_tree, make_tree_arb_safe
+from greengenes.util import GreengenesRecord, prune_tree, \
+        make_tree_arb_safe, WorkflowLogger, log_f, greengenes_system_call, \
+        greengenes_streaming_call, greengenes_pooled_calls, coerce_columns, \
+        validate_records, write_arb_safe_newick
+from StringIO import StringIO
+from tempfile import mkstemp, mkdtemp
+from shutil import rmtree
+from datetime import datetime
+from time import time, sleep
+import json
+import os
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2012, Greengenes"
@@ -44,6 +54,49 @@ class UtilTests(TestCase):
         make_tree_arb_safe(t)
         self.assertEqual(t.getNewick(), exp)
 
+    def test_write_arb_safe_newick(self):
+        """prune, make ARB safe and write in one go"""
+        t = DndParser("(((a,b)c,(d,e)f)g,(h,i)j)k;", constructor=RangeNode)
+        exp = "(((a,b)c,X)g,(h,i)j)k;"
+        obs = StringIO()
+        write_arb_safe_newick(t, ['a','b','h','i'], obs)
+        self.assertEqual(obs.getvalue(), exp)
+
+        # the input tree is left alone
+        self.assertEqual(t.getNewick(), "(((a,b)c,(d,e)f)g,(h,i)j)k;")
+
+        t = DndParser("(((((a)b)c)d)e)f;", constructor=RangeNode)
+        exp = "(((((a,X)b,X)c,X)d,X)e,X)f;"
+        obs = StringIO()
+        write_arb_safe_newick(t, ['a'], obs)
+        self.assertEqual(obs.getvalue(), exp)
+
+        t = DndParser("((a:1,b:2)c:3,(d:1,e:1)f:2)g;", constructor=RangeNode)
+        exp = "((a:1.0,X:0.0)c:3.0,(d:1.0,e:1.0)f:2.0)g;"
+        obs = StringIO()
+        write_arb_safe_newick(t, ['a','d','e'], obs, with_distances=True)
+        self.assertEqual(obs.getvalue(), exp)
+
+    def test_write_arb_safe_newick_matches(self):
+        """same as prune_tree then make_tree_arb_safe"""
+        t = DndParser("((((a,b)c,(d,e)f)g,(h,i)j,(k,l,m)n)o,(p,q)r)s;",
+                        constructor=RangeNode)
+        for ids in [['a','b','d','e','h','i','k','l'], ['k'], ['a','q'],
+                    ['m','p','q']]:
+            exp = prune_tree(t, ids)
+            make_tree_arb_safe(exp)
+            obs = StringIO()
+            write_arb_safe_newick(t, ids, obs)
+            self.assertEqual(obs.getvalue(), exp.getNewick())
+
+    def test_write_arb_safe_newick_bad_ids(self):
+        """complain if ids are not in the tree"""
+        t = DndParser("((a,b)c,(d,e)f)g;", constructor=RangeNode)
+        self.assertRaises(ValueError, write_arb_safe_newick, t, ['a','x'],
+                          StringIO())
+        self.assertRaises(ValueError, write_arb_safe_newick, t, [],
+                          StringIO())
+
 class GreengenesRecordTests(TestCase):
     def setUp(self):
         self.ggrecord = GreengenesRecord({'prokmsa_id':123})
@@ -117,6 +170,195 @@ class GreengenesRecordTests(TestCase):
         self.assertEqual(self.ggrecord.sanityCheck(), None)
         self.ggrecord['prokmsa_id'] = "bad"
         self.assertRaises(ValueError, self.ggrecord.sanityCheck)
+
+    def test_coerce_columns(self):
+        """coerce whole columns, reporting all bad values"""
+        columns = {'prokmsa_id':['1','2',None,''],
+                   'non_acgt_percent':['0.1','0.2','0.3','0.4'],
+                   'country':['a','',None,'b'],
+                   'not_a_field':['x','y','z','w']}
+        exp = {'prokmsa_id':[1,2,None,None],
+               'non_acgt_percent':[0.1,0.2,0.3,0.4],
+               'country':['a',None,None,'b'],
+               'not_a_field':['x','y','z','w']}
+        obs, errors = coerce_columns(columns)
+        self.assertEqual(obs, exp)
+        self.assertEqual(errors, [])
+
+        columns = {'prokmsa_id':['1','x','3',''],
+                   'pubmed':['1.5','2','','y']}
+        obs, errors = coerce_columns(columns)
+        self.assertEqual(obs['prokmsa_id'], [1,'x',3,None])
+        self.assertEqual(obs['pubmed'], ['1.5',2,None,'y'])
+        self.assertEqual(errors, [(0,'pubmed','1.5','not a valid int'),
+                                  (1,'prokmsa_id','x','not a valid int'),
+                                  (3,'pubmed','y','not a valid int')])
+
+    def test_coerce_columns_required(self):
+        """optionally complain about missing required values"""
+        columns = {'prokmsa_id':['1',None], 'country':['', 'a'],
+                   'strain':[None, None]}
+        obs, errors = coerce_columns(columns, check_required=True)
+        self.assertEqual(errors, [(0,'country','','missing required value'),
+                            (1,'prokmsa_id',None,'missing required value')])
+
+    def test_validate_records(self):
+        """validate a block of records in place"""
+        recs = [GreengenesRecord({'prokmsa_id':'1', 'country':'a'}),
+                GreengenesRecord({'prokmsa_id':'2', 'pubmed':'bad'}),
+                GreengenesRecord({'prokmsa_id':3, 'non_acgt_percent':'0.5'})]
+        errors = validate_records(recs)
+        self.assertEqual(errors, [(1,'pubmed','bad','not a valid int')])
+        self.assertEqual([r['prokmsa_id'] for r in recs], [1,2,3])
+        self.assertEqual(recs[2]['non_acgt_percent'], 0.5)
+        self.assertEqual(recs[1]['pubmed'], 'bad')
+        recs[1]['pubmed'] = None
+        for r in recs:
+            r.sanityCheck()
+
+        self.assertEqual(validate_records([]), [])
+
+class SystemCallTests(TestCase):
+    def test_greengenes_streaming_call(self):
+        """stream stdout to a consumer"""
+        lines = []
+        obs = greengenes_streaming_call("printf 'a\\nb\\n'; echo err >&2",
+                                        lines.append)
+        self.assertEqual(lines, ['a\n','b\n'])
+        sout, serr, ret = obs
+        self.assertEqual(sout, None)
+        self.assertEqual(serr, 'err\n')
+        self.assertEqual(ret, 0)
+        self.assertFalse(obs.timed_out)
+        self.assertTrue(obs.wall_time >= 0)
+        self.assertTrue(obs.cpu_time >= 0)
+        self.assertTrue(obs.max_rss_kb > 0)
+
+    def test_greengenes_streaming_call_contract(self):
+        """without a consumer, results match greengenes_system_call"""
+        cmd = "echo foo; echo bar >&2; exit 3"
+        self.assertEqual(greengenes_streaming_call(cmd),
+                         greengenes_system_call(cmd))
+
+    def test_greengenes_streaming_call_timeout(self):
+        """commands running past the timeout are killed"""
+        obs = greengenes_streaming_call("sleep 10; echo done", timeout=0.2)
+        self.assertTrue(obs.timed_out)
+        self.assertEqual(obs.stdout, '')
+        self.assertTrue(obs.return_value < 0)
+        self.assertTrue(obs.wall_time < 5)
+
+        # closing stdout doesn't get around the timeout
+        obs = greengenes_streaming_call("exec >&-; sleep 10", timeout=0.2)
+        self.assertTrue(obs.timed_out)
+        self.assertTrue(obs.wall_time < 5)
+
+        # finishing in time isn't a timeout
+        obs = greengenes_streaming_call("echo fast", timeout=5)
+        self.assertFalse(obs.timed_out)
+        self.assertEqual(obs.return_value, 0)
+
+    def test_greengenes_streaming_call_consumer_raises(self):
+        """a failing consumer doesn't leave the command running"""
+        def consumer(line):
+            raise ValueError, line
+        start = time()
+        self.assertRaises(ValueError, greengenes_streaming_call, 
+                          "echo a; sleep 10", consumer, 30)
+        self.assertTrue(time() - start < 5)
+
+    def test_greengenes_pooled_calls(self):
+        """results come back in command order"""
+        cmds = ["sleep 0.%d; echo %d" % (5 - i, i) for i in range(5)]
+        seen = []
+        obs = greengenes_pooled_calls(iter(cmds), n_workers=3,
+                                      callback=seen.append)
+        self.assertEqual([r.stdout for r in obs],
+                         ['%d\n' % i for i in range(5)])
+        self.assertEqual([r.cmd for r in obs], cmds)
+        self.assertEqual(sorted(r.cmd for r in seen), sorted(cmds))
+
+        self.assertEqual(greengenes_pooled_calls([]), [])
+        self.assertRaises(ValueError, greengenes_pooled_calls, cmds, 0)
+
+    def test_greengenes_pooled_calls_error(self):
+        """nothing is left running once an error is raised"""
+        out_dir = mkdtemp()
+        cmds = ["sleep 0.2; touch %s/%d" % (out_dir, i) for i in range(10)]
+        # not a command, fails to start
+        cmds[2] = None
+        self.assertRaises(Exception, greengenes_pooled_calls, cmds, 2)
+        done = sorted(os.listdir(out_dir))
+        sleep(0.5)
+        self.assertEqual(sorted(os.listdir(out_dir)), done)
+        self.assertTrue(len(done) < 8)
+        rmtree(out_dir)
+
+class WorkflowLoggerTests(TestCase):
+    def setUp(self):
+        fd, self.log_fp = mkstemp(suffix='.txt')
+        os.close(fd)
+        self.summary_fp = os.path.splitext(self.log_fp)[0] + '_stages.jsonl'
+
+    def tearDown(self):
+        for fp in [self.log_fp, self.summary_fp]:
+            if os.path.exists(fp):
+                os.remove(fp)
+
+    def test_log_f(self):
+        """log lines are timestamped"""
+        obs = log_f("foo")
+        self.assertTrue(obs.endswith("\tfoo\n"))
+        # raises if the timestamp is malformed
+        datetime.strptime(obs.split('\t')[0], '%H:%M:%S on %d %b %Y')
+
+    def test_buffered_write(self):
+        """writes are held until flushed or closed"""
+        logger = WorkflowLogger(self.log_fp, flush_interval=3600)
+        logger.write("buffered\n")
+        self.assertFalse('buffered' in open(self.log_fp).read())
+        logger.flush()
+        self.assertTrue('buffered' in open(self.log_fp).read())
+        logger.write("at close\n")
+        logger.close()
+        self.assertTrue('at close' in open(self.log_fp).read())
+
+        # closing twice is harmless
+        logger.close()
+
+    def test_stage(self):
+        """stages are timed and summarized as JSON lines"""
+        logger = WorkflowLogger(self.log_fp, flush_interval=3600)
+        with logger.stage('parse') as stage:
+            # visible while the stage runs
+            self.assertTrue('Starting stage parse' in open(self.log_fp).read())
+            stage.increment()
+            stage.increment(4)
+        with logger.stage('write'):
+            pass
+        self.assertTrue('Stage write: 0 records' in open(self.log_fp).read())
+        logger.close()
+
+        stages = logger.getStages()
+        self.assertEqual([s.name for s in stages], ['parse','write'])
+        self.assertEqual(stages[0].records, 5)
+        self.assertTrue(stages[0].wall_time >= 0)
+        self.assertTrue(stages[0].cpu_time >= 0)
+        self.assertTrue(stages[0].peak_rss_kb > 0)
+        self.assertTrue('Stage parse: 5 records' in open(self.log_fp).read())
+
+        obs = [json.loads(l) for l in open(self.summary_fp)]
+        self.assertEqual([o['stage'] for o in obs], ['parse','write'])
+        self.assertEqual(obs[0]['records'], 5)
+        self.assertEqual(sorted(obs[0].keys()), ['cpu_time','peak_rss_kb',
+                                 'records','stage','wall_time'])
+
+    def test_no_stages_no_summary(self):
+        """the summary is only written if stages were recorded"""
+        logger = WorkflowLogger(self.log_fp)
+        logger.close()
+        self.assertFalse(os.path.exists(self.summary_fp))
+
 exp_testrecord = """BEGIN
 prokmsa_id=123
 gg_id=
@@ -3,7 +3,12 @@
 from cogent.parse.tree import DndParser
 from cogent.util.unit_test import TestCase, main
 from greengenes.verify_taxonomy import check_parse, check_n_levels, check_gap, \
-        check_prefixes, ParseError, cache_tipnames, get_polyphyletic
+        check_prefixes, ParseError, cache_tipnames, get_polyphyletic, \
+        index_tips, check_line, TaxonomyReport, verify_taxonomy_lines, \
+        verify_taxonomy_file, split_lines_file, EXIT_OK, EXIT_FAILED_CHECKS, \
+        EXIT_PARSE_ERROR
+from tempfile import mkstemp
+import os
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2013, Greengenes"
@@ -16,7 +21,15 @@ __status__ = "Development"
 
 class VerifyTaxonomy(TestCase):
     def setUp(self):
-        pass
+        self.prefixes = ['k','p','c','o','f','g','s']
+        fd, self.taxonomy_fp = mkstemp(suffix='.txt')
+        os.close(fd)
+        f = open(self.taxonomy_fp, 'w')
+        f.write('\n'.join(taxonomy_lines * 25) + '\n')
+        f.close()
+
+    def tearDown(self):
+        os.remove(self.taxonomy_fp)
 
     def test_check_parse(self):
         """returns valid parsed or raises"""
@@ -70,6 +83,73 @@ class VerifyTaxonomy(TestCase):
     
         self.fail("check duplicate ranks")
 
+    def test_check_line(self):
+        """all the checks in one go"""
+        self.assertEqual(check_line(good_string, 7, self.prefixes), [])
+        self.assertEqual(check_line(good_trailing, 7, self.prefixes), [])
+        self.assertEqual(check_line(bad_string, 7, self.prefixes), ['parse'])
+        self.assertEqual(check_line(gap, 7, self.prefixes), ['gap'])
+        self.assertEqual(check_line(bad_prefix, 7, self.prefixes), 
+                         ['prefixes'])
+        self.assertEqual(check_line(bad_nlevels, 7, self.prefixes), 
+                         ['n_levels'])
+        self.assertEqual(check_line(bad_unclassified1, 7, self.prefixes), 
+                         ['prefixes', 'n_levels'])
+
+    def test_taxonomy_report(self):
+        """count errors and keep the first lines"""
+        report = verify_taxonomy_lines(taxonomy_lines, 7, self.prefixes, 
+                                       max_examples=1)
+        self.assertEqual(report.n_lines, 5)
+        self.assertEqual(report.counts, {'parse':1, 'prefixes':2, 
+                                         'n_levels':1, 'gap':1})
+        self.assertEqual(report.examples['prefixes'], [(3, bad_prefix)])
+        self.assertEqual(report.examples['gap'], [(5, gap)])
+        self.assertEqual(report.exitStatus(), EXIT_PARSE_ERROR)
+
+        more = verify_taxonomy_lines(taxonomy_lines, 7, self.prefixes)
+        report.update(more)
+        self.assertEqual(report.n_lines, 10)
+        self.assertEqual(report.counts['gap'], 2)
+        self.assertEqual(report.examples['gap'], [(5, gap)])
+
+        report = TaxonomyReport(max_examples=2)
+        report.update(more)
+        self.assertEqual(report.examples['prefixes'], 
+                         [(3, bad_prefix), (4, bad_unclassified1)])
+
+        report = verify_taxonomy_lines([good_string, gap], 7, self.prefixes)
+        self.assertEqual(report.exitStatus(), EXIT_FAILED_CHECKS)
+        self.assertEqual(report.toLines(), ["#lines\t2\n", "#status\t1\n",
+            "#error\tcount\n", "parse\t0\n", "prefixes\t0\n",
+            "n_levels\t0\n", "gap\t1\n", "#error\tline number\tline\n",
+            "gap\t2\t%s\n" % gap])
+        report = verify_taxonomy_lines([good_string], 7, self.prefixes)
+        self.assertEqual(report.exitStatus(), EXIT_OK)
+
+    def test_split_lines_file(self):
+        """split on line boundaries"""
+        text = open(self.taxonomy_fp).read()
+        for n in [2, 3, 10]:
+            ranges = split_lines_file(self.taxonomy_fp, n)
+            self.assertTrue(len(ranges) <= n)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], None)
+            for (a, b), (c, d) in zip(ranges, ranges[1:]):
+                self.assertEqual(b, c)
+                self.assertEqual(text[c - 1], '\n')
+        self.assertEqual(split_lines_file('foo.txt.gz', 4), [(0, None)])
+        self.assertEqual(split_lines_file(self.taxonomy_fp, 1), [(0, None)])
+
+    def test_verify_taxonomy_file(self):
+        """same report with any number of processes"""
+        exp = verify_taxonomy_lines(open(self.taxonomy_fp), 7, self.prefixes)
+        self.assertEqual(exp.counts['parse'], 25)
+        for n_workers in [1, 3]:
+            obs = verify_taxonomy_file(self.taxonomy_fp, 7, self.prefixes,
+                                       n_workers)
+            self.assertEqual(obs.toLines(), exp.toLines())
+
     def test_cache_tipnames(self):
         """caches tipnames"""
         t = DndParser("((a,b)c,(d,e)f)g;")
@@ -79,6 +159,27 @@ class VerifyTaxonomy(TestCase):
         self.assertEqual(t.Children[0].TipNames,['a','b'])
         self.assertEqual(t.Children[1].TipNames,['d','e'])
 
+        # views, not copies
+        names = t.TipNames
+        self.assertEqual(len(names), 4)
+        self.assertEqual(names[0], 'a')
+        self.assertEqual(names[-1], 'e')
+        self.assertEqual(names[1:3], ['b','d'])
+        self.assertEqual(list(t.Children[1].TipNames), ['d','e'])
+        self.assertTrue(t.Children[1].TipNames._names is names._names)
+        self.assertRaises(IndexError, t.Children[0].TipNames.__getitem__, 2)
+
+    def test_index_tips(self):
+        """number tips so each node covers a range"""
+        t = DndParser("((a,b)c,(d,(e,f)x,y)g)h;")
+        obs = index_tips(t)
+        self.assertEqual(obs, ['a','b','d','e','f','y'])
+        for n in t.postorder(include_self=True):
+            self.assertEqual(obs[n.TipStart:n.TipStop], 
+                             [tip.Name for tip in n.tips(include_self=True)])
+        self.assertEqual(obs[t.getNodeMatchingName('g').TipStart], 'd')
+        self.assertEqual(obs[t.getNodeMatchingName('x').TipStart], 'e')
+
     def test_get_polyphyletic(self):
         """get polyphyletic groups"""
         cons = {'a':['K','X1','X'],
@@ -120,6 +221,7 @@ bad_unclassified3 = "60	k__x; "
 bad_unclassified4 = "70	k__x"
 bad_nlevels = "80	k__a; p__b; c__c"
 bad_prefix = "1	k__a; p__b; c__c; q__d; f__e; g__f; s__g"
+taxonomy_lines = [good_string, bad_string, bad_prefix, bad_unclassified1, gap]
 
 if __name__ == '__main__':
     main()